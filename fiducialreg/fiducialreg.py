@@ -36,12 +36,18 @@ Examples
 """
 from __future__ import print_function, division
 
-from scipy import ndimage, optimize, stats
+from scipy import ndimage, optimize
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import cdist
+import os
 from os import path as osp
+import hashlib
 import itertools
 import numpy as np
 import logging
 import json
+from concurrent.futures import ThreadPoolExecutor
+from numba import jit
 
 # using Qt5Agg causes "window focus loss" in interpreter for some reason
 # import matplotlib
@@ -59,12 +65,67 @@ class RegistrationError(Exception):
     pass
 
 
-# TODO: try seperable gaussian filter instead for speed
-def log_filter(img, blurxysigma=1, blurzsigma=2.5, mask=None):
+def _filter_blocks(func, img, sigma, truncate=4.0, workers=None):
+    """Apply the separable filter func(block) to img in parallel blocks.
+
+    img is split along the axis where the blocks can be largest relative to the
+    kernel radius.  Each block is extended by the kernel radius on both sides,
+    so the result is identical to func(img).  scipy.ndimage releases the GIL,
+    so the blocks are filtered in threads.  Returns float32.
+    """
+    img = np.asarray(img, dtype=np.float32)
+    out = np.empty(img.shape, dtype=np.float32)
+    radius = [int(truncate * float(s) + 0.5) for s in sigma]
+    axis = int(np.argmax([n / (2 * r + 1) for n, r in zip(img.shape, radius)]))
+    n, r = img.shape[axis], radius[axis]
+    workers = workers or os.cpu_count() or 1
+    # blocks at least 4x the radius, so the overlap is at most half the work
+    nblocks = max(1, min(workers, n // max(1, 4 * r)))
+    edges = np.linspace(0, n, nblocks + 1).astype(int)
+
+    def work(i):
+        start, stop = edges[i], edges[i + 1]
+        lo, hi = max(0, start - r), min(n, stop + r)
+        src = [slice(None)] * img.ndim
+        dst = [slice(None)] * img.ndim
+        src[axis] = slice(lo, hi)
+        dst[axis] = slice(start, stop)
+        result = func(img[tuple(src)])
+        src[axis] = slice(start - lo, stop - lo)
+        out[tuple(dst)] = result[tuple(src)]
+
+    if nblocks == 1:
+        work(0)
+    else:
+        with ThreadPoolExecutor(nblocks) as executor:
+            list(executor.map(work, range(nblocks)))
+    return out
+
+
+def blur_filter(img, blurxysigma=1, blurzsigma=2.5, workers=None):
+    """float32 gaussian blur on the CPU, split across `workers` threads.
+
+    Same as the gputools.blur that FiducialCloud uses when OpenCL is available
+    (zero outside of the image).
+    """
+    sigma = [blurzsigma, blurxysigma, blurxysigma][-img.ndim :]
+
+    def func(block):
+        return ndimage.gaussian_filter(block, sigma, output=np.float32, mode="constant")
+
+    return _filter_blocks(func, img, sigma, workers=workers)
+
+
+def log_filter(img, blurxysigma=1, blurzsigma=2.5, mask=None, workers=None):
     # sigma that works for 2 or 3 dimensional img
     sigma = [blurzsigma, blurxysigma, blurxysigma][-img.ndim :]
+
+    def func(block):
+        return ndimage.gaussian_laplace(block, sigma, output=np.float32)
+
     # LOG filter image
-    filtered_img = -ndimage.gaussian_laplace(img.astype("f"), sigma)
+    filtered_img = _filter_blocks(func, img, sigma, workers=workers)
+    np.negative(filtered_img, out=filtered_img)
     # eliminate negative pixels
     filtered_img *= filtered_img > 0
     if mask is not None:
@@ -77,7 +138,89 @@ def bead_centroids(img, labeled, nlabels):
     return [ndimage.center_of_mass(img, labeled, l) for l in range(1, nlabels + 1)]
 
 
-def get_thresh(im, mincount=None, steps=100):
+@jit(nopython=True, nogil=True)
+def _find_root(parent, i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]  # path halving
+        i = parent[i]
+    return i
+
+
+@jit(nopython=True, nogil=True)
+def _sweep_components(bins, shape, nsteps):
+    """count connected components of the pixels with bins[i] > k, for every k
+
+    Pixels are added in order of decreasing bin and merged with their
+    (already added) 4-connected neighbors using a union-find forest, so the
+    counts for all thresholds are obtained in a single pass over the image.
+    """
+    ny, nx = shape
+    npix = ny * nx
+    # counting sort of the pixels by bin
+    start = np.zeros(nsteps + 2, np.int64)
+    for i in range(npix):
+        start[bins[i] + 1] += 1
+    for k in range(1, nsteps + 2):
+        start[k] += start[k - 1]
+    order = np.empty(npix, np.int64)
+    fill = start.copy()
+    for i in range(npix):
+        order[fill[bins[i]]] = i
+        fill[bins[i]] += 1
+
+    parent = np.full(npix, -1, np.int64)
+    counts = np.zeros(nsteps, np.int64)
+    ncomp = 0
+    for k in range(nsteps - 1, -1, -1):
+        # pixels in bin k + 1 are above threshold k, but not threshold k + 1
+        for n in range(start[k + 1], start[k + 2]):
+            i = order[n]
+            parent[i] = i
+            ncomp += 1
+            y, x = i // nx, i % nx
+            for dy, dx in ((-1, 0), (1, 0), (0, -1), (0, 1)):
+                yy, xx = y + dy, x + dx
+                if yy < 0 or yy >= ny or xx < 0 or xx >= nx:
+                    continue
+                j = yy * nx + xx
+                if parent[j] < 0:
+                    continue
+                ri, rj = _find_root(parent, i), _find_root(parent, j)
+                if ri != rj:
+                    parent[rj] = ri
+                    ncomp -= 1
+        counts[k] = ncomp
+    return counts
+
+
+def object_counts(im, thresholds):
+    """Return the number of objects ``ndimage.label(im > t)`` finds for each t
+
+    Equivalent to ``[ndimage.label(im > t)[1] for t in thresholds]`` for 2D
+    images, but computed in a single pass regardless of the number of
+    thresholds.
+    """
+    im = np.asarray(im)
+    if im.ndim != 2:
+        raise ValueError("object_counts requires a 2D image")
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    order = np.argsort(thresholds, kind="stable")
+    # number of thresholds each pixel is strictly greater than
+    bins = np.searchsorted(thresholds[order], im.ravel(), side="left")
+    counts = np.empty(len(thresholds), np.int64)
+    counts[order] = _sweep_components(bins, im.shape, len(thresholds))
+    return counts
+
+
+def threshold_counts(im, steps=100):
+    """return candidate thresholds and the number of objects above each one"""
+    if im.ndim == 3:
+        im = im.max(0)
+    threshrange = np.linspace(im.min(), im.max(), steps)
+    return threshrange, object_counts(im, threshrange)
+
+
+def get_thresh(im, mincount=None, steps=100, counts=None):
     """intelligently find coordinates of local maxima in an image
     by searching a range of threshold parameters to find_local_maxima
 
@@ -87,21 +230,22 @@ def get_thresh(im, mincount=None, steps=100):
     a tuple of sets of tuples ({(x,y),..},{(x,y),..},..) corresponding to
     local maxima in each image provided.  If nimages in == 1, returns a set
 
+    counts may be the precomputed output of :func:`threshold_counts`, to
+    avoid counting objects again when only mincount changes.
     """
-    if im.ndim == 3:
-        im = im.max(0)
     if mincount is None:
         mincount = 20
-    threshrange = np.linspace(im.min(), im.max(), steps)
-    object_count = [ndimage.label(im > t)[1] for t in threshrange]
-    object_count = np.array(object_count)
+    if counts is None:
+        counts = threshold_counts(im, steps)
+    threshrange, object_count = counts
     if mincount > object_count.max():
         raise RegistrationError(
             "Could not detect minimum number of beads specified ({}), found: {}".format(
                 mincount, object_count.max()
             )
         )
-    modecount = stats.mode(object_count[(object_count >= mincount)], axis=None).mode[0]
+    # most common count (smallest one in case of a tie, like scipy.stats.mode)
+    modecount = np.bincount(object_count[(object_count >= mincount)]).argmax()
     logging.debug(
         "Threshold detected: {}".format(
             threshrange[np.argmax(object_count == modecount)]
@@ -110,6 +254,119 @@ def get_thresh(im, mincount=None, steps=100):
     return threshrange[np.argmax(object_count == modecount)], modecount
 
 
+def bin_volume(img, binning):
+    """Mean of non-overlapping blocks of size binning=(bz, by, bx), as float32.
+
+    Trailing planes/rows/columns that do not fill a block are dropped.
+    """
+    shape = [n // b for n, b in zip(img.shape, binning)]
+    view = img[tuple(slice(0, n * b) for n, b in zip(shape, binning))]
+    view = view.reshape([i for n, b in zip(shape, binning) for i in (n, b)])
+    return view.mean(axis=tuple(range(1, 2 * img.ndim, 2)), dtype=np.float32)
+
+
+def plausible_objects(filtered, labeled, nlabels, maxdev=5):
+    """Boolean mask of the labeled objects that look like single beads.
+
+    Objects whose size (number of voxels) or peak intensity in the filtered
+    image deviates from the median of all objects by more than maxdev robust
+    standard deviations (on a log scale) are rejected: dim noise blobs,
+    bright clumps of beads and large aggregates.
+    """
+    if not nlabels:
+        return np.zeros(0, dtype=bool)
+    index = np.arange(1, nlabels + 1)
+    size = np.bincount(labeled.ravel(), minlength=nlabels + 1)[1:]
+    peak = ndimage.maximum(filtered, labeled, index)
+    keep = np.ones(nlabels, dtype=bool)
+    for values in (size, peak):
+        logv = np.log(np.maximum(values, 1e-6))
+        # 1.4826 * MAD estimates the standard deviation; allow at least 25%
+        spread = max(1.4826 * mad(logv), 0.25)
+        keep &= np.abs(logv - np.median(logv)) <= maxdev * spread
+    return keep
+
+
+def refine_roi(data, coarse, binning, half):
+    """Full resolution roi for an object found in a binned volume.
+
+    The roi is centered on the brightest voxel of ``data`` inside the (scaled)
+    coarse roi, and extends ``half`` voxels to each side in (z, y, x).
+    """
+    key = tuple(slice(s.start * b, s.stop * b) for s, b in zip(coarse, binning))
+    peak = np.unravel_index(np.argmax(data[key]), data[key].shape)
+    return tuple(
+        slice(max(0, s.start + p - h), min(n, s.start + p + h + 1))
+        for s, p, h, n in zip(key, peak, half, data.shape)
+    )
+
+
+def _roi_signal(data, key):
+    """background subtracted float roi, keeping only the upper half of the peak"""
+    roi = data[key].astype("f")
+    roi -= roi.min()
+    return np.maximum(roi - roi.max() / 2, 0)
+
+
+def localize_centroid(data, objects):
+    """Intensity weighted centroid of each roi (as in GaussFitter3D start values)
+
+    Returns:
+        np.ndarray: (N, 3) array of (x, y, z) pixel coordinates, NaN where the
+            roi has no signal.
+    """
+    out = np.full((len(objects), 3), np.nan)
+    for i, key in enumerate(objects):
+        w = _roi_signal(data, key)
+        total = w.sum()
+        if total > 0:
+            for ax, sl in enumerate(key):
+                profile = w.sum(axis=tuple(a for a in range(3) if a != ax))
+                center = (profile * np.arange(len(profile))).sum() / total
+                out[i, 2 - ax] = sl.start + center
+    return out
+
+
+def _gauss1d_center(profile):
+    """center of a 1D gaussian fit to profile (Guo's weighted log-parabola)"""
+    valid = profile > profile.max() * 0.1
+    x = np.flatnonzero(valid)
+    if x.size < 3:
+        return np.nan
+    y = profile[valid]
+    # minimize sum(y**2 * (log(y) - (a*x**2 + b*x + c))**2)
+    a, b, _ = np.polyfit(x, np.log(y), 2, w=y)
+    if a >= 0:
+        return np.nan
+    center = -b / (2 * a)
+    return center if 0 <= center <= len(profile) - 1 else np.nan
+
+
+def localize_gauss1d(data, objects):
+    """Separable localization: 1D gaussian fits to the projections of each roi
+
+    Returns:
+        np.ndarray: (N, 3) array of (x, y, z) pixel coordinates, NaN where a
+            fit failed.
+    """
+    out = np.full((len(objects), 3), np.nan)
+    for i, key in enumerate(objects):
+        roi = data[key].astype("f")
+        roi -= roi.min()
+        for ax, sl in enumerate(key):
+            profile = roi.sum(axis=tuple(a for a in range(3) if a != ax))
+            out[i, 2 - ax] = sl.start + _gauss1d_center(profile)
+    return out
+
+
+# bead localization tiers, see FiducialCloud (gauss3d uses GaussFitter3D)
+localizers = {
+    "centroid": localize_centroid,
+    "gauss1d": localize_gauss1d,
+    "gauss3d": None,
+}
+
+
 def mad(arr, axis=None, method="median"):
     """ Median/Mean Absolute Deviation: a "Robust" version of standard deviation.
     Indices variabililty of the sample.
@@ -123,19 +380,34 @@ def mad(arr, axis=None, method="median"):
         raise ValueError("Unrecognized option for method: {}".format(method))
 
 
+def _get_closest_points_brute(pc1, pc2):
+    """brute force reference implementation of :func:`get_closest_points`"""
+    pc1 = pc1.T
+    pc2 = pc2.T
+    d = [((pc2 - point) ** 2).sum(axis=1) for point in pc1]
+    nn = [(np.min(p), np.argmin(p)) for p in d]
+    return nn
+
+
 def get_closest_points(pc1, pc2):
-    """returns the distance and index of the closest matching point in pc2
-    for each point in pc1.
+    """returns the (squared) distance and index of the closest matching point
+    in pc2 for each point in pc1.
 
     len(nn) == len(pc1)
 
     can be used to eliminate points in pc2 that don't have a partner in pc1
+
+    Neighbors are found with a k-d tree, so this scales as O(N log M) rather
+    than O(N * M).
     """
-    pc1 = pc1.T
-    pc2 = pc2.T
-    d = [((pc2 - point) ** 2).sum(axis=1) for point in pc1]
-    nn = [(np.min(p), np.argmin(p)) for p in d]
-    return nn
+    pc1 = np.asarray(pc1, dtype=np.float64).T
+    pc2 = np.asarray(pc2, dtype=np.float64).T
+    if not len(pc2):
+        raise ValueError("Cannot find closest points in an empty point cloud")
+    idx = cKDTree(pc2).query(pc1, k=1)[1]
+    # recompute the squared distance exactly as the brute force method did
+    dist = ((pc2[idx] - pc1) ** 2).sum(axis=1)
+    return list(zip(dist, idx))
 
 
 def get_matching_points(pc1, pc2, method=None):
@@ -249,6 +521,119 @@ def infer_translation(X, Y):
     return M
 
 
+# minimal number of point pairs that determine each transform
+_min_samples = {
+    "translate": 1,
+    "translation": 1,
+    "rigid": 3,
+    "similarity": 3,
+    "affine": 4,
+    "2step": 4,
+}
+
+
+def infer_robust(
+    X,
+    Y,
+    mode="affine",
+    thresh=None,
+    confidence=0.999,
+    maxiter=2000,
+    batchsize=64,
+    seed=0,
+):
+    """ MSAC estimate of a `mode` transform that maps points X onto Y
+
+    Minimal random samples of point pairs are fit with the least squares
+    function for `mode`, and every hypothesis is scored on all points
+    at once (in batches of `batchsize`) with the truncated squared residual.
+    Sampling stops as soon as, with probability `confidence`, an outlier-free
+    sample has been drawn, or after `maxiter` hypotheses, so run time is
+    bounded by maxiter * npoints.  The best model is refit to its inliers.
+
+    X - 3xM XYZ points in starting coordinate system.
+    Y - 3xM XYZ points in destination coordinate system.
+    thresh - inlier distance.  If None, it is estimated from the residuals of
+        the least-median-of-squares hypothesis of the first batch.
+
+    Returns:
+        tuple: (4x4 transform matrix, boolean inlier mask of length M)
+    """
+    mode = mode.lower()
+    if mode not in _min_samples:
+        raise ValueError("Unrecognized robust transformation mode: {}".format(mode))
+    func = funcDict[mode]
+    npoints = X.shape[1]
+    nsample = _min_samples[mode]
+    if npoints < nsample:
+        raise RegistrationError(
+            "{} transform needs at least {} matching points, got {}".format(
+                mode, nsample, npoints
+            )
+        )
+    rs = np.random.RandomState(seed)
+    Xh = cart2hom(X)
+
+    def residuals(tforms):
+        # squared distance of all points for a stack of tforms: (ntforms, M)
+        return ((np.matmul(tforms[:, :3], Xh) - Y) ** 2).sum(1)
+
+    best_tform, best_cost, best_r2 = None, np.inf, None
+    t2 = None if thresh is None else float(thresh) ** 2
+    needed = maxiter
+    niter = 0
+    while niter < min(needed, maxiter):
+        tforms = []
+        nbatch = min(batchsize, maxiter - niter)
+        for _ in range(nbatch):
+            idx = rs.choice(npoints, nsample, replace=False)
+            try:
+                T = func(X[:, idx], Y[:, idx])
+            except np.linalg.LinAlgError:
+                continue
+            if np.all(np.isfinite(T)):
+                tforms.append(T)
+        niter += nbatch
+        if not tforms:
+            continue
+        tforms = np.array(tforms)
+        r2 = residuals(tforms)
+        if t2 is None:
+            # least median of squares gives a robust scale for the threshold
+            med = np.median(r2, 1)
+            scale = 1.4826 * (1 + 5 / max(npoints - nsample, 1)) * np.sqrt(med.min())
+            t2 = max(2.5 * scale, 1e-12) ** 2
+        cost = np.minimum(r2, t2).sum(1)
+        i = np.argmin(cost)
+        if cost[i] < best_cost:
+            best_tform, best_cost, best_r2 = tforms[i], cost[i], r2[i]
+            ratio = np.mean(best_r2 < t2)
+            if ratio >= 1:
+                needed = 0
+            elif ratio > 0:
+                needed = np.log(1 - confidence) / np.log(1 - ratio ** nsample)
+
+    if best_tform is None:
+        raise RegistrationError("Failed to estimate {} transform".format(mode))
+    # refine the best hypothesis by least squares on its inliers
+    inliers = best_r2 < t2
+    for _ in range(5):
+        if inliers.sum() < nsample:
+            break
+        tform = func(X[:, inliers], Y[:, inliers])
+        refined = residuals(tform[np.newaxis])[0] < t2
+        best_tform = tform
+        if np.array_equal(refined, inliers):
+            break
+        inliers = refined
+    logger.debug(
+        "{} MSAC: {} of {} inliers after {} hypotheses".format(
+            mode, inliers.sum(), npoints, niter
+        )
+    )
+    return best_tform, inliers
+
+
 # ### APPLY TRANSFORMS ####
 
 
@@ -365,13 +750,28 @@ def FitModelWeighted(modelFcn, startParameters, data, sigmas, *args):
 
 
 class GaussFitResult:
-    def __init__(self, fitResults, dx, dz, slicekey=None, resultCode=None, fitErr=None):
+    def __init__(
+        self,
+        fitResults,
+        dx,
+        dz,
+        slicekey=None,
+        resultCode=None,
+        fitErr=None,
+        residual=None,
+    ):
         self.fitResults = fitResults
         self.dx = dx
         self.dz = dz
         self.slicekey = slicekey
         self.resultCode = resultCode
         self.fitErr = fitErr
+        self.residual = residual
+
+    @property
+    def success(self):
+        """whether the fit converged (follows the scipy.optimize.leastsq codes)"""
+        return self.resultCode in (1, 2, 3, 4)
 
     def A(self):
         return self.fitResults[0]
@@ -408,8 +808,8 @@ class GaussFitter3D(object):
         self.wx = wx
         self.wz = wz
 
-    def __getitem__(self, key):
-        """ return gaussian fit of a 3D roi defined by a 3-tuple of slices """
+    def _prepare(self, key):
+        """cut out a 3D roi and return (dataROI, sigma, X, Y, Z, startParameters)"""
         zslice, yslice, xslice = key
         # cut region out of data stack
         dataROI = self.data[zslice, yslice, xslice].astype("f")
@@ -451,23 +851,220 @@ class GaussFitter3D(object):
             )
             / electrons_per_ADU
         )
+        return dataROI, sigma, X, Y, Z, startParameters
+
+    def __getitem__(self, key):
+        """ return gaussian fit of a 3D roi defined by a 3-tuple of slices """
+        dataROI, sigma, X, Y, Z, startParameters = self._prepare(key)
 
         (res1, cov_x, infodict, mesg1, resCode) = FitModelWeighted(
             f_Gauss3d, startParameters, dataROI, sigma, X, Y, Z
         )
         # misfit = (infodict['fvec']**2).sum()  # nfev is the number of function calls
+        residual = (infodict["fvec"] * infodict["fvec"]).sum() / (
+            dataROI.size - len(res1)
+        )
 
         fitErrors = None
         try:
-            fitErrors = np.sqrt(
-                np.diag(cov_x)
-                * (infodict["fvec"] * infodict["fvec"]).sum()
-                / (dataROI.size - len(res1))
-            )
+            fitErrors = np.sqrt(np.diag(cov_x) * residual)
         except Exception:
             pass
 
-        return GaussFitResult(res1, self.dx, self.dz, key, resCode, fitErrors)
+        return GaussFitResult(res1, self.dx, self.dz, key, resCode, fitErrors, residual)
+
+    def fit_batch(self, keys, batchsize=256, workers=None, maxiter=200):
+        """Fit many rois at once.
+
+        Equivalent to ``[self[key] for key in keys]``, but rois are padded to a
+        common size and fit together with a vectorized Levenberg-Marquardt
+        solver (:func:`fit_gauss3d_batch`), in batches of ``batchsize`` spread
+        across ``workers`` threads.
+
+        Rois that cannot be fit are not dropped: their result has
+        ``success == False`` (resultCode 0 for invalid input or numerical
+        failure, 5 if the fit did not converge within ``maxiter`` iterations).
+        An error in one roi never aborts the fit of the others.
+        """
+        keys = list(keys)
+        failed = (np.full(7, np.nan), 0, None, np.nan)
+        prepared = {}
+        for i, key in enumerate(keys):
+            try:
+                prepared[i] = self._prepare(key)
+            except Exception as e:
+                logger.debug("could not prepare roi {}: {}".format(key, e))
+        # group rois of similar size to minimize padding
+        order = sorted(prepared, key=lambda i: prepared[i][0].size)
+        batches = [order[i : i + batchsize] for i in range(0, len(order), batchsize)]
+
+        def fit_one(i):
+            try:
+                return [r[0] for r in fit_gauss3d_batch([prepared[i]], maxiter)]
+            except Exception as e:
+                logger.debug("could not fit roi {}: {}".format(keys[i], e))
+                return failed
+
+        def work(batch):
+            # np.seterr is thread-local, diverging fits must not spam warnings
+            with np.errstate(all="ignore"):
+                try:
+                    return fit_gauss3d_batch(
+                        [prepared[i] for i in batch], maxiter=maxiter
+                    )
+                except Exception:
+                    # refit one roi at a time, so that a bad roi only fails itself
+                    return list(zip(*[fit_one(i) for i in batch]))
+
+        results = [
+            GaussFitResult(failed[0], self.dx, self.dz, key, *failed[1:])
+            for key in keys
+        ]
+        with ThreadPoolExecutor(workers) as executor:
+            for batch, out in zip(batches, executor.map(work, batches)):
+                for i, params, code, err, residual in zip(batch, *out):
+                    results[i] = GaussFitResult(
+                        params, self.dx, self.dz, keys[i], code, err, residual
+                    )
+        return results
+
+
+def _gauss3d_residuals(p, data, weights, X, Y, Z, jacobian=True):
+    """weighted residuals (and their jacobian) of f_Gauss3d for a batch of rois
+
+    p has shape (N, 7), all other arrays have shape (N, npix)
+    """
+    A, x0, y0, z0, wxy, wz, b = [p[:, i : i + 1] for i in range(7)]
+    dx, dy, dz = X - x0, Y - y0, Z - z0
+    rxy = dx ** 2 + dy ** 2
+    E = np.exp(-rxy / (2 * wxy ** 2) - dz ** 2 / (2 * wz ** 2))
+    res = (data - A * E - b) * weights
+    if not jacobian:
+        return res
+    AE = A * E
+    jac = np.stack(
+        (
+            E,
+            AE * dx / wxy ** 2,
+            AE * dy / wxy ** 2,
+            AE * dz / wz ** 2,
+            AE * rxy / wxy ** 3,
+            AE * dz ** 2 / wz ** 3,
+            np.ones_like(E),
+        ),
+        axis=-1,
+    )
+    jac *= -weights[..., None]
+    return res, jac
+
+
+def _solve_batch(M, v):
+    """solve a stack of linear systems, returning nan for singular ones"""
+    try:
+        return np.linalg.solve(M, v[..., None])[..., 0]
+    except np.linalg.LinAlgError:
+        out = np.full(v.shape, np.nan)
+        for i in range(len(M)):
+            try:
+                out[i] = np.linalg.solve(M[i], v[i])
+            except np.linalg.LinAlgError:
+                pass
+        return out
+
+
+def fit_gauss3d_batch(rois, maxiter=200, ftol=1.49012e-08, xtol=1.49012e-08):
+    """Vectorized weighted least-squares fit of f_Gauss3d to many rois.
+
+    Args:
+        rois: list of (data, sigma, X, Y, Z, startParameters), as returned
+            by :meth:`GaussFitter3D._prepare`.  Rois may differ in size.
+
+    Returns:
+        tuple: (params, resultCode, fitErrors, residual) lists, one entry per
+        roi.  resultCode follows scipy.optimize.leastsq: 1 and 2 indicate
+        convergence in cost and parameters respectively, 5 that maxiter was
+        reached, and 0 that the roi could not be fit.  residual is the
+        reduced chi-square of the fit.
+    """
+    nparam = 7
+    n = len(rois)
+    npix = np.array([r[0].size for r in rois])
+    P = max(npix.max() if n else 0, 1)
+    data = np.zeros((n, P))
+    weights = np.zeros((n, P))
+    X, Y, Z = np.zeros((n, P)), np.zeros((n, P)), np.zeros((n, P))
+    p = np.zeros((n, nparam))
+    for i, (d, sigma, x, y, z, start) in enumerate(rois):
+        k = d.size
+        data[i, :k] = d.ravel()
+        weights[i, :k] = (1.0 / sigma).astype("f").ravel()
+        X[i, :k], Y[i, :k], Z[i, :k] = x.ravel(), y.ravel(), z.ravel()
+        p[i] = start
+
+    def residuals(idx, params, jacobian=True):
+        return _gauss3d_residuals(
+            params, data[idx], weights[idx], X[idx], Y[idx], Z[idx], jacobian
+        )
+
+    code = np.zeros(n, dtype=int)
+    running = np.isfinite(p).all(1) & (npix > nparam)
+    res = np.zeros((n, P))
+    jac = np.zeros((n, P, nparam))
+    idx = np.flatnonzero(running)
+    res[idx], jac[idx] = residuals(idx, p[idx])
+    cost = (res ** 2).sum(1)
+    lam = np.full(n, 1e-3)
+    # as in MINPACK, scale the damping by the largest column norms seen so far
+    scale = np.zeros((n, nparam))
+    for _ in range(maxiter):
+        idx = np.flatnonzero(running)
+        if not idx.size:
+            break
+        J, r = jac[idx], res[idx]
+        JTJ = J.transpose(0, 2, 1) @ J
+        grad = (J.transpose(0, 2, 1) @ r[..., None])[..., 0]
+        scale[idx] = np.maximum(scale[idx], np.diagonal(JTJ, axis1=1, axis2=2))
+        damped = JTJ + lam[idx, None, None] * (
+            np.eye(nparam) * scale[idx][:, None, :]
+        )
+        step = -_solve_batch(damped, grad)
+        new_p = p[idx] + step
+        new_res, new_jac = residuals(idx, new_p)
+        new_cost = (new_res ** 2).sum(1)
+        pred_cost = ((r + (J @ step[..., None])[..., 0]) ** 2).sum(1)
+
+        ok = np.isfinite(new_cost) & (new_cost <= cost[idx])
+        acc = idx[ok]
+        small_cost = (cost[acc] - new_cost[ok] <= ftol * cost[acc]) & (
+            cost[acc] - pred_cost[ok] <= ftol * cost[acc]
+        )
+        snorm = np.sqrt(scale[acc])
+        small_step = np.linalg.norm(snorm * step[ok], axis=1) <= (
+            xtol * np.linalg.norm(snorm * new_p[ok], axis=1)
+        )
+        p[acc] = new_p[ok]
+        res[acc], jac[acc], cost[acc] = new_res[ok], new_jac[ok], new_cost[ok]
+        lam[acc] /= 10
+        code[acc[small_step]] = 2
+        code[acc[small_cost]] = 1
+        rej = idx[~ok]
+        lam[rej] *= 10
+        # no further improvement possible: at a minimum
+        code[rej[lam[rej] > 1e16]] = 1
+        running &= code == 0
+    code[running] = 5
+
+    dof = np.maximum(npix - nparam, 1)
+    residual = cost / dof
+    fiterr = [None] * n
+    for i in np.flatnonzero(code > 0):
+        try:
+            J = jac[i, : npix[i]]
+            fiterr[i] = np.sqrt(np.diag(np.linalg.inv(J.T @ J)) * residual[i])
+        except np.linalg.LinAlgError:
+            pass
+    residual[code == 0] = np.nan
+    return list(p), list(code), fiterr, list(residual)
 
 
 class FiducialCloud(object):
@@ -492,6 +1089,18 @@ class FiducialCloud(object):
         filtertype ({'blur', 'log'}): type of blur to use prior to bead detection.
             log = laplacian of gaussian
             blur = gaussian
+        binning (:obj:`int`): if > 1, beads are detected coarse-to-fine: the
+            volume is binned by this factor in XY before filtering, thresholding
+            and labeling, implausible objects are rejected by size and
+            intensity (see :func:`plausible_objects`), and only the remaining
+            candidates are fit at full resolution, in a roi of +/- 3 blur sigmas
+            around their brightest voxel.  ``filtered`` and the threshold then
+            refer to the binned volume.
+        localization ({'centroid', 'gauss1d', 'gauss3d'}): how beads are
+            localized in their roi, from fastest to most accurate.
+            centroid = intensity weighted centroid
+            gauss1d = 1D gaussian fits to the X, Y and Z projections
+            gauss3d = full 3D gaussian fit (:obj:`GaussFitter3D`, default)
 
     """
 
@@ -506,6 +1115,8 @@ class FiducialCloud(object):
         mincount=None,
         imref=None,
         filtertype="blur",
+        binning=1,
+        localization="gauss3d",
     ):
         # data is a numpy array or filename
         self.data = None
@@ -538,12 +1149,87 @@ class FiducialCloud(object):
         self._mincount = mincount
         self.imref = imref
         self.coords = None
+        self.fits = []
         self.filtertype = filtertype
+        self.binning = int(binning)
+        if localization not in localizers:
+            raise ValueError(
+                "localization must be one of {}, got {}".format(
+                    tuple(localizers), localization
+                )
+            )
+        self.localization = localization
 
         logger.debug("New fiducial cloud created with dx: {},  dz: {}".format(dx, dz))
         if self.data is not None:
             self.update_coords()
 
+    # parameters that change the result of bead detection
+    detection_params = (
+        "dx",
+        "dz",
+        "blurxysig",
+        "blurzsig",
+        "threshold",
+        "_mincount",
+        "filtertype",
+        "binning",
+        "localization",
+    )
+
+    @classmethod
+    def from_cache(cls, data, cache_dir=None, **kwargs):
+        """Create a FiducialCloud, reusing bead coordinates from a previous run.
+
+        Results are stored as JSON in cache_dir (by default the "beads"
+        folder of :func:`mosaicpy.util.get_cache_dir`), keyed by the identity
+        of the data and the detection parameters in kwargs.  Files are
+        identified by path, size and modification time, only in-memory arrays
+        are hashed.  On a cache hit no detection is performed, and a file is
+        not even read.
+        """
+        if cache_dir is None:
+            from mosaicpy.util import get_cache_dir
+
+            cache_dir = get_cache_dir("beads")
+        cloud = cls(**kwargs)
+        if isinstance(data, str) and osp.isfile(data):
+            stat = os.stat(data)
+            ident = [osp.abspath(data), stat.st_mtime_ns, stat.st_size]
+            name = osp.splitext(osp.basename(data))[0]
+        elif isinstance(data, np.ndarray):
+            digest = hashlib.sha1(np.ascontiguousarray(data).view(np.uint8))
+            ident = [digest.hexdigest(), data.shape, str(data.dtype)]
+            name = "array"
+        else:
+            raise ValueError(
+                "Input to Registration must either be a filepath or a numpy arrays"
+            )
+        params = {k: getattr(cloud, k) for k in cls.detection_params}
+        key = json.dumps([ident, params], sort_keys=True, default=str)
+        cachefile = osp.join(
+            cache_dir,
+            "{}_{}.json".format(name, hashlib.sha1(key.encode()).hexdigest()[:16]),
+        )
+        if osp.isfile(cachefile):
+            with open(cachefile) as f:
+                cloud.fromJSON(f.read())
+            if isinstance(data, np.ndarray):
+                cloud.data = data
+            logger.debug("Loaded fiducials from cache: {}".format(cachefile))
+            return cloud
+
+        cloud = cls(data, **kwargs)
+        os.makedirs(cache_dir, exist_ok=True)
+        # write to a temporary file first, so that concurrent processes
+        # never see a partially written cache file
+        tmpfile = "{}.{}.tmp".format(cachefile, os.getpid())
+        with open(tmpfile, "w") as f:
+            f.write(cloud.toJSON())
+        os.replace(tmpfile, cachefile)
+        logger.debug("Cached fiducials: {}".format(cachefile))
+        return cloud
+
     def has_data(self):
         return isinstance(self.data, np.ndarray)
 
@@ -567,24 +1253,45 @@ class FiducialCloud(object):
     @lazyattr
     def filtered(self):
         if self.data is not None:
+            data = self.data
+            blurxysig = self.blurxysig
+            if self.binning > 1:
+                data = bin_volume(data, (1, self.binning, self.binning))
+                blurxysig = blurxysig / self.binning
             if self.filtertype == "log":
-                return log_filter(self.data, self.blurxysig, self.blurzsig)
+                return log_filter(data, blurxysig, self.blurzsig)
             else:
-                from gputools import blur
-                import warnings
-
-                sigs = np.array([self.blurzsig, self.blurxysig, self.blurxysig]) * 2
-                with warnings.catch_warnings():
-                    warnings.simplefilter("ignore")
-                    out = blur(self.data, sigs)
-                return out
+                sigs = np.array([self.blurzsig, blurxysig, blurxysig]) * 2
+                try:
+                    from gputools import blur
+                    import warnings
+
+                    with warnings.catch_warnings():
+                        warnings.simplefilter("ignore")
+                        return blur(data, sigs)
+                except Exception as e:
+                    logger.debug("gputools blur unavailable, using CPU: {}".format(e))
+                    return blur_filter(data, sigs[1], sigs[0])
         else:
             return None
 
+    @property
+    def threshold_counts(self):
+        """:func:`threshold_counts` of filtered, cached until filtered changes"""
+        filtered = self.filtered
+        if filtered is None:
+            return None
+        cached = self.__dict__.get("_threshold_counts")
+        # hold on to the array itself, an id() could be reused
+        if cached is None or cached[0] is not filtered:
+            cached = (filtered, threshold_counts(filtered))
+            self._threshold_counts = cached
+        return cached[1]
+
     def autothresh(self, mincount=None):
         if mincount is None:
             mincount = self._mincount
-        return get_thresh(self.filtered, mincount)[0]
+        return get_thresh(self.filtered, mincount, counts=self.threshold_counts)[0]
 
     def update_coords(self, thresh=None):
         if self.filtered is None:
@@ -601,30 +1308,55 @@ class FiducialCloud(object):
                 "Threshold must be number greater than 0.  got: {}".format(thresh)
             )
         logger.debug("Update_coords using threshold: {}".format(thresh))
-        labeled = ndimage.label(self.filtered > thresh)[0]
+        labeled, nlabels = ndimage.label(self.filtered > thresh)
         objects = ndimage.find_objects(labeled)
-        # FIXME: pass sigmas to wx and wz parameters of GaussFitter
-        fitter = GaussFitter3D(self.data, dz=self.dz, dx=self.dx)
-        gaussfits = []
-        for chunk in objects:
-            try:
-                # TODO: filter by bead intensity as well to reject bright clumps
-                F = fitter[chunk]
-                if (
-                    (F.x(0) < self.data.shape[2])
-                    and (F.x(0) > 0)
-                    and (F.y(0) < self.data.shape[1])
-                    and (F.y(0) > 0)
-                    and (F.z(0) < self.data.shape[0])
-                    and (F.z(0) > 0)
-                ):
-                    gaussfits.append(F)
-            except Exception:
-                pass
-                # import warnings
-                # warnings.warn('skipped a spot')
-        self.coords = np.array([[n.x(0), n.y(0), n.z(0)] for n in gaussfits]).T
-        if not len(self.coords):
+        if self.binning > 1:
+            keep = plausible_objects(self.filtered, labeled, nlabels)
+            logger.debug(
+                "rejected {} of {} coarse bead candidates".format(
+                    nlabels - keep.sum(), nlabels
+                )
+            )
+            # refine the survivors at full resolution, in rois of +/- 3 sigma
+            binning = (1, self.binning, self.binning)
+            sigma = np.array([self.blurzsig, self.blurxysig, self.blurxysig])
+            half = np.ceil(3 * sigma).astype(int)
+            objects = [
+                refine_roi(self.data, obj, binning, half)
+                for obj, k in zip(objects, keep)
+                if k
+            ]
+        if self.localization != "gauss3d":
+            xyz = localizers[self.localization](self.data, objects)
+            with np.errstate(invalid="ignore"):
+                inbounds = np.all((xyz > 0) & (xyz < self.data.shape[::-1]), 1)
+            self.fits = []
+            self.coords = xyz[inbounds].T
+        else:
+            # FIXME: pass sigmas to wx and wz parameters of GaussFitter
+            fitter = GaussFitter3D(self.data, dz=self.dz, dx=self.dx)
+            self.fits = fitter.fit_batch(objects)
+            gaussfits = [
+                F
+                for F in self.fits
+                if F.success
+                and (F.x(0) < self.data.shape[2])
+                and (F.x(0) > 0)
+                and (F.y(0) < self.data.shape[1])
+                and (F.y(0) > 0)
+                and (F.z(0) < self.data.shape[0])
+                and (F.z(0) > 0)
+            ]
+            nfailed = sum(not F.success for F in self.fits)
+            if nfailed:
+                logger.debug(
+                    "{} of {} bead fits failed to converge".format(
+                        nfailed, len(self.fits)
+                    )
+                )
+            coords = [[n.x(0), n.y(0), n.z(0)] for n in gaussfits]
+            self.coords = np.array(coords).reshape(-1, 3).T
+        if not self.count:
             logging.warning(
                 "PointCloud has no points! {}".format(
                     self.filename if "filename" in dir(self) else ""
@@ -644,14 +1376,20 @@ class FiducialCloud(object):
                 im = self.filtered.max(0)
             else:
                 im = self.data.max(0)
-            plt.imshow(im, cmap="gray", vmax=im.max() * 0.7)
+            # binned images are stretched to full resolution pixel coordinates
+            b = self.binning if filtered else 1
+            ny, nx = im.shape[0] * b, im.shape[1] * b
+            extent = (-0.5, nx - 0.5, ny - 0.5, -0.5)
+            plt.imshow(im, cmap="gray", vmax=im.max() * 0.7, extent=extent)
         if self.count:
             plt.scatter(self.coords[0], self.coords[1], c="red", s=5)
 
     def toJSON(self):
         D = self.__dict__.copy()
         D.pop("filtered", None)
+        D.pop("_threshold_counts", None)
         D.pop("data", None)
+        D.pop("fits", None)
         D["coords"] = self.coords.tolist()
         return json.dumps(D)
 
@@ -682,6 +1420,10 @@ class CloudSet(object):
             fiducial cloud in the set.  This allows registration using labels
             instead of the index of the original dataset provided to :obj:`CloudSet`
 
+        cache_dir (:obj:`str`, optional): if provided, detected bead clouds are
+            cached in this directory (see :obj:`FiducialCloud.from_cache`), so
+            that clouds are only detected once for each file and set of
+            detection parameters.
         **kwargs: extra keyword arguments are passed to the :obj:`FiducialCloud`
             constructor.
 
@@ -695,10 +1437,13 @@ class CloudSet(object):
         dz=1,
         mincount=None,
         threshold=None,
+        cache_dir=None,
         **kwargs
     ):
         self.dx = dx
         self.dz = dz
+        # (moving, fixed, mode): (number of inliers, number of matching points)
+        self.inliers = {}
         if data is not None:
             if not isinstance(data, (list, tuple, set)):
                 raise ValueError(
@@ -719,16 +1464,14 @@ class CloudSet(object):
                 logger.info(
                     "Creating FiducalCloud for label: {}".format(self.labels[i])
                 )
-                self.clouds.append(
-                    FiducialCloud(
-                        d,
-                        dx=self.dx,
-                        dz=self.dz,
-                        threshold=threshold,
-                        mincount=mincount,
-                        **kwargs
-                    )
+                kwargs.update(
+                    dx=self.dx, dz=self.dz, threshold=threshold, mincount=mincount
                 )
+                if cache_dir is not None:
+                    cloud = FiducialCloud.from_cache(d, cache_dir, **kwargs)
+                else:
+                    cloud = FiducialCloud(d, **kwargs)
+                self.clouds.append(cloud)
         else:
             self.clouds = []
             self.N = 0
@@ -842,8 +1585,13 @@ class CloudSet(object):
             "cpd_2step",
             "cpd_similarity",
         ),
+        robust=False,
     ):
-        """Generate an array of dicts for lots of possible tforms."""
+        """Generate an array of dicts for lots of possible tforms.
+
+        For robustly estimated modes, the dict also holds the number of
+        "inliers" among the "matched" points.
+        """
 
         if refs is None:
             # default to all channels
@@ -884,15 +1632,19 @@ class CloudSet(object):
         for moving, fixed in pairings:
             for mode in modes:
                 try:
-                    D.append(
-                        {
-                            "mode": mode,
-                            "reference": fixed,
-                            "moving": moving,
-                            "inworld": inworld,
-                            "tform": self.tform(moving, fixed, mode, inworld=inworld),
-                        }
+                    tform = self.tform(
+                        moving, fixed, mode, inworld=inworld, robust=robust
                     )
+                    d = {
+                        "mode": mode,
+                        "reference": fixed,
+                        "moving": moving,
+                        "inworld": inworld,
+                        "tform": tform,
+                    }
+                    if robust and (moving, fixed, mode) in self.inliers:
+                        d["inliers"], d["matched"] = self.inliers[(moving, fixed, mode)]
+                    D.append(d)
                 except Exception:
                     print("SKIPPING MODE: ", mode)
                     logger.error(
@@ -930,7 +1682,13 @@ class CloudSet(object):
 
     # Main Method
     def tform(
-        self, movingLabel=None, fixedLabel=None, mode="2step", inworld=True, **kwargs
+        self,
+        movingLabel=None,
+        fixedLabel=None,
+        mode="2step",
+        inworld=True,
+        robust=False,
+        **kwargs
     ):
         """ get tform matrix that maps moving point cloud to fixed point cloud
 
@@ -947,6 +1705,11 @@ class CloudSet(object):
             inworld (:obj:`bool`): if True, will use :obj:`intrinsicToWorld` to
                 convert pixel coordinates into world coordinates using the voxel
                 size provided.  (needs work)
+            robust (:obj:`bool`): for least squares modes, estimate the tform
+                with :obj:`infer_robust`, ignoring mismatched points.  The
+                number of inliers is stored in ``self.inliers``.  Defaults to
+                False.
+            **kwargs: passed to :obj:`infer_robust` (e.g. thresh, maxiter)
 
         Returns:
             :obj:`np.ndarray`: 4x4 transformation matrix
@@ -994,7 +1757,17 @@ class CloudSet(object):
                 matching = self._get_matching(inworld=inworld)
                 moving = matching[movIdx]
                 fixed = matching[fixIdx]
-                tform = funcDict[mode](moving, fixed)
+                if robust:
+                    tform, inliers = infer_robust(moving, fixed, mode, **kwargs)
+                    key = (movingLabel, fixedLabel, mode)
+                    self.inliers[key] = (int(inliers.sum()), inliers.size)
+                    logger.info(
+                        "{} tform: {} of {} matching points are inliers".format(
+                            mode, *self.inliers[key]
+                        )
+                    )
+                else:
+                    tform = funcDict[mode](moving, fixed)
             logger.info(
                 "Measured {} Tform Matrix {}inWorld:\n".format(
                     mode, "" if inworld else "not "
@@ -1205,6 +1978,70 @@ class RegFile(object):
 
         return self.tform_dict[ref][moving][mode]
 
+    def preview(
+        self,
+        volumes,
+        waves,
+        ref,
+        mode,
+        dx=None,
+        dz=None,
+        method="mip",
+        binning=4,
+        prewarp=None,
+    ):
+        """Quickly show the effect of this registration on a set of volumes.
+
+        Args:
+            volumes (list): one 3D (z, y, x) array per channel
+            waves (list): wavelength of each volume
+            ref: reference wavelength, this channel is not transformed
+            mode (str): registration mode to apply (see get_tform)
+            dx, dz (float): voxel size of the volumes, by default the voxel
+                size of the registration calibration
+            method ({'mip', 'binned'}): 'mip' warps the maximum intensity
+                projection of each channel (see imwarp.projection_plan), and
+                returns (c, 1, y, x).  'binned' warps the volumes after
+                binning by `binning` in XY, and returns (c, z, y/b, x/b).
+            prewarp (tuple, optional): (matrix, output_shape) of an index
+                transform (see WarpPlan.from_matrix) applied to every volume
+                before registration, e.g. to deskew sample-scan stacks.  dx
+                and dz are then the voxel size after prewarp.
+
+        Returns:
+            np.ndarray: float32 array of registered channels
+        """
+        from fiducialreg.imref import imref3d
+        from fiducialreg.imwarp import projection_plan, WarpPlan
+
+        dx = dx or self.dx or 1
+        dz = dz or self.dz or 1
+        if prewarp is not None:
+            matrix, shape = prewarp
+            prewarp = WarpPlan.from_matrix(matrix, np.shape(volumes[0]), shape)
+        out = []
+        for vol, wave in zip(volumes, waves):
+            if prewarp is not None:
+                vol = prewarp(vol)
+            if method == "mip":
+                data = vol.max(0)[np.newaxis].astype(np.float32)
+            elif method == "binned":
+                vol = bin_volume(vol, (1, binning, binning))
+                data = vol
+            else:
+                raise ValueError("Unrecognized preview method: {}".format(method))
+            if str(wave) == str(ref):
+                out.append(data)
+                continue
+            tform = self.get_tform(wave, ref, mode)
+            if method == "mip":
+                R_A = imref3d(vol.shape, dx, dx, dz)
+                out.append(projection_plan(tform, vol.shape, R_A)(data))
+            else:
+                R_A = imref3d(vol.shape, dx * binning, dx * binning, dz)
+                out.append(WarpPlan(tform, vol.shape, R_A)(vol))
+        return np.stack(out)
+
 
 ###############################################################################
 # code below is a *very* slightly modified version of the pycpd repo from
@@ -1260,6 +2097,7 @@ class CPDregistration(object):
         maxIterations=100,
         tolerance=0.001,
         w=0,
+        blocksize=None,
     ):
         if X.shape[1] != Y.shape[1]:
             raise ValueError(
@@ -1281,6 +2119,9 @@ class CPDregistration(object):
         self.w = w
         self.q = 0
         self.err = 0
+        # number of points in X processed at once in the E step: memory use is
+        # proportional to M * blocksize rather than M * N
+        self.blocksize = blocksize or max(1, 2 ** 22 // max(self.M, 1))
 
     @property
     def matrix(self):
@@ -1326,44 +2167,61 @@ class CPDregistration(object):
             self.t, self.M, axis=0
         )
         if not self.sigma2:
-            XX = np.reshape(self.X, (1, self.N, self.D))
-            YY = np.reshape(self.Y, (self.M, 1, self.D))
-            XX = np.tile(XX, (self.M, 1, 1))
-            YY = np.tile(YY, (1, self.N, 1))
-            diff = XX - YY
-            err = np.multiply(diff, diff)
-            self.sigma2 = np.sum(err) / (self.D * self.M * self.N)
+            # mean squared distance over all pairs of points, without forming
+            # the M x N distance matrix.  Centering keeps this accurate.
+            center = np.mean(self.X, axis=0)
+            X, Y = self.X - center, self.Y - center
+            err = (
+                self.M * np.sum(X * X)
+                + self.N * np.sum(Y * Y)
+                - 2 * np.dot(np.sum(X, axis=0), np.sum(Y, axis=0))
+            )
+            self.sigma2 = err / (self.D * self.M * self.N)
 
         self.err = self.tolerance + 1
         self.q = -self.err - self.N * self.D / 2 * np.log(self.sigma2)
 
     def EStep(self):
-        P = np.zeros((self.M, self.N))
-
-        for i in range(0, self.M):
-            diff = self.X - np.tile(self.TY[i, :], (self.N, 1))
-            diff = np.multiply(diff, diff)
-            P[i, :] = P[i, :] + np.sum(diff, axis=1)
+        """Compute the posterior correspondence probabilities P (M x N).
 
+        P is never stored: it is computed in blocks of ``blocksize`` columns
+        (points of X), which are independent because P is normalized over
+        each column, and reduced on the fly to the sums used in the M step:
+        P1 = P 1, Pt1 = P^T 1 and PX = P X.
+        """
         c = (2 * np.pi * self.sigma2) ** (self.D / 2)
         c = c * self.w / (1 - self.w)
         c = c * self.M / self.N
 
-        P = np.exp(-P / (2 * self.sigma2))
-        den = np.sum(P, axis=0)
-        den = np.tile(den, (self.M, 1))
-        den[den == 0] = np.finfo(float).eps
-
-        self.P = np.divide(P, den)
-        self.Pt1 = np.sum(self.P, axis=0)
-        self.P1 = np.sum(self.P, axis=1)
+        self.Pt1 = np.empty(self.N)
+        self.P1 = np.zeros(self.M)
+        self.PX = np.zeros((self.M, self.D))
+        for start in range(0, self.N, self.blocksize):
+            block = slice(start, start + self.blocksize)
+            P = cdist(self.TY, self.X[block], "sqeuclidean")
+            P = np.exp(-P / (2 * self.sigma2))
+            den = np.sum(P, axis=0)
+            den[den == 0] = np.finfo(float).eps
+            P /= den
+            self.Pt1[block] = np.sum(P, axis=0)
+            self.P1 += np.sum(P, axis=1)
+            self.PX += np.dot(P, self.X[block])
         self.Np = np.sum(self.P1)
 
-        def updateTransform(self):
-            raise NotImplementedError()
+    def _weighted_moments(self):
+        """return the weighted means of X and Y and A = (P^T XX)^T YY"""
+        muX = np.divide(np.sum(self.PX, axis=0), self.Np)
+        muY = np.divide(np.dot(self.P1, self.Y), self.Np)
+        self.XX = self.X - np.tile(muX, (self.N, 1))
+        YY = self.Y - np.tile(muY, (self.M, 1))
+        self.A = np.dot(np.transpose(self.PX - np.outer(self.P1, muX)), YY)
+        return muX, muY, YY
 
-        def updateVariance(self):
-            raise NotImplementedError()
+    def updateTransform(self):
+        raise NotImplementedError()
+
+    def updateVariance(self):
+        raise NotImplementedError()
 
 
 class CPDsimilarity(CPDregistration):
@@ -1371,12 +2229,7 @@ class CPDsimilarity(CPDregistration):
         super(CPDsimilarity, self).__init__(*args, **kwargs)
 
     def updateTransform(self):
-        muX = np.divide(np.sum(np.dot(self.P, self.X), axis=0), self.Np)
-        muY = np.divide(np.sum(np.dot(np.transpose(self.P), self.Y), axis=0), self.Np)
-        self.XX = self.X - np.tile(muX, (self.N, 1))
-        YY = self.Y - np.tile(muY, (self.M, 1))
-        self.A = np.dot(np.transpose(self.XX), np.transpose(self.P))
-        self.A = np.dot(self.A, YY)
+        muX, muY, YY = self._weighted_moments()
         U, _, V = np.linalg.svd(self.A, full_matrices=True)
         C = np.ones((self.D,))
         C[self.D - 1] = np.linalg.det(np.dot(U, V))
@@ -1413,12 +2266,7 @@ class CPDrigid(CPDsimilarity):
         return M
 
     def updateTransform(self):
-        muX = np.divide(np.sum(np.dot(self.P, self.X), axis=0), self.Np)
-        muY = np.divide(np.sum(np.dot(np.transpose(self.P), self.Y), axis=0), self.Np)
-        self.XX = self.X - np.tile(muX, (self.N, 1))
-        YY = self.Y - np.tile(muY, (self.M, 1))
-        self.A = np.dot(np.transpose(self.XX), np.transpose(self.P))
-        self.A = np.dot(self.A, YY)
+        muX, muY, YY = self._weighted_moments()
         U, _, V = np.linalg.svd(self.A, full_matrices=True)
         C = np.ones((self.D,))
         C[self.D - 1] = np.linalg.det(np.dot(U, V))
@@ -1444,12 +2292,7 @@ class CPDaffine(CPDregistration):
         super(CPDaffine, self).__init__(*args, **kwargs)
 
     def updateTransform(self):
-        muX = np.divide(np.sum(np.dot(self.P, self.X), axis=0), self.Np)
-        muY = np.divide(np.sum(np.dot(np.transpose(self.P), self.Y), axis=0), self.Np)
-        self.XX = self.X - np.tile(muX, (self.N, 1))
-        YY = self.Y - np.tile(muY, (self.M, 1))
-        self.A = np.dot(np.transpose(self.XX), np.transpose(self.P))
-        self.A = np.dot(self.A, YY)
+        muX, muY, YY = self._weighted_moments()
         self.YPY = np.dot(np.transpose(YY), np.diag(self.P1))
         self.YPY = np.dot(self.YPY, YY)
         Rt = np.linalg.solve(np.transpose(self.YPY), np.transpose(self.A))
@@ -1484,3 +2327,199 @@ funcDict = {
     "cpd_affine": CPDaffine,
     "cpd_2step": cpd_2step,
 }
+
+
+def _synthetic_beads(n, shape=(40, 256, 256), sigma=(2.0, 1.3, 1.3), seed=0):
+    """volume with n gaussian beads on a noisy background, for benchmarks"""
+    rs = np.random.RandomState(seed)
+    im = np.full(shape, 100.0)
+    pad = np.ceil(np.array(sigma) * 3).astype(int)
+    centers = rs.uniform(pad, np.array(shape) - pad - 1, (n, 3))
+    for center in centers:
+        sl = tuple(slice(int(c) - p, int(c) + p + 1) for c, p in zip(center, pad))
+        grid = np.ogrid[sl]
+        im[sl] += 800 * np.exp(
+            -sum((g - c) ** 2 / (2 * s ** 2) for g, c, s in zip(grid, center, sigma))
+        )
+    return rs.poisson(im).astype("f"), centers
+
+
+if __name__ == "__main__":
+    import time
+
+    # benchmark point matching for increasing numbers of beads
+    rs = np.random.RandomState(0)
+    print("{:>8} {:>12} {:>12}".format("beads", "kdtree (s)", "brute (s)"))
+    for n in (100, 500, 1000, 5000, 10000, 50000):
+        # beads in a 1000 x 1000 x 100 volume, second channel slightly shifted
+        pc1 = rs.uniform(0, 1, (3, n)) * np.array([[1000], [1000], [100]])
+        pc2 = pc1 + rs.normal(0.5, 0.1, pc1.shape)
+        pc2 = pc2[:, rs.permutation(n)]
+        t0 = time.time()
+        get_matching_points(pc1, pc2)
+        tree = time.time() - t0
+        brute = "-"
+        if n <= 5000:
+            t0 = time.time()
+            _get_closest_points_brute(pc1, pc2)
+            brute = "{:.4f}".format(time.time() - t0)
+        print("{:>8} {:>12} {:>12}".format(n, "{:.4f}".format(tree), brute))
+
+    # benchmark automatic threshold detection against one label() per threshold
+    print("\n{:>12} {:>12} {:>12}".format("image", "sweep", "label loop"))
+    threshold_counts(np.zeros((2, 2)))  # jit compilation
+    for side in (256, 1024, 2048):
+        im, _ = _synthetic_beads(side, shape=(16, side, side))
+        mip = log_filter(im).max(0)
+        t0 = time.time()
+        thresh, counts = threshold_counts(mip)
+        tsweep = time.time() - t0
+        t0 = time.time()
+        expected = [ndimage.label(mip > t)[1] for t in thresh]
+        tloop = time.time() - t0
+        assert np.array_equal(counts, expected)
+        print(
+            "{:>12} {:>11.3f}s {:>11.3f}s".format(
+                "{0}x{0}".format(side), tsweep, tloop
+            )
+        )
+
+    # benchmark gaussian localization for increasing numbers of beads
+    print("\n{:>8} {:>12} {:>12} {:>14}".format("beads", "batch", "loop", "max diff"))
+    for n in (100, 500, 2000):
+        side = int(64 * np.sqrt(n / 10))
+        im, _ = _synthetic_beads(n, shape=(40, side, side))
+        filtered = log_filter(im)
+        labeled = ndimage.label(filtered > np.percentile(filtered, 99.5))[0]
+        objects = ndimage.find_objects(labeled)
+        fitter = GaussFitter3D(im, dx=0.1, dz=0.3)
+        t0 = time.time()
+        batch = fitter.fit_batch(objects)
+        tbatch = time.time() - t0
+        t0 = time.time()
+        loop = [fitter[o] for o in objects]
+        tloop = time.time() - t0
+
+        def inside(F):
+            xyz = np.array([F.x(0), F.y(0), F.z(0)])
+            inbounds = np.all((xyz > 0) & (xyz < im.shape[::-1]))
+            return F.success and F.A() > 0 and inbounds
+
+        # largest coordinate difference (pixels) between converged bead fits
+        diff = max(
+            np.abs(a.fitResults[1:4] - b.fitResults[1:4]).max() / fitter.dx
+            for a, b in zip(loop, batch)
+            if inside(a) and inside(b)
+        )
+        print(
+            "{:>8} {:>11.3f}s {:>11.3f}s {:>14.1e}".format(
+                len(objects), tbatch, tloop, diff
+            )
+        )
+
+    # benchmark localization tiers on beads with known positions
+    header = ("tier", "matched", "time", "rois/s", "rms (px)")
+    print("\n{:>10} {:>8} {:>10} {:>10} {:>10}".format(*header))
+    im, centers = _synthetic_beads(1000, shape=(40, 640, 640))
+    tree = cKDTree(centers[:, ::-1])
+    filtered = log_filter(im)
+    objects = ndimage.find_objects(ndimage.label(filtered > 5)[0])
+    fitter = GaussFitter3D(im, dx=0.1, dz=0.3)
+
+    def gauss3d(data, objects):
+        fits = fitter.fit_batch(objects)
+        return np.array([[F.x(0), F.y(0), F.z(0)] for F in fits])
+
+    for tier, func in (
+        ("centroid", localize_centroid),
+        ("gauss1d", localize_gauss1d),
+        ("gauss3d", gauss3d),
+    ):
+        t0 = time.time()
+        xyz = func(im, objects)
+        elapsed = time.time() - t0
+        dist = tree.query(xyz[np.all(np.isfinite(xyz), 1)])[0]
+        dist = dist[dist < 1]
+        print(
+            "{:>10} {:>8} {:>9.3f}s {:>10.0f} {:>10.3f}".format(
+                tier,
+                len(dist),
+                elapsed,
+                len(objects) / elapsed,
+                np.sqrt(np.mean(dist ** 2)),
+            )
+        )
+
+    # benchmark CPU filtering of a bead stack against the single-threaded filter
+    print("\n{:>16} {:>12} {:>12} {:>12}".format("filter", "threads", "scipy", "diff"))
+    im, centers = _synthetic_beads(1000, shape=(64, 1024, 1024))
+    for name, func, ref in (
+        ("log", log_filter, lambda x: -ndimage.gaussian_laplace(x, (2.5, 1, 1))),
+        (
+            "blur",
+            lambda x: blur_filter(x, 2, 5),
+            lambda x: ndimage.gaussian_filter(x, (5, 2, 2), mode="constant"),
+        ),
+    ):
+        t0 = time.time()
+        result = func(im)
+        tblocks = time.time() - t0
+        t0 = time.time()
+        expected = ref(im.astype("f"))
+        tscipy = time.time() - t0
+        if name == "log":
+            expected *= expected > 0
+        print(
+            "{:>16} {:>11.3f}s {:>11.3f}s {:>12.1e}".format(
+                "{} {}".format(name, im.shape),
+                tblocks,
+                tscipy,
+                np.abs(result - expected).max(),
+            )
+        )
+
+    # benchmark coarse-to-fine bead detection on the same stack
+    header = ("filter", "binning", "time", "matched", "rms")
+    print("\n{:>12} {:>8} {:>10} {:>8} {:>8}".format(*header))
+    tree = cKDTree(centers[:, ::-1])
+    for filtertype in ("log", "blur"):
+        for binning in (1, 2, 4):
+            t0 = time.time()
+            cloud = FiducialCloud(
+                im, dx=0.1, dz=0.3, filtertype=filtertype, binning=binning
+            )
+            elapsed = time.time() - t0
+            # localization error (pixels) of beads matched to the ground truth
+            dist = tree.query(cloud.coords.T)[0]
+            dist = dist[dist < 1]
+            print(
+                "{:>12} {:>8} {:>9.2f}s {:>8} {:>8.3f}".format(
+                    filtertype, binning, elapsed, len(dist), np.sqrt(np.mean(dist ** 2))
+                )
+            )
+
+    # benchmark robust transform estimation with mismatched pairs
+    header = ("points", "outliers", "time", "inliers", "msac error", "lstsq error")
+    print("\n{:>8} {:>9} {:>10} {:>9} {:>12} {:>12}".format(*header))
+    for n in (1000, 5000, 20000):
+        for fraction in (0.1, 0.3):
+            T = np.eye(4)
+            T[:3, :3] += rs.normal(0, 0.01, (3, 3))
+            T[:3, 3] = [0.4, -0.3, 0.2]
+            X = rs.uniform(0, 1, (3, n)) * np.array([[100], [100], [20]])
+            Y = affineXF(X, T) + rs.normal(0, 0.01, X.shape)
+            nout = int(fraction * n)
+            Y[:, :nout] += rs.uniform(-3, 3, (3, nout))
+            t0 = time.time()
+            tform, inliers = infer_robust(X, Y, "affine")
+            elapsed = time.time() - t0
+            print(
+                "{:>8} {:>9} {:>9.3f}s {:>9} {:>12.1e} {:>12.1e}".format(
+                    n,
+                    nout,
+                    elapsed,
+                    inliers.sum(),
+                    np.abs(tform - T).max(),
+                    np.abs(infer_affine(X, Y) - T).max(),
+                )
+            )
@@ -1,11 +1,253 @@
 import numpy as np
 from scipy.ndimage.interpolation import map_coordinates
 from .imref import imref3d
-from numba import njit
+from numba import njit, prange
 
 
-def imwarp(inputImage, tform, R_A=None, outputRef=None):
-    """ transform input image with provided tform matrix"""
+def imwarp(inputImage, tform, R_A=None, outputRef=None, out=None):
+    """ transform input image with provided tform matrix
+
+    Same result as :func:`imwarp_map_coordinates` (linear interpolation,
+    zero outside of the input), but interpolated in float32 on all cores.
+    Source coordinates are computed on the fly for each output row rather
+    than stored, so no volume-sized temporary arrays are created: memory use
+    is the input plus the output.  The output is a new float32 array, or
+    ``out`` (e.g. a np.memmap) if provided.
+
+    Note that, unlike :func:`imwarp_map_coordinates`, integer input is
+    returned as float32 rather than float64.  float32 represents 16-bit data
+    exactly; cast the result if float64 is required.
+
+    To apply the same transform to many volumes, create a :class:`WarpPlan`
+    once and call it on each volume.
+    """
+    return WarpPlan(tform, inputImage.shape, R_A, outputRef)(inputImage, out)
+
+
+class WarpPlan(object):
+    """Precomputed warp of volumes of one shape with one transform.
+
+    Everything that does not depend on the pixel values is done once: the
+    spatial referencing is reduced to a single index matrix (see
+    :func:`intrinsic_tform`), and the range of each output row that falls
+    inside the input is stored (two int32 per row).  Calling the plan on a
+    volume then only gathers and interpolates.
+
+    Args:
+        tform (np.ndarray): 4x4 transformation matrix (in world coordinates)
+        input_shape (tuple): (nz, ny, nx) shape of the volumes to warp
+        R_A (imref3d): spatial referencing of the input, by default
+            imref3d(input_shape)
+        outputRef (imref3d): spatial referencing of the output, by default R_A
+    """
+
+    def __init__(self, tform, input_shape, R_A=None, outputRef=None):
+        self.input_shape = tuple(int(i) for i in input_shape)
+        if R_A is None:
+            R_A = imref3d(self.input_shape)
+        if outputRef is None:
+            # see imwarp_map_coordinates
+            outputRef = R_A
+        self.R_A = R_A
+        self.outputRef = outputRef
+        self.tform = np.asarray(tform, dtype=np.float64)
+        self.output_shape = tuple(int(i) for i in outputRef.ImageSize)
+        self.matrix = intrinsic_tform(self.tform, R_A, outputRef)
+        self.spans = _row_spans(self.matrix, self.input_shape, self.output_shape)
+        self._inverse = np.linalg.inv(self.tform)
+
+    @classmethod
+    def from_matrix(cls, matrix, input_shape, output_shape):
+        """Create a plan directly from a 4x4 index matrix, mapping zero-based
+        (z, y, x, 1) output indices to input indices (see
+        :func:`intrinsic_tform`).  This allows several resampling steps to be
+        composed by matrix multiplication and applied at once.
+        """
+        plan = cls.__new__(cls)
+        plan.input_shape = tuple(int(i) for i in input_shape)
+        plan.output_shape = tuple(int(i) for i in output_shape)
+        plan.R_A = plan.outputRef = plan.tform = plan._inverse = None
+        plan.matrix = np.ascontiguousarray(matrix, dtype=np.float64)
+        plan.spans = _row_spans(plan.matrix, plan.input_shape, plan.output_shape)
+        return plan
+
+    def __call__(self, inputImage, out=None):
+        inputImage = np.asarray(inputImage)
+        if inputImage.shape != self.input_shape:
+            raise ValueError(
+                "WarpPlan expects input of shape {}, got {}".format(
+                    self.input_shape, inputImage.shape
+                )
+            )
+        if out is None:
+            out = np.empty(self.output_shape, dtype=np.float32)
+        elif tuple(out.shape) != self.output_shape:
+            raise ValueError(
+                "out must have shape {}, got {}".format(self.output_shape, out.shape)
+            )
+        _affine_resample(inputImage, self.matrix, self.spans, out)
+        return out
+
+    def inverse_points(self, x, y, z):
+        """same as transformPackedPointsInverse(tform, x, y, z), reusing the
+        inverted matrix"""
+        if self._inverse is None:
+            raise ValueError("WarpPlan created from an index matrix has no tform")
+        return _apply_tform(self._inverse, x, y, z)
+
+
+def intrinsic_tform(tform, R_A, outputRef):
+    """Return the 4x4 matrix mapping (z, y, x, 1) zero-based indices of the
+    output image to zero-based indices in the input image.
+
+    This composes the output spatial referencing, the inverse of tform, and
+    the input spatial referencing, which are all affine.
+    """
+    # evaluate the mapping on the origin and unit vectors (1-based intrinsic)
+    zi = np.array([1.0, 2.0, 1.0, 1.0])
+    yi = np.array([1.0, 1.0, 2.0, 1.0])
+    xi = np.array([1.0, 1.0, 1.0, 2.0])
+    xw, yw, zw = outputRef.intrinsicToWorld(xi, yi, zi)
+    xw, yw, zw = transformPoints(
+        np.asarray(tform, dtype=np.float64), xw, yw, zw, inverse=True
+    )
+    xs, ys, zs = R_A.worldToIntrinsic(xw, yw, zw)
+    src = np.array([zs, ys, xs]) - 1
+    M = np.eye(4)
+    M[:3, 3] = src[:, 0]
+    M[:3, :3] = src[:, 1:] - src[:, :1]
+    return M
+
+
+def projection_plan(tform, input_shape, R_A=None):
+    """WarpPlan for the Z maximum intensity projection of volumes of input_shape.
+
+    The projection of ``imwarp(volume, tform, R_A)`` is approximated by warping
+    the projection of the volume with the in-plane part of the transform,
+    evaluated at the central Z plane.  Shifts and scaling in Z are ignored, the
+    in-plane part is exact for transforms that do not couple Z into X and Y
+    (e.g. translation and '2step').  Call the plan on
+    ``projection[np.newaxis]``, the result has shape (1, ny, nx).
+    """
+    nz, ny, nx = input_shape
+    if R_A is None:
+        R_A = imref3d(input_shape)
+    M = intrinsic_tform(tform, R_A, R_A)
+    P = np.eye(4)
+    P[1:3, 1:3] = M[1:3, 1:3]
+    P[1:3, 3] = M[1:3, 3] + M[1:3, 0] * (nz - 1) / 2
+    return WarpPlan.from_matrix(P, (1, ny, nx), (1, ny, nx))
+
+
+@njit(nogil=True)
+def _row_start(M, k, j):
+    """source (z, y, x) coordinates of output voxel (k, j, 0)"""
+    z0 = M[0, 0] * k + M[0, 1] * j + M[0, 3]
+    y0 = M[1, 0] * k + M[1, 1] * j + M[1, 3]
+    x0 = M[2, 0] * k + M[2, 1] * j + M[2, 3]
+    return z0, y0, x0
+
+
+@njit(nogil=True)
+def _inside(M, z0, y0, x0, i, sz, sy, sx):
+    z = z0 + M[0, 2] * i
+    y = y0 + M[1, 2] * i
+    x = x0 + M[2, 2] * i
+    return 0 <= z <= sz - 1 and 0 <= y <= sy - 1 and 0 <= x <= sx - 1
+
+
+@njit(parallel=True, nogil=True)
+def _row_spans(M, input_shape, output_shape):
+    """[start, stop) of the output voxels of each row that map inside the input
+
+    Coordinates outside [0, n - 1] on any axis are outside of the input (as
+    for map_coordinates(order=1, mode='constant')).
+    """
+    sz, sy, sx = input_shape
+    nz, ny, nx = output_shape
+    size = np.array([sz, sy, sx], np.float64)
+    spans = np.zeros((nz, ny, 2), np.int32)
+    for k in prange(nz):
+        for j in range(ny):
+            c0 = _row_start(M, k, j)
+            # intersect the intervals in which each coordinate is inside
+            lo, hi = -1.0, float(nx)
+            for a in range(3):
+                d = M[a, 2]
+                if d == 0:
+                    if c0[a] < 0 or c0[a] > size[a] - 1:
+                        lo, hi = 1.0, 0.0
+                else:
+                    t1 = -c0[a] / d
+                    t2 = (size[a] - 1 - c0[a]) / d
+                    lo = max(lo, min(t1, t2))
+                    hi = min(hi, max(t1, t2))
+            if hi < lo:
+                continue
+            start = max(0, int(np.ceil(lo)))
+            stop = min(nx, int(np.floor(hi)) + 1)
+            # fix rounding at the boundaries with the exact test used for
+            # interpolation
+            z0, y0, x0 = c0
+            while start < stop and not _inside(M, z0, y0, x0, start, sz, sy, sx):
+                start += 1
+            while start > 0 and _inside(M, z0, y0, x0, start - 1, sz, sy, sx):
+                start -= 1
+            while stop > start and not _inside(M, z0, y0, x0, stop - 1, sz, sy, sx):
+                stop -= 1
+            while start < stop < nx and _inside(M, z0, y0, x0, stop, sz, sy, sx):
+                stop += 1
+            if start < stop:
+                spans[k, j, 0] = start
+                spans[k, j, 1] = stop
+    return spans
+
+
+@njit(parallel=True, nogil=True)
+def _affine_resample(src, M, spans, out):
+    """trilinear interpolation of src at M @ (z, y, x, 1) for each output voxel
+
+    Matches map_coordinates(order=1, mode='constant', cval=0).  Voxels
+    outside of the [start, stop) span of their row (see :func:`_row_spans`)
+    are set to 0.
+    """
+    nz, ny, nx = out.shape
+    sz, sy, sx = src.shape
+    for k in prange(nz):
+        for j in range(ny):
+            start, stop = spans[k, j, 0], spans[k, j, 1]
+            for i in range(start):
+                out[k, j, i] = 0
+            for i in range(stop, nx):
+                out[k, j, i] = 0
+            z0, y0, x0 = _row_start(M, k, j)
+            for i in range(start, stop):
+                z = z0 + M[0, 2] * i
+                y = y0 + M[1, 2] * i
+                x = x0 + M[2, 2] * i
+                iz, iy, ix = int(z), int(y), int(x)
+                # upper neighbors, clipped at the last plane/row/column
+                jz = min(iz + 1, sz - 1)
+                jy = min(iy + 1, sy - 1)
+                jx = min(ix + 1, sx - 1)
+                fz = np.float32(z - iz)
+                fy = np.float32(y - iy)
+                fx = np.float32(x - ix)
+                c00 = src[iz, iy, ix] * (1 - fx) + src[iz, iy, jx] * fx
+                c01 = src[iz, jy, ix] * (1 - fx) + src[iz, jy, jx] * fx
+                c10 = src[jz, iy, ix] * (1 - fx) + src[jz, iy, jx] * fx
+                c11 = src[jz, jy, ix] * (1 - fx) + src[jz, jy, jx] * fx
+                c0 = c00 * (1 - fy) + c01 * fy
+                c1 = c10 * (1 - fy) + c11 * fy
+                out[k, j, i] = c0 * (1 - fz) + c1 * fz
+
+
+def imwarp_map_coordinates(inputImage, tform, R_A=None, outputRef=None):
+    """ transform input image with provided tform matrix
+
+    Reference implementation of :func:`imwarp` using
+    scipy.ndimage.map_coordinates with full-volume float64 coordinates.
+    """
 
     # checkImageAgreementWithTform(inputImage,tform)
 
@@ -26,7 +268,7 @@ def imwarp(inputImage, tform, R_A=None, outputRef=None):
         # checkOutputViewAgreementWithTform(outputRef,tform)
 
     # Resampling the input image must be done in a floating point type.
-    if not np.issubdtype(inputImage.dtype, np.float):
+    if not np.issubdtype(inputImage.dtype, np.floating):
         inputImage = inputImage.astype(np.float64)
 
     # Form grid of intrinsic points in output image.
@@ -124,10 +366,14 @@ def transformPackedPointsInverse(tform, x, y, z):
     # make sure they are the same size
     if not tform.shape == (4, 4):
         raise ValueError("transformation expects a 4x4 tform matrix")
+    return _apply_tform(np.linalg.inv(tform), x, y, z)
+
+
+def _apply_tform(M, x, y, z):
+    """apply 4x4 matrix M to points, without building homogeneous coordinates"""
+    x, y, z = np.asarray(x), np.asarray(y), np.asarray(z)
     packed = np.array([x.ravel(), y.ravel(), z.ravel()])
-    ndim = ndim = packed.shape[0]
-    homo = np.vstack((packed, np.ones((1, packed.shape[1]))))
-    tformed_points = np.dot(np.linalg.inv(tform), homo)[:ndim, :]
+    tformed_points = np.dot(M[:3, :3], packed) + M[:3, 3:]
     xt = tformed_points[0].reshape(x.shape)
     yt = tformed_points[1].reshape(y.shape)
     zt = tformed_points[2].reshape(z.shape)
@@ -136,7 +382,7 @@ def transformPackedPointsInverse(tform, x, y, z):
 
 @njit
 def transformPoints(M, x, y, z, inverse=False):
-    if not len({A.shape for A in (x, y, z)}):
+    if x.shape != y.shape or x.shape != z.shape:
         raise ValueError("coordinate lists must all be the same size")
     if not M.shape == (4, 4):
         raise ValueError("transformation expects a 4x4 tform matrix")
@@ -146,3 +392,48 @@ def transformPoints(M, x, y, z, inverse=False):
     yt = M[1, 0] * x + M[1, 1] * y + M[1, 2] * z + M[1, 3]
     zt = M[2, 0] * x + M[2, 1] * y + M[2, 2] * z + M[2, 3]
     return xt, yt, zt
+
+
+if __name__ == "__main__":
+    # python -m fiducialreg.imwarp
+    # warp a 100-timepoint series with the same transform
+    import time
+
+    nt, shape = 100, (40, 256, 256)
+    rs = np.random.RandomState(0)
+    tform = np.eye(4)
+    tform[:3, :3] += rs.normal(0, 0.02, (3, 3))
+    tform[:3, 3] = [1.3, -2.2, 0.7]
+    R_A = imref3d(shape, 0.1, 0.1, 0.3)
+    outputRef = calculateOutputSpatialReferencing(R_A, tform)
+    volumes = [(rs.rand(*shape) * 1000).astype(np.uint16) for _ in range(4)]
+    imwarp(volumes[0][:2, :2, :2], tform)  # jit compilation
+
+    def run(label, func, n=nt):
+        t0 = time.time()
+        for t in range(n):
+            func(volumes[t % len(volumes)])
+        elapsed = (time.time() - t0) * nt / n
+        print("{:<28} {:>8.2f}s".format(label, elapsed))
+        return elapsed
+
+    print("{} timepoints of {}".format(nt, shape))
+    legacy = run(
+        "map_coordinates (est.)",
+        lambda v: imwarp_map_coordinates(
+            v, tform, R_A, calculateOutputSpatialReferencing(R_A, tform)
+        ),
+        n=5,
+    )
+    single = run(
+        "imwarp per timepoint",
+        lambda v: imwarp(v, tform, R_A, calculateOutputSpatialReferencing(R_A, tform)),
+    )
+    plan = WarpPlan(tform, shape, R_A, outputRef)
+    out = np.empty(plan.output_shape, np.float32)
+    planned = run("WarpPlan, reused output", lambda v: plan(v, out=out))
+    print(
+        "plan speedup: {:.1f}x vs imwarp, {:.0f}x vs map_coordinates".format(
+            single / planned, legacy / planned
+        )
+    )
@@ -179,9 +179,11 @@ def sub_background(im, background=None):
     if background is None:
         background = detect_background(im)
     dtype = im.dtype
-    out = im.astype(np.float) - background
+    # float32 is exact for 16-bit data and keeps the working copy small
+    out = im.astype(np.promote_types(dtype, np.float32))
+    out -= background
     out[out < 0] = 0
-    return out.astype(dtype)
+    return out.astype(dtype, copy=False)
 
 
 def deskew_gputools(rawdata, dz=0.5, dx=0.102, angle=31.5, filler=0):
@@ -1,10 +1,15 @@
 from . import util
-from . import llsdir
+from .camera import CameraROI, roi_slices
+from .settingstxt import parse_settings
 import numpy as np
 import os
 import glob
+import time
+import shutil
+import hashlib
+import threading
 import tifffile as tf
-import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 from scipy.optimize import least_squares
 from numba import jit
 import warnings
@@ -13,6 +18,33 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+def tiff_shape(path):
+    """Return the shape of the first series in a tiff, reading only headers"""
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        with tf.TiffFile(path) as t:
+            return tuple(t.series[0].shape)
+
+
+def read_tile(path, yslice=slice(None), xslice=slice(None)):
+    """Read a YX tile from every plane of a 3D tiff as a (nz, ny, nx) array.
+
+    Uncompressed files are memory-mapped, so only the requested tile is
+    read from disk.  Otherwise, pages are decoded one at a time and cropped,
+    so memory use is bounded by one page plus the tile.
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        try:
+            data = tf.memmap(path, mode="r")
+            tile = np.array(data[..., yslice, xslice])
+            del data
+        except ValueError:
+            with tf.TiffFile(path) as t:
+                tile = np.stack([p.asarray()[yslice, xslice] for p in t.pages])
+    return tile.reshape((-1,) + tile.shape[-2:])
+
+
 def get_channel_list(folder):
     """Generate list of all ch0 and ch1 tiffs in a given folder, with error checking
 
@@ -28,7 +60,7 @@ def get_channel_list(folder):
         ch1list
     ), "The number of stacks in ch0 and ch1 must be the same"
 
-    shapes = [tf.TiffFile(f).series[0].shape for f in (ch0list + ch1list)]
+    shapes = [tiff_shape(f) for f in (ch0list + ch1list)]
     assert (
         len(set(shapes)) == 1
     ), "All stacks must have the same number of pixels and planes"
@@ -36,20 +68,191 @@ def get_channel_list(folder):
     return ch0list, ch1list
 
 
+def calibration_roi(folder):
+    """Return the camera ROI used to acquire the calibration images in folder"""
+    roi = (parse_settings(folder).get("camera") or {}).get("roi")
+    if roi is None:
+        raise ValueError(
+            "Could not read the camera ROI from a Settings.txt file in: {}".format(
+                folder
+            )
+        )
+    return CameraROI(roi)
+
+
+def roi_tile(path, roi=None, fullroi=None):
+    """Return the (yslice, xslice) of the images in path that hold camera ROI roi.
+
+    fullroi is the camera ROI the images were acquired with (by default, read
+    from the Settings.txt file in the same folder).  With roi=None, the slices
+    span the whole image.
+    """
+    ny, nx = tiff_shape(path)[-2:]
+    if roi is None:
+        return slice(0, ny), slice(0, nx)
+    if fullroi is None:
+        fullroi = calibration_roi(os.path.dirname(path))
+    fullroi = CameraROI(fullroi)
+    if (fullroi.width, fullroi.height) != (ny, nx):
+        raise ValueError(
+            "{} does not match the shape of the images: {}".format(fullroi, (ny, nx))
+        )
+    return roi_slices(fullroi, roi, (ny, nx))
+
+
+def crop_to_tile(im, yslice, xslice):
+    """crop a full-chip (dark) image to a tile, passing tile-sized images through"""
+    shape = (yslice.stop - yslice.start, xslice.stop - xslice.start)
+    if im.shape[-2:] == shape:
+        return im
+    return im[..., yslice, xslice]
+
+
+def _read_series(files, darkavg, yslice=slice(None), xslice=slice(None)):
+    """concatenate a tile of every file into one dark-subtracted float32 stack
+
+    darkavg must have the shape of the tile.
+    """
+    nz, ny, nx = tiff_shape(files[0])
+    ny = len(range(ny)[yslice])
+    nx = len(range(nx)[xslice])
+    out = np.empty((nz * len(files), ny, nx), dtype=np.float32)
+    for n, f in enumerate(files):
+        out[n * nz : n * nz + nz] = read_tile(f, yslice, xslice)
+    out -= np.asarray(darkavg, dtype=np.float32)
+    return out
+
+
 def combine_stacks(ch0, ch1, darkavg):
-    """Read tifs into two large stacks ...
+    """Read tifs into two large (float32) stacks.
 
-    #TODO: see if we do this sequentially to minimize the amount of RAM required
+    Use :func:`iter_bright_tiles` to avoid holding the full series in memory.
     """
-    shp = list(tf.TiffFile(ch0[0]).series[0].shape)
-    nZ = shp[0]
-    shp[0] *= len(ch0)
-    pre = np.zeros(shp, dtype=np.float)
-    post = np.zeros(shp, dtype=np.float)
-    for n in range(len(ch0)):
-        pre[n * nZ : n * nZ + nZ, :, :] = tf.imread(ch0[n]).astype(np.float) - darkavg
-        post[n * nZ : n * nZ + nZ, :, :] = tf.imread(ch1[n]).astype(np.float) - darkavg
-    return pre, post
+    return _read_series(ch0, darkavg), _read_series(ch1, darkavg)
+
+
+def bright_tile_slices(ch0, tile_rows=None, max_bytes=2 ** 28, shape=None):
+    """Return the list of row slices used to split the bright series in bands.
+
+    By default, tile_rows is chosen so that the pre and post arrays of one
+    band together occupy at most ``max_bytes``.  ``shape`` is the YX shape of
+    the region being calibrated (default: the whole image).
+    """
+    nz, ny, nx = tiff_shape(ch0[0])
+    if shape is not None:
+        ny, nx = shape
+    if tile_rows is None:
+        tile_rows = max(1, int(max_bytes // (2 * 4 * nz * len(ch0) * nx)))
+    return [slice(y, min(y + tile_rows, ny)) for y in range(0, ny, tile_rows)]
+
+
+def iter_bright_tiles(ch0, ch1, darkavg, tile_rows=None, max_bytes=2 ** 28):
+    """Iterate over the bright series in bands of rows.
+
+    Yields:
+        tuple: (yslice, pre, post), where pre and post are dark-subtracted
+        float32 arrays of shape (nz * len(ch0), rows, nx) for the rows in
+        yslice.  Peak memory is proportional to the tile (see
+        :func:`bright_tile_slices`), not to the whole series.
+    """
+    for yslice in bright_tile_slices(ch0, tile_rows, max_bytes):
+        yield (
+            yslice,
+            _read_series(ch0, darkavg[yslice], yslice),
+            _read_series(ch1, darkavg[yslice], yslice),
+        )
+
+
+class ThrottledCallback(object):
+    """Wrap a progress callback so that it is called at most once per interval.
+
+    Calls are accumulated and the underlying callback receives the total
+    count since it was last called, so the number of (e.g. Qt signal) emissions
+    is bounded by the run time, regardless of chip size.  Call :meth:`flush` at
+    the end to report any remaining count.
+    """
+
+    def __init__(self, callback, interval=0.2):
+        self.callback = callback
+        self.interval = interval
+        self._pending = 0
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def __call__(self, n=1):
+        with self._lock:
+            self._pending += n
+            if time.time() - self._last < self.interval:
+                return
+            n, self._pending = self._pending, 0
+            self._last = time.time()
+        self.callback(n)
+
+    def flush(self):
+        with self._lock:
+            n, self._pending = self._pending, 0
+        if n:
+            self.callback(n)
+
+
+class TileCheckpoint(object):
+    """Persist finished calibration tiles, so an interrupted job can resume.
+
+    Each finished tile is saved as an .npy file in ``directory``.  A key
+    describing the job (input files, dark image and tiling) is stored along
+    with them; tiles from a job with a different key are discarded.
+    """
+
+    def __init__(self, directory, key):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        keyfile = os.path.join(directory, "job.key")
+        if os.path.isfile(keyfile):
+            with open(keyfile) as f:
+                if f.read() != key:
+                    logger.info("Discarding checkpoint of a different calibration")
+                    self.clear()
+                    os.makedirs(directory, exist_ok=True)
+        with open(keyfile, "w") as f:
+            f.write(key)
+
+    @staticmethod
+    def job_key(files, darkavg, slices):
+        sha = hashlib.sha1()
+        for f in files:
+            stat = os.stat(f)
+            sha.update(
+                "{}|{}|{}".format(os.path.basename(f), stat.st_size, stat.st_mtime_ns)
+                .encode()
+            )
+        sha.update(np.ascontiguousarray(darkavg, dtype=np.float32).tobytes())
+        sha.update(str([(s.start, s.stop) for s in slices]).encode())
+        return sha.hexdigest()
+
+    def _path(self, yslice):
+        return os.path.join(
+            self.directory, "tile_{:05d}-{:05d}.npy".format(yslice.start, yslice.stop)
+        )
+
+    def load(self, yslice):
+        """return the saved result for yslice, or None if not finished"""
+        path = self._path(yslice)
+        if os.path.isfile(path):
+            try:
+                return np.load(path)
+            except Exception:
+                logger.warning("Ignoring unreadable checkpoint tile: %s", path)
+        return None
+
+    def save(self, yslice, result):
+        path = self._path(yslice)
+        tmpfile = path + ".tmp"
+        with open(tmpfile, "wb") as f:
+            np.save(f, result)
+        os.replace(tmpfile, path)
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
 
 
 @jit(nopython=True, nogil=True)
@@ -58,83 +261,212 @@ def fun(p, x, y):
     return p[0] * (1 - np.exp(-p[1] * x)) - y
 
 
+P0 = (100, 0.0019)  # starting guess
+BOUNDS = ([0, 0], [800, 0.01])  # min and max bounds
+
+
 def fitstickypixel(xdata, ydata, i, j):
-    """ fit data to curve, return optimal parameters from function """
-    p0 = np.array([100, 0.0019])  # starting guess
-    bounds = ([0, 0], [800, 0.01])  # min and max bounds
-    res = least_squares(fun, p0, args=(xdata, ydata), bounds=bounds)
+    """ fit data to curve, return optimal parameters from function
+
+    single-pixel reference fit.  See :func:`fit_block` for the batched version
+    """
+    p0 = np.array(P0)
+    res = least_squares(fun, p0, args=(xdata, ydata), bounds=BOUNDS)
     return res.x, i, j
 
 
-def splat_fit(args):
-    # helper function to unwarp arguments to fitter
-    return fitstickypixel(*args)
+def fit_block(xdata, ydata, ngrid=64, maxiter=50, tol=1e-10):
+    """fit the exponential association curve to many pixels at once.
 
+    Fits ``ydata = a * (1 - exp(-b * xdata))`` independently for every column
+    of the (nobservations, npixels) arrays ``xdata`` and ``ydata``, minimizing
+    the same sum of squares (with the same bounds) as :func:`fitstickypixel`.
 
-def parallel_fit(xdata, ydata, callback=None):
+    For a fixed ``b`` the optimal ``a`` is closed form, so ``b`` is first
+    chosen from a grid of ``ngrid`` values.  The estimate is then refined
+    with a vectorised, bounded Levenberg-Marquardt iteration.
+
+    Returns:
+        np.ndarray: (2, npixels) array of [a, b]
+    """
+    x = np.asarray(xdata, dtype=np.float64)
+    y = np.asarray(ydata, dtype=np.float64)
+    (amin, bmin), (amax, bmax) = BOUNDS
+
+    def cost(a, b):
+        return np.square(a * -np.expm1(-b * x) - y).sum(0)
+
+    # coarse search over b, with closed-form a
+    npix = x.shape[1]
+    a = np.full(npix, P0[0], dtype=np.float64)
+    b = np.full(npix, P0[1], dtype=np.float64)
+    best = cost(a, b)
+    for bb in np.linspace(bmax / ngrid, bmax, ngrid):
+        g = -np.expm1(-bb * x)
+        gg = np.square(g).sum(0)
+        aa = np.clip((g * y).sum(0) / np.where(gg > 0, gg, 1), amin, amax)
+        c = np.square(aa * g - y).sum(0)
+        better = c < best
+        a[better] = aa[better]
+        b[better] = bb
+        best[better] = c[better]
+
+    # refine with Levenberg-Marquardt, clipping steps to the bounds
+    lam = np.full(npix, 1e-3)
+    for _ in range(maxiter):
+        e = np.exp(-b * x)
+        r = a * (1 - e) - y
+        ja = 1 - e
+        jb = a * x * e
+        haa = np.square(ja).sum(0) * (1 + lam)
+        hbb = np.square(jb).sum(0) * (1 + lam)
+        hab = (ja * jb).sum(0)
+        ga = (ja * r).sum(0)
+        gb = (jb * r).sum(0)
+        det = haa * hbb - hab * hab
+        det[det == 0] = np.inf
+        na = np.clip(a - (hbb * ga - hab * gb) / det, amin, amax)
+        nb = np.clip(b - (haa * gb - hab * ga) / det, bmin, bmax)
+        c = cost(na, nb)
+        better = c < best
+        improvement = np.where(better, best - c, 0)
+        a[better] = na[better]
+        b[better] = nb[better]
+        best[better] = c[better]
+        lam = np.where(better, lam / 10, lam * 10)
+        if np.all(improvement <= tol * np.maximum(best, 1)):
+            break
+    return np.stack((a, b))
+
+
+def parallel_fit(xdata, ydata, callback=None, blocksize=None, workers=None):
     """ parallelize fitting and return 3D numpy array where...
 
     first plane = paramater a = plateau of exponential association
     second plane = parameter b = rate of exponential association
-    """
-    pool = multiprocessing.Pool()
-    M = xdata.shape[1]
-    N = xdata.shape[2]
-    imap_iter = pool.imap(
-        splat_fit,
-        ((xdata[:, i, j], ydata[:, i, j], i, j) for i in range(M) for j in range(N)),
-        chunksize=8,
-    )
 
-    out = np.zeros((2, M, N), dtype=np.float32)
-    for i in imap_iter:
-        out[:2, i[1], i[2]] = i[0]
-        if callback is not None:
-            callback(1)
-        # print("result: {}, I: {}, J: {}".format(*i))
-    return out
+    Pixels are fit in blocks of ``blocksize`` pixels (by default, sized so that
+    each block holds about 2 million observations) with :func:`fit_block`,
+    distributed across ``workers`` threads.  If provided, callback is called
+    with the number of pixels fit after each block.
+    """
+    nobs, M, N = xdata.shape
+    X = xdata.reshape(nobs, M * N)
+    Y = ydata.reshape(nobs, M * N)
+    if blocksize is None:
+        blocksize = max(1, 2 ** 21 // nobs)
+    blocks = [slice(i, min(i + blocksize, M * N)) for i in range(0, M * N, blocksize)]
 
+    out = np.zeros((2, M * N), dtype=np.float32)
 
-def process_dark_images(folder, callback=None, callback2=None):
-    darklist = sorted(glob.glob(os.path.join(folder, "*dark*.tif")))
+    def work(sl):
+        out[:, sl] = fit_block(X[:, sl], Y[:, sl])
+        return sl.stop - sl.start
 
-    # TODO: are these two loops necessary? seems like it should
-    # be possible in a single loop
+    with ThreadPoolExecutor(workers) as executor:
+        for npix in executor.map(work, blocks):
+            if callback is not None:
+                callback(npix)
+    return out.reshape(2, M, N)
 
-    # first  verify size/shape of everything
-    shapes = np.zeros((len(darklist), 3))
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        for i, d in enumerate(darklist):
-            with tf.TiffFile(d) as t:
-                shapes[i, :] = t.series[0].shape
-                if callback is not None:
-                    callback(1)
 
-    if len(set(shapes[:, 1])) + len(set(shapes[:, 2])) > 2:
+@jit(nopython=True, nogil=True)
+def _welford_update(stack, count, mean, m2):
+    """update running per-pixel mean and sum of squared deviations in place"""
+    for i in range(stack.shape[0]):
+        count += 1
+        for j in range(stack.shape[1]):
+            for k in range(stack.shape[2]):
+                x = stack[i, j, k]
+                delta = x - mean[j, k]
+                mean[j, k] += delta / count
+                m2[j, k] += delta * (x - mean[j, k])
+    return count
+
+
+def _accumulate_dark(
+    files, callback=None, yslice=slice(None), xslice=slice(None), cancel=None
+):
+    """read each file once, returning (count, mean, m2) for all planes"""
+    count, mean, m2, shape = 0, None, None, None
+    for d in files:
+        if cancel is not None and cancel.is_set():
+            break
+        data = read_tile(d, yslice, xslice)
+        if mean is None:
+            shape = data.shape[-2:]
+            mean = np.zeros(shape, dtype=np.float64)
+            m2 = np.zeros(shape, dtype=np.float64)
+        elif data.shape[-2:] != shape:
+            raise ValueError("All images must have same XY shape")
+        count = _welford_update(data, count, mean, m2)
+        if callback is not None:
+            callback(1)
+    return count, mean, m2
+
+
+def _merge_stats(a, b):
+    """combine two (count, mean, m2) partial results (Chan et al.)"""
+    na, mean_a, m2a = a
+    nb, mean_b, m2b = b
+    if not na:
+        return b
+    if not nb:
+        return a
+    if mean_a.shape != mean_b.shape:
         raise ValueError("All images must have same XY shape")
-
-    darkstack = np.zeros(
-        (int(shapes[:, 0].sum()), int(shapes[0, 1]), int(shapes[0, 2])), dtype=np.uint16
-    )
-
-    # then load the data
-    plane = 0
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        for d in darklist:
-            t = tf.imread(d)
-            nz = t.shape[0]
-            darkstack[plane : plane + nz, :, :] = t
-            plane += nz
-            if callback is not None:
-                callback(1)
-
-    # nZ = shp[0]
-    # shp[0] *= len(darklist)
-    # darkstack = tf.imread(darklist[0])
-    # for n in range(1, len(darklist)):
-    #   darkstack = np.vstack((darkstack, tf.imread(darklist[n])))
+    n = na + nb
+    delta = mean_b - mean_a
+    mean = mean_a + delta * (nb / n)
+    m2 = m2a + m2b + delta ** 2 * (na * nb / n)
+    return n, mean, m2
+
+
+def process_dark_images(
+    folder,
+    callback=None,
+    callback2=None,
+    workers=1,
+    roi=None,
+    fullroi=None,
+    cancel=None,
+):
+    """calculate the per-pixel mean (offset) and standard deviation (noise)
+    of all *dark*.tif images in folder.
+
+    If roi is given, only the pixels of that camera ROI are read and
+    accumulated (see :func:`roi_tile`).
+
+    Each file is read exactly once, and running statistics are accumulated
+    with Welford's algorithm, so memory use is bounded by the size of a single
+    file (plus two float64 planes per reader) regardless of the number of dark
+    images.  Files may be split across several reader threads (``workers``),
+    whose partial results are merged at the end.
+
+    callback is called with 1 after each file is read.
+
+    cancel may be a :class:`threading.Event`; it is checked between files,
+    and once set, the function returns (None, None).
+    """
+    darklist = sorted(glob.glob(os.path.join(folder, "*dark*.tif")))
+    if not darklist:
+        raise IOError("No dark images found in folder: {}".format(folder))
+    yslice, xslice = roi_tile(darklist[0], roi, fullroi)
+
+    workers = max(1, min(workers, len(darklist)))
+    chunks = [darklist[i::workers] for i in range(workers)]
+    with ThreadPoolExecutor(workers) as executor:
+        partials = list(
+            executor.map(
+                lambda files: _accumulate_dark(
+                    files, callback, yslice, xslice, cancel
+                ),
+                chunks,
+            )
+        )
+    if cancel is not None and cancel.is_set():
+        logger.info("Camera Calibration - cancelled")
+        return (None, None)
 
     if callback2 is not None:
         try:
@@ -143,7 +475,9 @@ def process_dark_images(folder, callback=None, callback2=None):
             pass
 
     logger.info("Camera Calibration - Calculating offset map...")
-    darkavg = darkstack.mean(0)
+    count, darkavg, m2 = partials[0]
+    for partial in partials[1:]:
+        count, darkavg, m2 = _merge_stats((count, darkavg, m2), partial)
 
     if callback2 is not None:
         try:
@@ -152,43 +486,170 @@ def process_dark_images(folder, callback=None, callback2=None):
             pass
 
     logger.info("Camera Calibration - Calculating noise map...")
-    darkstd = darkstack.std(0)
+    darkstd = np.sqrt(m2 / count)
     return darkavg, darkstd
 
 
-def process_bright_images(folder, darkavg, darkstd, callback=None, save=True):
-
+def process_bright_images(
+    folder,
+    darkavg,
+    darkstd,
+    callback=None,
+    save=True,
+    tile_rows=None,
+    checkpoint_dir=None,
+    roi=None,
+    fullroi=None,
+    cancel=None,
+):
+    """Fit the charge carry-over parameters for every pixel.
+
+    The chip is processed in bands of rows (see :func:`bright_tile_slices`).
+    Each finished band is saved to ``checkpoint_dir`` (by default a
+    ``camcalib_checkpoint`` subfolder of ``folder``, with one ``roi_<roi>``
+    subfolder per ROI), so that a cancelled or crashed calibration resumes
+    from the last finished band when called again.  The checkpoint is deleted
+    once calibration completes.
+
+    If roi is given, only the pixels of that camera ROI are read and fit,
+    and the saved parameter file is labeled with roi, so that it can be used
+    directly by :class:`~mosaicpy.camera.CameraParameters` for data acquired
+    with roi (or any ROI it contains).  darkavg and darkstd may be either
+    full-chip or already cropped to roi.
+
+    callback is called with the number of pixels finished, at most five
+    times per second.
+
+    cancel may be a :class:`threading.Event`; it is checked between bands,
+    and once set, the function returns (None, None) leaving the checkpoint
+    of the finished bands in place.
+    """
     ch0list, ch1list = get_channel_list(folder)
-    pre, post = combine_stacks(ch0list, ch1list, darkavg)
-
-    results = parallel_fit(pre, post, callback)
+    ry, rx = roi_tile(ch0list[0], roi, fullroi)
+    ny, nx = ry.stop - ry.start, rx.stop - rx.start
+    darkavg = crop_to_tile(darkavg, ry, rx)
+    darkstd = crop_to_tile(darkstd, ry, rx)
+    slices = bright_tile_slices(ch0list, tile_rows, shape=(ny, nx))
+    if checkpoint_dir is None:
+        checkpoint_dir = os.path.join(folder, "camcalib_checkpoint")
+        if roi is not None:
+            # ROIs of one folder must not discard each other's checkpoints
+            checkpoint_dir = os.path.join(checkpoint_dir, "roi_" + _roi_label(roi))
+    checkpoint = TileCheckpoint(
+        checkpoint_dir,
+        TileCheckpoint.job_key(ch0list + ch1list, darkavg, slices + [ry, rx]),
+    )
+    progress = ThrottledCallback(callback) if callback is not None else None
+
+    results = np.zeros((2, ny, nx), dtype=np.float32)
+    for yslice in slices:
+        if cancel is not None and cancel.is_set():
+            logger.info("Camera Calibration - cancelled, checkpoint kept")
+            return (None, None)
+        tile = checkpoint.load(yslice)
+        if tile is not None:
+            logger.debug("Resuming: rows {} already fit".format(yslice))
+            if progress is not None:
+                progress(tile[0].size)
+        else:
+            rows = slice(ry.start + yslice.start, ry.start + yslice.stop)
+            pre = _read_series(ch0list, darkavg[yslice], rows, rx)
+            post = _read_series(ch1list, darkavg[yslice], rows, rx)
+            tile = parallel_fit(pre, post, progress)
+            del pre, post
+            checkpoint.save(yslice, tile)
+        results[:, yslice] = tile
+    if progress is not None:
+        progress.flush()
     results = np.vstack((results, darkavg[None, :, :], darkstd[None, :, :]))
     results = util.reorderstack(results, "zyx").astype(np.float32)
 
     if save:
-        try:
-            E = llsdir.LLSdir(folder, ditch_partial=False)
-            outname = "FlashParam_sn{}_roi{}_date{}.tif".format(
-                E.settings.camera.serial,
-                "-".join([str(i) for i in E.settings.camera.roi]),
-                E.date.strftime("%Y%m%d"),
-            )
-        except Exception:
-            from datetime import datetime
-
-            outname = "FlashParam_roi{}_date{}.tif".format(
-                "-".join([0] * 4), datetime.now().strftime("%Y%m%d")
-            )
-
+        from datetime import datetime
+
+        settings = parse_settings(folder)
+        camera = settings.get("camera") or {}
+        if roi is None:
+            roi = camera.get("roi")
+        dx = (settings.get("params") or {}).get("dx") or 1
+        outname = "FlashParam{}_roi{}_date{}.tif".format(
+            "_sn{}".format(camera["serial"]) if camera.get("serial") else "",
+            _roi_label(roi) if roi is not None else "0-0-0-0",
+            (settings.get("date") or datetime.now()).strftime("%Y%m%d"),
+        )
+        outpath = os.path.join(folder, outname)
         tf.imsave(
-            os.path.join(folder, outname),
+            outpath,
             results,
             imagej=True,
-            resolution=(1 / E.parameters.dx, 1 / E.parameters.dx),
+            resolution=(1 / dx, 1 / dx),
             metadata={"unit": "micron", "hyperstack": "true", "mode": "composite"},
         )
+    else:
+        outpath = None
 
-    return (os.path.join(folder, outname), results)
+    checkpoint.clear()
+    try:
+        # remove the parent of per-ROI checkpoints once it is empty
+        os.rmdir(os.path.dirname(checkpoint.directory))
+    except OSError:
+        pass
+    return (outpath, results)
+
+
+def _roi_label(roi):
+    return "-".join(str(int(i)) for i in roi)
+
+
+def find_calibration(folder, roi):
+    """Return the path of a FlashParam file for roi in folder, or None."""
+    pattern = "FlashParam*_roi{}_date*.tif".format(_roi_label(roi))
+    found = sorted(glob.glob(os.path.join(folder, pattern)))
+    return found[-1] if found else None
+
+
+def process_rois(folder, rois, callback=None, workers=1, **kwargs):
+    """Calibrate each of several camera ROIs from the same calibration folder.
+
+    Only the pixels inside each ROI are read and fit.  ROIs that already have
+    a FlashParam file in folder are skipped, and each ROI is checkpointed
+    separately, so an interrupted run resumes where it stopped.  Additional
+    keyword arguments (e.g. cancel) are passed to
+    :func:`process_bright_images`.
+
+    Returns:
+        list: (outpath, results) for each ROI processed; results is None for
+        ROIs that were already calibrated.  If cancelled, the list ends with
+        (None, None).
+    """
+    output = []
+    cancel = kwargs.get("cancel")
+    for roi in rois:
+        if kwargs.get("save", True):
+            outpath = find_calibration(folder, roi)
+            if outpath is not None:
+                logger.info("Camera Calibration - ROI {} done".format(CameraROI(roi)))
+                output.append((outpath, None))
+                continue
+        logger.info("Camera Calibration - ROI {}".format(CameraROI(roi)))
+        darkavg, darkstd = process_dark_images(
+            folder,
+            workers=workers,
+            roi=roi,
+            fullroi=kwargs.get("fullroi"),
+            cancel=cancel,
+        )
+        if darkavg is None:
+            output.append((None, None))
+            break
+        output.append(
+            process_bright_images(
+                folder, darkavg, darkstd, callback=callback, roi=roi, **kwargs
+            )
+        )
+        if output[-1][1] is None:
+            break
+    return output
 
 
 if __name__ == "__main__":
@@ -1,22 +1,24 @@
 from . import libcudawrapper as libcu
-from .util import imread
+from .util import imread, get_cache_dir
 from . import arrayfun
 from scipy.ndimage.filters import median_filter
 
 import os
 import re
+import hashlib
 import warnings
 import numpy as np
-from numba import jit
+from numba import jit, prange
 import math
+import time
 import logging
 
 logger = logging.getLogger(__name__)
 
 
-# #THIS ONE WORKS BEST SO FAR
 @jit(nopython=True, nogil=True)
-def calc_correction(stack, a, b, offset):
+def _calc_correction_serial(stack, a, b, offset):
+    """reference (single-threaded, float64) implementation of calc_correction"""
     res = np.empty_like(stack)
     for i in range(stack.shape[0]):
         for j in range(stack.shape[1]):
@@ -33,33 +35,163 @@ def calc_correction(stack, a, b, offset):
     return res
 
 
-def selectiveMedianFilter(stack, background, median_range=3, with_mean=False):
+@jit(nopython=True, nogil=True, parallel=True)
+def _calc_correction_parallel(stack, a, b, offset, out, dampening):
+    nz, ny, nx = stack.shape
+    damp = np.float32(dampening)
+    for j in prange(ny):
+        # the raw (offset-subtracted) value of the previous plane is kept in a
+        # row buffer so that ``out`` may be the same array as ``stack``
+        prev = np.empty(nx, dtype=np.float32)
+        for k in range(nx):
+            d = np.float32(stack[0, j, k]) - offset[j, k]
+            prev[k] = d
+            out[0, j, k] = d if d > 0 else 0
+        for i in range(1, nz):
+            for k in range(nx):
+                raw = np.float32(stack[i, j, k]) - offset[j, k]
+                cor = (np.float32(1) - np.exp(-b[j, k] * prev[k])) * a[j, k]
+                d = raw - damp * cor
+                prev[k] = raw
+                out[i, j, k] = d if d > 0 else 0
+    return out
+
+
+def calc_correction(stack, a, b, offset, out=None, dampening=0.88):
+    """Correct the Flash4.0 charge carry-over ("sticky pixel") artifact.
+
+    Multithreaded over image rows and computed in float32.  Each plane is
+    corrected by the residual charge predicted from the previous raw plane::
+
+        res[i] = (stack[i] - offset
+                  - dampening * a * (1 - exp(-b * (stack[i-1] - offset))))
+
+    Args:
+        stack (np.ndarray): 3D (interleaved) ZYX stack to correct
+        a, b, offset (np.ndarray): 2D camera parameter planes, same YX shape as stack
+        out (np.ndarray, optional): array to write the result into.  May be
+            ``stack`` itself to correct in place.  Defaults to a new array with
+            the same shape and dtype as ``stack``.
+        dampening (float): scale factor applied to the correction
+
+    Returns:
+        np.ndarray: the corrected stack (``out``)
+    """
+    if stack.ndim != 3:
+        raise ValueError("calc_correction expects a 3D stack")
+    if out is None:
+        out = np.empty_like(stack)
+    elif out.shape != stack.shape:
+        raise ValueError("out array must have the same shape as stack")
+    a, b, offset = (np.ascontiguousarray(p, dtype=np.float32) for p in (a, b, offset))
+    return _calc_correction_parallel(stack, a, b, offset, out, dampening)
+
+
+@jit(nopython=True, nogil=True, parallel=True)
+def _median_filter_planes(stack, mask, size, out):
+    nz, ny, nx = stack.shape
+    r = size // 2
+    n = size * size
+    # parallelize over every row of every plane, so that single planes
+    # (e.g. projections) are also spread across threads
+    for zj in prange(nz * ny):
+        z = zj // ny
+        j = zj % ny
+        buf = np.empty(n, dtype=stack.dtype)
+        for k in range(nx):
+            # edge pixels and pixels outside of the mask are left unchanged
+            if not mask[j, k] or j < r or k < r or j >= ny - r or k >= nx - r:
+                out[z, j, k] = stack[z, j, k]
+                continue
+            m = 0
+            for dj in range(-r, r + 1):
+                for dk in range(-r, r + 1):
+                    buf[m] = stack[z, j + dj, k + dk]
+                    m += 1
+            buf.sort()
+            out[z, j, k] = buf[n // 2]
+    return out
+
+
+def median_filter_cpu(stack, size=3, mask=None):
+    """Multithreaded 2D median filter of every plane in a 2D or 3D array.
+
+    Like the OpenCL kernel in :mod:`mosaicpy.gpumedfilt`, pixels closer than
+    ``size // 2`` to the edge of the image are left unchanged.
+
+    Args:
+        stack (np.ndarray): 2D (YX) or 3D (ZYX) array
+        size (int): (odd) width of the square median window
+        mask (np.ndarray, optional): 2D boolean array.  If provided, only
+            pixels where mask is True are filtered; all others are copied.
+
+    Returns:
+        np.ndarray: filtered array with the same shape and dtype as ``stack``
+    """
+    if not size % 2:
+        raise ValueError("median filter size must be odd")
+    ndim = stack.ndim
+    stack = np.ascontiguousarray(stack)
+    if ndim == 2:
+        stack = stack[np.newaxis]
+    if mask is None:
+        mask = np.ones(stack.shape[-2:], dtype=np.bool_)
+    out = _median_filter_planes(stack, mask, size, np.empty_like(stack))
+    return out[0] if ndim == 2 else out
+
+
+def _gpu_available():
+    from mosaicpy.gpumedfilt import has_device
+
+    return has_device()
+
+
+def selectiveMedianFilter(
+    stack, background, median_range=3, with_mean=False, target=None
+):
     """correct bad pixels on sCMOS camera.
     based on MATLAB code by Philipp J. Keller,
     HHMI/Janelia Research Campus, 2011-2014
 
+    target may be 'gpu' (OpenCL, 3x3 window only) or 'cpu'.  By default,
+    the gpu is used if an OpenCL device is available.
     """
-    from mosaicpy.gpumedfilt import gpu_med_filt
+    if target is None:
+        target = "gpu" if _gpu_available() else "cpu"
+    if target == "gpu":
+        from mosaicpy.gpumedfilt import gpu_med_filt
+
+        def medfilt(im):
+            return gpu_med_filt(np.ascontiguousarray(im, dtype=np.float32))
+
+    elif target == "cpu":
+
+        def medfilt(im):
+            return median_filter_cpu(im, median_range)
+
+    else:
+        raise ValueError("unrecognized median filter target: {}".format(target))
 
+    start = time.time()
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
 
-        devProj = np.std(stack, 0, ddof=1)
-        devProjMedFiltered = gpu_med_filt(devProj)
+        devProj = np.std(stack, 0, ddof=1, dtype=np.float32)
+        devProjMedFiltered = medfilt(devProj)
         # devProjMedFiltered = median_filter(devProj, median_range, mode='constant')
         deviationDistances = np.abs(devProj - devProjMedFiltered)
         deviationDistances[deviationDistances == np.inf] = 0
-        deviationThreshold = determineThreshold(sorted(deviationDistances.flatten()))
+        deviationThreshold = determineThreshold(deviationDistances)
 
         deviationMatrix = deviationDistances > deviationThreshold
 
         if with_mean:
-            meanProj = np.mean(stack, 0) - background
-            meanProjMedFiltered = gpu_med_filt(meanProj)
+            meanProj = np.mean(stack, 0, dtype=np.float32) - background
+            meanProjMedFiltered = medfilt(meanProj)
             # meanProjMedFiltered = median_filter(meanProj, median_range)
             meanDistances = np.abs(meanProj - meanProjMedFiltered / meanProjMedFiltered)
             meanDistances[meanDistances == np.inf] = 0
-            meanThreshold = determineThreshold(sorted(meanDistances.flatten()))
+            meanThreshold = determineThreshold(meanDistances)
 
             meanMatrix = meanDistances > meanThreshold
 
@@ -84,34 +216,57 @@ def selectiveMedianFilter(stack, background, median_range=3, with_mean=False):
         )
 
         dt = stack.dtype
-        out = np.zeros(stack.shape, dt)
-        # apply pixelMatrix to correct insensitive pixels
-        for z in range(stack.shape[0]):
-            frame = np.asarray(stack[z], "Float32")
-            filteredFrame = gpu_med_filt(frame)
-            # filteredFrame = median_filter(frame, median_range)
-            frame[pixelMatrix == 1] = filteredFrame[pixelMatrix == 1]
-            out[z] = np.asarray(frame, dt)
-
-        return out, pixelCorrection
-
-
-def determineThreshold(array, maxSamples=50000):
-    array = np.array(array)
-    elements = len(array)
-
-    if elements > maxSamples:  # subsample
-        step = round(elements / maxSamples)
-        array = array[0::step]
-        elements = len(array)
-
-    connectingline = np.linspace(array[0], array[-1], elements)
-    distances = np.abs(array - connectingline)
-    position = np.argmax(distances)
-
-    threshold = array[position]
-    if np.isnan(threshold):
-        threshold = 0
+        if target == "cpu":
+            # filter only the bad pixels, of all planes, in a single call
+            out = median_filter_cpu(stack, median_range, mask=pixelMatrix)
+        else:
+            out = np.zeros(stack.shape, dt)
+            # apply pixelMatrix to correct insensitive pixels
+            for z in range(stack.shape[0]):
+                frame = np.asarray(stack[z], "Float32")
+                filteredFrame = medfilt(frame)
+                # filteredFrame = median_filter(frame, median_range)
+                frame[pixelMatrix == 1] = filteredFrame[pixelMatrix == 1]
+                out[z] = np.asarray(frame, dt)
+
+    logger.debug(
+        "Selective median filter ({}) on stack {}: {:0.3f} s".format(
+            target, stack.shape, time.time() - start
+        )
+    )
+    return out, pixelCorrection
+
+
+def determineThreshold(array, nbins=50000):
+    """Find the "knee" in the sorted values of array.
+
+    The threshold is the value at which the sorted array is furthest from the
+    straight line connecting its minimum and maximum.  Rather than sorting,
+    the sorted curve is reconstructed from a histogram with ``nbins`` bins,
+    in linear time.  The result is accurate to within one bin width.
+    """
+    array = np.asarray(array).ravel()
+    array = array[np.isfinite(array)]
+    if not array.size:
+        return 0
+    lo, hi = array.min(), array.max()
+    if lo == hi:
+        return lo
+    counts, edges = np.histogram(array, bins=nbins, range=(lo, hi))
+    # positions in the sorted array of the first and last element in each bin
+    last = np.cumsum(counts) - 1
+    first = last - counts + 1
+    slope = (hi - lo) / (array.size - 1)
+    filled = counts > 0
+    # within a bin, the sorted values run from its left to its right edge
+    dfirst = np.abs(edges[:-1] - (lo + slope * first))
+    dlast = np.abs(edges[1:] - (lo + slope * last))
+    dfirst[~filled] = -1
+    dlast[~filled] = -1
+    if dfirst.max() >= dlast.max():
+        threshold = edges[np.argmax(dfirst)]
+    else:
+        threshold = edges[np.argmax(dlast) + 1]
     return threshold
 
 
@@ -159,9 +314,27 @@ class CameraROI(np.ndarray):
         return "<CameraROI left:%d, top:%d, right:%d, bot:%d>" % (l, t, r, b)
 
 
+def roi_slices(roi, subroi, shape):
+    """Return the (row, column) slices of an image acquired with camera ROI
+    ``roi`` (of YX shape ``shape``) that hold the pixels of ``subroi``.
+    """
+    roi, subroi = CameraROI(roi), CameraROI(subroi)
+    if subroi not in roi:
+        raise ValueError("{} does not encompass {}".format(roi, subroi))
+    ny, nx = shape
+    # either Labview or the camera is doing
+    # something weird with the ROI... or I am calculating the required ROI
+    # alignment wrong... this is the hack I empirically came up with:
+    # rows are flipped relative to left/right, and
+    # it appears that the camera never shifts the roi horizontally...
+    yslice = slice(int(roi.right - subroi.right), ny - int(subroi.left - roi.left))
+    xslice = slice(int(subroi.top - roi.top), nx - int(roi.bottom - subroi.bottom))
+    return yslice, xslice
+
+
 def seemsValidCamParams(path):
     try:
-        data = imread(path)
+        data = imread(path, mmap=True)
         if not data.ndim == 3:
             return False
         if not data.shape[0] >= 3:
@@ -191,7 +364,9 @@ class CameraParameters(object):
         if data is None and path is None:
             raise ValueError("Must provide either filename or data array")
         if data is not None:
-            self.data = data.astype(np.float32)
+            # the camcor kernels need C-contiguous float32 data; this avoids
+            # a copy if data already is (e.g. a cached memmap)
+            self.data = np.ascontiguousarray(data, dtype=np.float32)
             self.path = path
         else:
             if not os.path.isfile(path):
@@ -201,7 +376,7 @@ class CameraParameters(object):
             if roi:
                 roi = [int(r) for r in roi.groups()]
             # TODO: ignore warnings from tifffile
-            self.data = imread(path).astype(np.float64)
+            self.data = imread(path).astype(np.float32)
 
         if roi is None or not len(roi):
             raise ValueError(
@@ -232,6 +407,43 @@ class CameraParameters(object):
     def __repr__(self):
         return "CameraParameters({})".format(os.path.basename(self.path))
 
+    @classmethod
+    def from_cache(cls, path, subroi):
+        """Load the parameters for subroi of the calibration file at path.
+
+        The first time a given (file, roi) combination is requested, the full
+        calibration file is read and cropped with :meth:`get_subroi`, and the
+        result is saved as an .npy file in the user cache directory.  Later
+        requests (from any process) memory-map that file read-only instead,
+        so they start instantly and share the same pages in memory.
+        """
+        if not os.path.isfile(path):
+            raise IOError("No such file: {}".format(path))
+        subroi = CameraROI(subroi)
+        stat = os.stat(path)
+        key = "|".join(
+            [os.path.abspath(path), str(stat.st_mtime_ns), str(stat.st_size)]
+        )
+        cachefile = os.path.join(
+            get_cache_dir("camparams"),
+            "{}_roi{}_{}.npy".format(
+                os.path.splitext(os.path.basename(path))[0],
+                "-".join(str(i) for i in subroi),
+                hashlib.sha1(key.encode()).hexdigest()[:12],
+            ),
+        )
+        if not os.path.isfile(cachefile):
+            params = cls(path).get_subroi(subroi)
+            # write to a temporary file first, so that concurrent processes
+            # never see a partially written cache file
+            tmpfile = "{}.{}.tmp".format(cachefile, os.getpid())
+            with open(tmpfile, "wb") as f:
+                np.save(f, np.ascontiguousarray(params.data, dtype=np.float32))
+            os.replace(tmpfile, cachefile)
+            logger.debug("Cached camera parameters: {}".format(cachefile))
+        data = np.load(cachefile, mmap_mode="r")
+        return cls(data=data, roi=subroi, path=path)
+
     def get_subroi(self, subroi):
         if not isinstance(subroi, CameraROI):
             if isinstance(subroi, (tuple, list)) and len(subroi) == 4:
@@ -244,18 +456,9 @@ class CameraParameters(object):
         if subroi not in self.roi:
             raise ValueError("ROI for correction file does not encompass data ROI")
 
-        diffroi = subroi - self.roi
-        # either Labview or the camera is doing
-        # something weird with the ROI... or I am calculating the required ROI
-        # alignment wrong... this is the hack I empirically came up with
-        vshift = self.roi.left + self.roi.right - subroi.left - subroi.right
-        # it appears that the camera never shifts the roi horizontally...
-        hshift = 0
-        subP = self.data[
-            :,
-            diffroi[0] + vshift : diffroi[2] + vshift,
-            diffroi[1] + hshift : diffroi[3] + hshift,
-        ]
+        yslice, xslice = roi_slices(self.roi, subroi, self.data.shape[-2:])
+        # copy, so that the subroi neither aliases nor pins the full-chip data
+        subP = self.data[:, yslice, xslice].copy()
         return CameraParameters(data=subP, roi=subroi, path=self.path)
 
     def init_CUDAcamcor(self, shape):
@@ -310,7 +513,9 @@ class CameraParameters(object):
         else:
             if flashCorrectTarget == "cpu":
                 # JIT VERSION
-                interleaved = calc_correction(interleaved, self.a, self.b, self.offset)
+                interleaved = calc_correction(
+                    interleaved, self.a, self.b, self.offset, dampening=dampening
+                )
             elif flashCorrectTarget == "numpy":
                 # NUMPY VERSION
                 interleaved = np.subtract(interleaved, self.offset)
@@ -352,54 +557,48 @@ class CameraParameters(object):
 
 
 if __name__ == "__main__":
+    # Reproducible benchmark of the CPU flash correction against thread count.
+    # usage: python -m mosaicpy.camera [nz ny nx]
+    import sys
+    import numba
 
-    from mosaicpy import llsdir
-    from mosaicpy import samples
-
-    paramfile = samples.camparams  # path to the calibration file
-
-    E = llsdir.LLSdir(samples.stickypix)  # special class for my data...
-    # you'll need to work around this to generate a list of filenames you want to correct
-
-    # get the master parameters TIF file and then crop it according to the
-    # roi used for the raw data set... if raw data is the same as the calibration
-    # you can use corrector = camparams
-    camparams = CameraParameters(paramfile)
-    corrector = camparams.get_subroi(CameraROI(E.settings.camera.roi))
-
-    # this is the list you need to make
-    stacks = [imread(str(t)) for t in E.tiff.raw if "stack0000" in str(t)]
+    shape = tuple(int(i) for i in sys.argv[1:4]) or (300, 512, 512)
     niters = 5
-
-    import time
-
-    start = time.time()
-    for _ in range(niters):
-        d1 = corrector.correct_stacks(
-            stacks, medianFilter=False, flashCorrectTarget="cpu"
-        )
-    end = time.time()
-    print("JitCPU Time: " + str((end - start) / niters))
-
-    start = time.time()
-    for _ in range(niters):
-        d2 = corrector.correct_stacks(
-            stacks, medianFilter=False, flashCorrectTarget="numpy"
-        )
-    end = time.time()
-    print("NumpyCPU Time: " + str((end - start) / niters))
-    print("Equal? = " + str(np.mean(d1[0] - d2[0])))
-    print("Equal? = " + str(np.mean(d1[1] - d2[1])))
-    print("Equal? = " + str(np.mean(d1[2] - d2[2])))
-
-    start = time.time()
-    corrector.init_CUDAcamcor(stacks[0].shape * np.array([len(stacks), 1, 1]))
-    for _ in range(niters):
-        d3 = corrector.correct_stacks(
-            stacks, medianFilter=False, flashCorrectTarget="cuda"
+    rs = np.random.RandomState(0)
+    stack = rs.poisson(200, size=shape).astype(np.uint16)
+    a = rs.uniform(0, 200, size=shape[1:]).astype(np.float32)
+    b = rs.uniform(0, 0.005, size=shape[1:]).astype(np.float32)
+    offset = rs.uniform(90, 110, size=shape[1:]).astype(np.float32)
+
+    def timeit(func, *args, **kwargs):
+        func(*args, **kwargs)  # warm up / compile
+        start = time.perf_counter()
+        for _ in range(niters):
+            result = func(*args, **kwargs)
+        return (time.perf_counter() - start) / niters, result
+
+    print("stack shape: {}, dtype: {}".format(shape, stack.dtype))
+    t_serial, ref = timeit(_calc_correction_serial, stack, a, b, offset)
+    print("serial (float64) : {:8.1f} ms".format(t_serial * 1000))
+
+    maxthreads = numba.config.NUMBA_NUM_THREADS
+    nthreads = sorted({1, 2, 4, 8, 16, maxthreads} & set(range(1, maxthreads + 1)))
+    for n in nthreads:
+        numba.set_num_threads(n)
+        t, res = timeit(calc_correction, stack, a, b, offset)
+        maxdiff = np.abs(res.astype(int) - ref.astype(int)).max()
+        print(
+            "parallel {:2d} thr  : {:8.1f} ms  speedup: {:5.2f}x  max diff: {}".format(
+                n, t * 1000, t_serial / t, maxdiff
+            )
         )
-    end = time.time()
-    print("CUDA Time: " + str((end - start) / niters))
-    print("Equal? = " + str(np.mean(d3[0] - d1[0])))
-    print("Equal? = " + str(np.mean(d3[1] - d1[1])))
-    print("Equal? = " + str(np.mean(d3[2] - d1[2])))
+    buf = stack.copy()
+    t, _ = timeit(calc_correction, buf, a, b, offset, out=buf)
+    print("in place {:2d} thr  : {:8.1f} ms".format(maxthreads, t * 1000))
+
+    # selective median filter: whole-volume cpu path vs per-plane OpenCL path
+    medstack = stack[:100].copy()
+    targets = ["cpu", "gpu"] if _gpu_available() else ["cpu"]
+    for target in targets:
+        t, _ = timeit(selectiveMedianFilter, medstack, 0, with_mean=True, target=target)
+        print("median filter {}    : {:8.1f} ms".format(target, t * 1000))
@@ -68,3 +68,11 @@ class SettingsError(MOSAICpyError):
 
 class OTFError(MOSAICpyError):
     pass
+
+
+class OpenCLError(MOSAICpyError):
+    """
+    Error indicating that no OpenCL device or context is available.
+    """
+
+    pass
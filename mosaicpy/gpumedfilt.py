@@ -1,24 +1,21 @@
-import pyopencl as cl
-import numpy as np
-
-# Get platforms, both CPU and GPU
-plat = cl.get_platforms()
-CPU = plat[0].get_devices()
-try:
-    GPU = plat[1].get_devices()
-except IndexError:
-    GPU = "none"
-
-# Create context for GPU/CPU
-if GPU != "none":
-    ctx = cl.Context(GPU)
-else:
-    ctx = cl.Context(CPU)
+"""OpenCL 3x3 median filter.
 
-# Create queue for each kernel execution
-queue = cl.CommandQueue(ctx)
+The OpenCL context and the compiled kernel are created lazily on the first
+call to :func:`gpu_med_filt` (or :func:`has_device`), so importing this module
+is cheap and does not fail on machines without an OpenCL device.  Compiled
+program binaries are cached on disk per device, so only the very first run on
+a given device pays for kernel compilation.
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+import numpy as np
+from .exceptions import OpenCLError
+from .util import get_cache_dir
 
-mf = cl.mem_flags
+logger = logging.getLogger(__name__)
 
 # Kernel function
 src = """
@@ -80,11 +77,98 @@ __kernel void medianFilter(__global float *img, __global float *result, __global
 }
 """
 
-# Kernel function instantiation
-prg = cl.Program(ctx, src).build()
+
+_CL = {}  # holds the lazily created context, queue and program
+_CL_LOCK = threading.Lock()  # so concurrent first calls only build once
+
+
+def _get_devices(cl):
+    # Get platforms, both CPU and GPU
+    plat = cl.get_platforms()
+    CPU = plat[0].get_devices()
+    try:
+        GPU = plat[1].get_devices()
+    except IndexError:
+        GPU = "none"
+    return GPU if GPU != "none" else CPU
+
+
+def _binary_path(cl, device):
+    key = "|".join(
+        [
+            src,
+            device.name,
+            device.platform.name,
+            device.driver_version,
+            cl.VERSION_TEXT,
+        ]
+    )
+    digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+    return os.path.join(get_cache_dir("opencl"), "medianFilter_{}.bin".format(digest))
+
+
+def _build_program(cl, ctx):
+    """build the median filter program, using cached binaries if possible"""
+    devices = ctx.devices
+    paths = [_binary_path(cl, d) for d in devices]
+    if all(os.path.isfile(p) for p in paths):
+        try:
+            binaries = []
+            for p in paths:
+                with open(p, "rb") as f:
+                    binaries.append(f.read())
+            prg = cl.Program(ctx, devices, binaries).build()
+            logger.debug("Loaded cached median filter kernel binaries")
+            return prg
+        except Exception as e:
+            logger.debug("Failed to load cached kernel binaries: {}".format(e))
+
+    prg = cl.Program(ctx, src).build()
+    try:
+        for path, binary in zip(paths, prg.get_info(cl.program_info.BINARIES)):
+            with open(path, "wb") as f:
+                f.write(binary)
+    except Exception as e:
+        logger.debug("Failed to cache kernel binaries: {}".format(e))
+    return prg
+
+
+def _init():
+    with _CL_LOCK:
+        if "error" in _CL:
+            # don't retry on every call once initialization has failed
+            raise OpenCLError(_CL["error"])
+        if _CL:
+            return _CL
+        try:
+            import pyopencl as cl
+
+            # Create context for GPU/CPU
+            ctx = cl.Context(_get_devices(cl))
+            # Create queue for each kernel execution
+            queue = cl.CommandQueue(ctx)
+            prg = _build_program(cl, ctx)
+        except Exception as e:
+            _CL["error"] = "Could not initialize OpenCL median filter: {}".format(e)
+            raise OpenCLError(_CL["error"])
+        _CL.update(cl=cl, ctx=ctx, queue=queue, prg=prg)
+        return _CL
+
+
+def has_device():
+    """Return True if an OpenCL device is available for gpu_med_filt."""
+    try:
+        _init()
+        return True
+    except OpenCLError:
+        return False
 
 
 def gpu_med_filt(img):
+    """3x3 median filter of a 2D float32 image on the OpenCL device"""
+    c = _init()
+    cl, ctx = c["cl"], c["ctx"]
+    mf = cl.mem_flags
     # Allocate memory for variables on the device
     img_g = cl.Buffer(ctx, mf.READ_ONLY | mf.COPY_HOST_PTR, hostbuf=img)
     result_g = cl.Buffer(ctx, mf.WRITE_ONLY, img.nbytes)
@@ -95,7 +179,26 @@ def gpu_med_filt(img):
         ctx, mf.READ_ONLY | mf.COPY_HOST_PTR, hostbuf=np.int32(img.shape[0])
     )
     # Call Kernel. Automatically takes care of block/grid distribution
-    prg.medianFilter(queue, img.shape, None, img_g, result_g, width_g, height_g)
+    c["prg"].medianFilter(
+        c["queue"], img.shape, None, img_g, result_g, width_g, height_g
+    )
     result = np.empty_like(img)
-    cl.enqueue_copy(queue, result, result_g)
+    cl.enqueue_copy(c["queue"], result, result_g)
     return result
+
+
+if __name__ == "__main__":
+    # report first-call (context creation + kernel build/load) latency
+    # run twice to see the effect of the on-disk kernel binary cache
+    img = np.random.RandomState(0).rand(2048, 2048).astype(np.float32)
+    start = time.perf_counter()
+    if not has_device():
+        print("No OpenCL device available")
+    else:
+        print("OpenCL init: {:8.1f} ms".format((time.perf_counter() - start) * 1000))
+        start = time.perf_counter()
+        gpu_med_filt(img)
+        print("first call:  {:8.1f} ms".format((time.perf_counter() - start) * 1000))
+        start = time.perf_counter()
+        gpu_med_filt(img)
+        print("second call: {:8.1f} ms".format((time.perf_counter() - start) * 1000))
@@ -6,6 +6,7 @@ import numpy as np
 import os
 import sys
 import glob
+import threading
 import tifffile as tf
 from mosaicpy.gui.camcordialog import Ui_Dialog as camcorDialog
 from mosaicpy.gui.helpers import newWorkerThread
@@ -27,13 +28,15 @@ class CamCalibWorker(QtCore.QObject):
         self.folder = folder
         self.darkavg = darkavg
         self.darkstd = darkstd
+        # set from the GUI thread to stop calibration between files or tiles
+        self.cancel = threading.Event()
 
     @QtCore.Slot()
     def work(self):
         def updatedarkstatus(prog):
             if prog == 0:
                 self.setStatus.emit("Calculating offset map... [Step 2 of 4]")
-            elif prog == 0:
+            elif prog == 1:
                 self.setStatus.emit("Calculating noise map... [Step 3 of 4]")
             return
 
@@ -45,10 +48,16 @@ class CamCalibWorker(QtCore.QObject):
                 self.setStatus.emit("Loading dark images... [Step 1 of 4]")
                 darklist = glob.glob(os.path.join(self.folder, "*dark*.tif"))
                 numdark = len(darklist)
-                self.setProgMax.emit(numdark * 2)
+                self.setProgMax.emit(numdark)
                 darkavg, darkstd = camcalib.process_dark_images(
-                    self.folder, self.progress.emit, updatedarkstatus
+                    self.folder,
+                    self.progress.emit,
+                    updatedarkstatus,
+                    cancel=self.cancel,
                 )
+                if self.cancel.is_set():
+                    self.finished.emit()
+                    return
 
             filelist = glob.glob(os.path.join(self.folder, "*.tif"))
             if not filelist:
@@ -59,15 +68,17 @@ class CamCalibWorker(QtCore.QObject):
 
             self.setProgMax.emit(ny * nx)
             self.setStatus.emit(
-                "Calculating correction image... This will take a while"
+                "Calculating correction image... This will take a while "
+                "(finished tiles are saved, aborted runs will resume)"
             )
             out = camcalib.process_bright_images(
-                self.folder, darkavg, darkstd, self.progress.emit
+                self.folder, darkavg, darkstd, self.progress.emit, cancel=self.cancel
             )
 
-            self.setStatus.emit(
-                "Done! Calibration file has been written to: {}".format(out[0])
-            )
+            if out[1] is not None:
+                self.setStatus.emit(
+                    "Done! Calibration file has been written to: {}".format(out[0])
+                )
 
             self.finished.emit()
 
@@ -83,6 +94,7 @@ class CamCalibDialog(QtW.QDialog, camcorDialog):
         self.setupUi(self)  # method inherited from form_class to init UI
         self.setWindowTitle("Flash4.0 Charge Carryover Correction")
         self.abortButton.hide()
+        self.abortButton.clicked.connect(self._abort)
         self.picture.setPixmap(
             QtGui.QPixmap(getAbsoluteResourcePath("gui/before_after.png"))
         )
@@ -191,16 +203,18 @@ class CamCalibDialog(QtW.QDialog, camcorDialog):
                 "progress": self.incrementProgress,
                 "setProgMax": self.resetWithMax,
                 "setStatus": self.statusLabel.setText,
-                "finished": self.abortButton.hide,
+                "finished": self._workerFinished,
             },
             start=True,
         )
-        # self.abortButton.clicked.connect(self._abort)
-        # self.abortButton.show()
+        # finished tiles are checkpointed, so an aborted calibration
+        # can be resumed by running it again on the same folder
+        self.abortButton.show()
 
     @QtCore.Slot(int)
     def incrementProgress(self, val=None):
-        self.progressBar.setValue(self.progressBar.value() + 1)
+        # val is the number of items (files, pixels) finished since last call
+        self.progressBar.setValue(self.progressBar.value() + (val or 1))
 
     @QtCore.Slot(int)
     def resetWithMax(self, maxm):
@@ -209,8 +223,19 @@ class CamCalibDialog(QtW.QDialog, camcorDialog):
 
     @QtCore.Slot()
     def _abort(self):
-        self.thread.terminate()
-        self.thread.wait()
+        # the worker stops at the next file or tile, then emits finished
+        self.worker.cancel.set()
+        self.abortButton.hide()
+        self.statusLabel.setText("Aborting…")
+
+    @QtCore.Slot()
+    def _workerFinished(self):
+        self.abortButton.hide()
+        self.thread.quit()
+        if self.worker.cancel.is_set():
+            self.statusLabel.setText(
+                "Calibration aborted. Run again on the same folder to resume."
+            )
 
 
 if __name__ == "__main__":
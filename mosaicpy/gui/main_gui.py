@@ -170,6 +170,10 @@ class Ui_Main_GUI(object):
         self.RegAutoThreshCheckbox.setChecked(True)
         self.RegAutoThreshCheckbox.setObjectName("RegAutoThreshCheckbox")
         self.gridLayout_3.addWidget(self.RegAutoThreshCheckbox, 1, 2, 1, 2)
+        self.RegRobustCheckbox = QtWidgets.QCheckBox(self.tab_registration)
+        self.RegRobustCheckbox.setChecked(False)
+        self.RegRobustCheckbox.setObjectName("RegRobustCheckbox")
+        self.gridLayout_3.addWidget(self.RegRobustCheckbox, 2, 0, 1, 4)
         self.tabWidget.addTab(self.tab_registration, "")
         self.tab_config = QtWidgets.QWidget()
         self.tab_config.setObjectName("tab_config")
@@ -564,6 +568,9 @@ class Ui_Main_GUI(object):
         self.BeadThresholdLabel.setText(QtWidgets.QApplication.translate("Main_GUI", "Bead Threshold:", None, -1))
         self.RegMinBeadsLabel.setText(QtWidgets.QApplication.translate("Main_GUI", "Min number of beads:", None, -1))
         self.RegAutoThreshCheckbox.setText(QtWidgets.QApplication.translate("Main_GUI", "Autodetect", None, -1))
+        self.RegRobustCheckbox.setToolTip(QtWidgets.QApplication.translate("Main_GUI", "Estimate least squares transforms robustly,\n"
+"ignoring beads that were matched to the wrong partner", None, -1))
+        self.RegRobustCheckbox.setText(QtWidgets.QApplication.translate("Main_GUI", "Robust fit (ignore mismatched beads)", None, -1))
         self.tabWidget.setTabText(self.tabWidget.indexOf(self.tab_registration), QtWidgets.QApplication.translate("Main_GUI", "Registration", None, -1))
         self.cudaDeconvPathLabel_2.setToolTip(QtWidgets.QApplication.translate("Main_GUI", "Toggle the GPUs that you want to use for processing.\n"
 " Work will be distributed among them", None, -1))
@@ -6,6 +6,7 @@ import mosaicpy.gui.exceptions as err
 from qtpy import QtCore, QtWidgets
 from mosaicpy import llsdir
 from mosaicpy.gui.helpers import newWorkerThread
+from mosaicpy.util import get_cache_dir
 from mosaicpy.gui import workers, actions
 from mosaicpy.gui.img_dialog import ImgDialog
 from fiducialreg.fiducialreg import RegistrationError
@@ -45,7 +46,7 @@ class RegistrationTab(actions.MOSAICpyActions):
         for cb in group.findChildren(QtWidgets.QCheckBox):
             layout.removeWidget(cb)
             cb.setParent(None)
-        for wave in RD.parameters.channels.values():
+        for wave in RD.waves:
             box = QtWidgets.QCheckBox(str(wave), group)
             layout.addWidget(box)
             box.setChecked(True)
@@ -63,13 +64,20 @@ class RegistrationTab(actions.MOSAICpyActions):
         if not len(refs):
             raise err.InvalidSettingsError("Select at least one reference channel")
 
+        # detected bead clouds are cached, so that regenerating the file with
+        # other references or modes does not detect the beads again
+        cache_dir = get_cache_dir("beads")
         autoThresh = self.RegAutoThreshCheckbox.isChecked()
         if autoThresh:
             minbeads = int(self.RegMinBeadsSpin.value())
-            RD = llsdir.RegDir(path, usejson=False, threshold="auto", mincount=minbeads)
+            RD = llsdir.RegDir(
+                path, threshold="auto", mincount=minbeads, cache_dir=cache_dir
+            )
         else:
             threshold = int(self.RegBeadThreshSpin.value())
-            RD = llsdir.RegDir(path, threshold=threshold, usejson=False)
+            RD = llsdir.RegDir(path, threshold=threshold, cache_dir=cache_dir)
+        # least squares modes ignore mismatched beads when robust
+        robust = self.RegRobustCheckbox.isChecked()
 
         if not RD.isValid:
             raise err.RegistrationError(
@@ -89,15 +97,18 @@ class RegistrationTab(actions.MOSAICpyActions):
             finished = QtCore.Signal(str)
             warning = QtCore.Signal(str, str)
 
-            def __init__(self, RD, outdir, refs):
+            def __init__(self, RD, outdir, refs, robust=False):
                 QtCore.QThread.__init__(self)
                 self.RD = RD
                 self.outdir = outdir
                 self.refs = refs
+                self.robust = robust
 
             def run(self):
                 try:
-                    outfile, outstring = self.RD.write_reg_file(outdir, refs=self.refs)
+                    outfile, outstring = self.RD.write_reg_file(
+                        outdir, refs=self.refs, robust=self.robust
+                    )
                     counts = self.RD.cloudset().count
                     if np.std(counts) > 15:
                         outstr = "\n".join(
@@ -136,7 +147,7 @@ class RegistrationTab(actions.MOSAICpyActions):
             QtWidgets.QMessageBox.warning(self, title, msg, QtWidgets.QMessageBox.Ok)
 
         self.regthreads = []
-        regthread = RegThread(RD, outdir, refs)
+        regthread = RegThread(RD, outdir, refs, robust)
         regthread.finished.connect(finishup)
         regthread.warning.connect(notifyuser)
         self.regthreads.append(regthread)
@@ -186,8 +197,8 @@ class RegistrationTab(actions.MOSAICpyActions):
             raise err.RegistrationError("Failed to load registration file", str(e))
 
     def previewRegistration(self):
-        RD = llsdir.RegDir(self.RegCalibPathLineEdit.text())
-        if not RD.isValid:
+        path = self.RegCalibPathLineEdit.text()
+        if not path or not os.path.isdir(path):
             raise err.RegistrationError(
                 "Registration Calibration dir not valid. Please check Fiducial Data path above."
             )
@@ -204,49 +215,29 @@ class RegistrationTab(actions.MOSAICpyActions):
             )
             return
 
+        mode = self.RegCalib_channelRefModeCombo.currentText()
+        refwave = int(self.RegCalib_channelRefCombo.currentText())
+
         @QtCore.Slot(np.ndarray, float, float, dict)
         def displayRegPreview(array, dx=None, dz=None, params=None):
             win = ImgDialog(
                 array,
                 info=params,
-                title="Registration Mode: {} -- RefWave: {}".format(
-                    opts["regMode"], opts["regRefWave"]
-                ),
+                title="Registration Mode: {} -- RefWave: {}".format(mode, refwave),
             )
             win.overlayButton.click()
-            win.maxProjButton.click()
             self.spimwins.append(win)
 
         self.previewButton.setDisabled(True)
         self.previewButton.setText("Working...")
 
-        try:
-            opts = self.getValidatedOptions()
-        except Exception:
-            self.previewButton.setEnabled(True)
-            self.previewButton.setText("Preview")
-            raise
-
-        opts["regMode"] = self.RegCalib_channelRefModeCombo.currentText()
-        if opts["regMode"].lower() == "none":
-            opts["doReg"] = False
-        else:
-            opts["doReg"] = True
-        opts["regRefWave"] = int(self.RegCalib_channelRefCombo.currentText())
-        opts["regCalibPath"] = self.RegFilePath.text()
-        opts["correctFlash"] = False
-        opts["medianFilter"] = False
-        opts["trimZ"] = (0, 0)
-        opts["trimY"] = (0, 0)
-        opts["trimX"] = (0, 0)
-        opts["nIters"] = 0
-
+        # warp projections only, for feedback within a second or two
         w, thread = newWorkerThread(
-            workers.TimePointWorker,
-            RD,
-            [0],
-            None,
-            opts,
+            workers.RegPreviewWorker,
+            path,
+            self.RegFilePath.text(),
+            refwave,
+            mode,
             workerConnect={"previewReady": displayRegPreview},
             start=True,
         )
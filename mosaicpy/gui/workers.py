@@ -657,3 +657,69 @@ class TimePointWorker(QtCore.QObject):
             raise
 
         self.finished.emit()
+
+
+class RegPreviewWorker(QtCore.QObject):
+    """Apply a registration file to the projections of a calibration folder
+
+    Only the maximum intensity projection of each channel (or, with
+    method='binned', an XY binned volume) is warped, so the preview is fast
+    regardless of the stack size.  Sample-scan stacks are deskewed first.
+    """
+
+    finished = QtCore.Signal()
+    previewReady = QtCore.Signal(np.ndarray, float, float, dict)
+
+    def __init__(self, path, regfile, refwave, mode, method="mip", **kwargs):
+        super(RegPreviewWorker, self).__init__()
+        self.path = str(path)
+        self.regfile = regfile
+        self.refwave = refwave
+        self.mode = mode
+        self.method = method
+        self._logger = logging.getLogger("mosaicpy.worker." + type(self).__name__)
+
+    @QtCore.Slot()
+    def work(self):
+        from fiducialreg.fiducialreg import RegFile
+        from fiducialreg.imwarp import WarpPlan
+        from mosaicpy.imgprocessors.imgprocessors import deskew_tform
+
+        try:
+            E = mosaicpy.LLSdir(self.path)
+            params = E.params
+            data = E.data.asarray(t=0)
+            if params.nc == 1:
+                data = data[np.newaxis]
+            waves = params.wavelengths
+            prewarp = None
+            if params.samplescan:
+                # registration files apply to deskewed volumes
+                prewarp = deskew_tform(
+                    data.shape[-3:], params.dz, params.dx, params.angle
+                )
+            if self.mode.lower() == "none":
+                if prewarp is not None:
+                    matrix, shape = prewarp
+                    deskew = WarpPlan.from_matrix(matrix, data.shape[-3:], shape)
+                    data = [deskew(d) for d in data]
+                preview = np.stack([d.max(0)[np.newaxis] for d in data])
+            else:
+                regfile = RegFile(self.regfile)
+                preview = regfile.preview(
+                    data,
+                    waves,
+                    self.refwave,
+                    self.mode.lower(),
+                    dx=params.dx,
+                    dz=params.dzFinal,
+                    method=self.method,
+                    prewarp=prewarp,
+                )
+            info = {"wavelength": waves, "mode": self.mode, "ref": self.refwave}
+            self.previewReady.emit(preview, params.dx, params.dzFinal, info)
+        except Exception:
+            self.finished.emit()
+            raise
+
+        self.finished.emit()
@@ -24,6 +24,9 @@ from mosaicpy.arrayfun import (
 from mosaicpy.util import imread
 from mosaicpy import LLSdir
 from mosaicpy.otf import choose_otf
+from fiducialreg.fiducialreg import RegFile, RegistrationError
+from fiducialreg.imref import imref3d
+from fiducialreg.imwarp import WarpPlan, intrinsic_tform
 
 logger = logging.getLogger()
 
@@ -91,6 +94,28 @@ def for_channel(inplace=True):
     return real_decorator
 
 
+def _nbytes(shape, dtype):
+    return int(np.prod(shape, dtype=np.int64)) * np.dtype(dtype).itemsize
+
+
+def narrowest_dtype(dtype, candidates):
+    """ the smallest of `candidates` that `dtype` can be cast to without loss,
+    or the largest candidate if there is none """
+    dtype = np.dtype(dtype)
+    candidates = sorted((np.dtype(d) for d in candidates), key=lambda d: d.itemsize)
+    if dtype in candidates:
+        return dtype
+    for candidate in candidates:
+        if np.can_cast(dtype, candidate, "safe"):
+            return candidate
+    return candidates[-1]
+
+
+def _background_overhead(shape, dtype):
+    """ working memory of the without_background decorator (one channel) """
+    return _nbytes(shape[-3:], np.float32) + _nbytes(shape[-3:], dtype)
+
+
 class BitDepth(Enum):
     uint16 = "16-bit"
     float32 = "32-bit"
@@ -111,12 +136,23 @@ class ImgProcessor(ABC):
     be specified for each channel in the dataset
     """
 
+    # whether processing the channels one at a time gives the same result
+    # (the ProcessPlan does that to stay within its memory budget)
+    channel_independent = True
+    # dtypes that process() works with.  Other input is cast to the narrowest
+    # of them that holds it (see input_dtype), e.g. float64 becomes float32
+    accepted_dtypes = (np.uint8, np.uint16, np.float32)
+
     def __init__(self):
         super().__init__()
 
     def __call__(self, data, meta, **kwargs):
         assert isinstance(data, np.ndarray), "Input to ImgProcessor must be np.ndarray"
         logger.debug("{} called on data with shape {}".format(self, data.shape))
+        dtype = self.input_dtype(data.dtype)
+        if dtype != data.dtype:
+            logger.debug("{} casting {} input to {}".format(self, data.dtype, dtype))
+            data = data.astype(dtype)
         data = self.process(data, meta, **kwargs)
         if kwargs.get("callback", False):
             kwargs.get("callback")(data, **kwargs)
@@ -176,6 +212,37 @@ class ImgProcessor(ABC):
         attrs = " <{}>".format(",".join(attrs)) if len(attrs) else ""
         return "{}{}".format(name, attrs)
 
+    def input_dtype(self, dtype):
+        """ dtype that process() receives for input of `dtype` """
+        return narrowest_dtype(dtype, self.accepted_dtypes)
+
+    def output_dtype(self, dtype):
+        """ dtype returned by process() for input of `dtype` (an accepted dtype)
+
+        The default is to keep the dtype.  Processors that change it should
+        override this, and return the narrowest dtype that holds the result.
+        """
+        return np.dtype(dtype)
+
+    def estimate_memory(self, shape, dtype, meta):
+        """ Estimate the peak memory used by process() for one timepoint.
+
+        The default assumes that process() allocates one output array the size
+        of the input.  Processors that make working copies, or that change the
+        shape of the data, should override this.  Must not modify meta.
+
+        Args:
+            shape (tuple): shape of the input data, (C)ZYX
+            dtype (np.dtype): dtype of the input data, after input_dtype()
+            meta (dict): same as for process()
+
+        Returns:
+            tuple: (peak bytes, including the input; output shape; output dtype)
+        """
+        outdtype = self.output_dtype(dtype)
+        peak = _nbytes(shape, dtype) + _nbytes(shape, outdtype)
+        return peak, tuple(shape), outdtype
+
     @classmethod
     def from_llsdir(cls, llsdir=None, **kwargs):
         """ instantiate the class based on data from an llsdir object.
@@ -202,7 +269,9 @@ class ImgProcessor(ABC):
 
 
 class ImgWriter(ImgProcessor):
-    pass
+    def estimate_memory(self, shape, dtype, meta):
+        # writers pass the data through
+        return _nbytes(shape, dtype), tuple(shape), np.dtype(dtype)
 
 
 class FlashProcessor(ImgProcessor):
@@ -210,6 +279,8 @@ class FlashProcessor(ImgProcessor):
 
     verbose_name = "Flash Artifact Correction"
     processing_verb = "Fixing Flash Artifact"
+    # the artifact carries over between interleaved channels
+    channel_independent = False
 
     class Target(Enum):
         CPU = "CPU"
@@ -223,14 +294,12 @@ class FlashProcessor(ImgProcessor):
                 raise ValueError(
                     '"{}" is not a valid FlashProcessor target'.format(perform_on)
                 )
-        if not isinstance(param_file, CameraParameters):
-            try:
-                param_file = CameraParameters(param_file)
-            except Exception as e:
-                raise self.ImgProcessorError("Error creating cam_params: {}".format(e))
-        # may raise an error... should catch here?
         try:
-            self.cam_params = param_file.get_subroi(data_roi)
+            if isinstance(param_file, CameraParameters):
+                self.cam_params = param_file.get_subroi(data_roi)
+            else:
+                # memory-mapped sub-roi parameters, cached per (file, roi)
+                self.cam_params = CameraParameters.from_cache(param_file, data_roi)
         except Exception as e:
             raise self.ImgProcessorError("Error creating cam_params: {}".format(e))
         self.target = self.Target(perform_on)
@@ -250,12 +319,17 @@ class FlashProcessor(ImgProcessor):
         """ interleaves and corrects 4D data, or just correct 3D """
         if self.target == self.Target.CPU:
             a, b, offset = self.cam_params.data[:3]
-            data = calc_correction(data, a, b, offset)
+            data = calc_correction(data, a, b, offset, out=data)
         else:
             data = camcor(data)
         meta["has_background"] = False
         return data, meta
 
+    def estimate_memory(self, shape, dtype, meta):
+        n = _nbytes(shape, dtype)
+        # correction is in place, but (de)interleaving 4D data copies it twice
+        return (3 * n if len(shape) > 3 else n), tuple(shape), np.dtype(dtype)
+
     @classmethod
     def from_llsdir(cls, llsdir, **kwargs):
         kwargs.pop("data_roi")
@@ -274,11 +348,13 @@ class SelectiveMedianProcessor(ImgProcessor):
     gui_layout = {"background": (0, 1), "median_range": (0, 0), "with_mean": (0, 2)}
     valid_range = {"background": (0, 1000), "median_range": (1, 9)}
     hint = "selective median filter as in Amat 2015"
+    channel_independent = False
 
     def __init__(self, background=0, median_range=3, with_mean=True):
         super(SelectiveMedianProcessor, self).__init__()
         self.background = background
-        self.median_range = median_range
+        # the median window must be odd, round even sizes from the GUI up
+        self.median_range = int(median_range) // 2 * 2 + 1
         self.with_mean = with_mean
 
     def process(self, data, meta):
@@ -293,6 +369,11 @@ class SelectiveMedianProcessor(ImgProcessor):
             data = data.reshape(nc, -1, ny, nx)
         return data, meta
 
+    def estimate_memory(self, shape, dtype, meta):
+        # plus a float32 temporary for the deviation projection
+        peak = 2 * _nbytes(shape, dtype) + _nbytes(shape, np.float32)
+        return peak, tuple(shape), np.dtype(dtype)
+
 
 class DivisionProcessor(ImgProcessor):
     """ Divides and image by another image, e.g. for flatfield correction
@@ -346,12 +427,22 @@ class DivisionProcessor(ImgProcessor):
         data = np.divide(data, self.divisor)
         return data, meta
 
+    def output_dtype(self, dtype):
+        return np.result_type(dtype, self.divisor.dtype)
+
+    def estimate_memory(self, shape, dtype, meta):
+        peak = _nbytes(shape, dtype) + _background_overhead(shape, dtype)
+        outdtype = self.output_dtype(dtype)
+        return peak + _nbytes(shape, outdtype), tuple(shape), outdtype
+
 
 class BleachCorrectionProcessor(ImgProcessor):
     """ Divides and image by another image, e.g. for flatfield correction """
 
     verbose_name = "Bleach Correction"
     processing_verb = "Correcting Photobleaching"
+    # the scaling factors are per channel of the first timepoint
+    channel_independent = False
 
     def __init__(self, first_timepoint):
         # convert first_timepoint into divisor
@@ -368,9 +459,18 @@ class BleachCorrectionProcessor(ImgProcessor):
             scaler = (self.first_mean / mean).reshape(data.shape[0], 1, 1, 1)
         else:
             raise self.ImgProcessorError("Bleach correction can only accept 3 or 4D")
-        data = np.multiply(data, scaler).astype(dtype)
+        # float32 is exact enough for 16-bit data, and the product of float32
+        # input needs no cast
+        scaler = np.asarray(scaler, dtype=np.float32)
+        data = np.multiply(data, scaler).astype(dtype, copy=False)
         return data, meta
 
+    def estimate_memory(self, shape, dtype, meta):
+        peak = _nbytes(shape, dtype) + _nbytes(shape, np.float32)
+        if dtype != np.float32:
+            peak += _nbytes(shape, dtype)
+        return peak, tuple(shape), np.dtype(dtype)
+
     @classmethod
     def from_llsdir(cls, llsdir, **kwargs):
         return cls(llsdir.data.asarray(t=0))
@@ -396,6 +496,12 @@ class TrimProcessor(ImgProcessor):
         data = data[tuple(self.slices)]
         return data, meta
 
+    def estimate_memory(self, shape, dtype, meta):
+        # trimming returns a view
+        trimmed = [len(range(n)[s]) for n, s in zip(shape[-3:], self.slices[-3:])]
+        outshape = tuple(shape[:-3]) + tuple(trimmed)
+        return _nbytes(shape, dtype), outshape, np.dtype(dtype)
+
 
 class CUDADeconProcessor(ImgProcessor):
     """  Perform richardson lucy deconvolution on the GPU
@@ -405,6 +511,8 @@ class CUDADeconProcessor(ImgProcessor):
 
     verbose_name = "Deconvolution/Deskewing"
     processing_verb = "Deconvolving"
+    # the GPU takes uint16, float input is cast after background subtraction
+    accepted_dtypes = (np.uint16, np.float32)
     valid_range = {"background": (0, 1000), "n_iters": (1, 20)}
 
     # gui_layout = {
@@ -522,13 +630,32 @@ class CUDADeconProcessor(ImgProcessor):
                 if c == 0:
                     d = self._process_channel(data[c], wave, meta)
                     shp = (len(meta["c"]),) + d.shape
-                    newdata = np.empty(shp)
+                    newdata = np.empty(shp, dtype=np.float32)
                     newdata[0] = d
                 else:
                     newdata[c] = self._process_channel(data[c], wave, meta)
         else:
             newdata = self._decon(data, meta.get("out_shape"))
-        return newdata.astype(self.dtype), meta
+        return newdata.astype(self.dtype, copy=False), meta
+
+    def output_dtype(self, dtype):
+        return np.dtype(self.dtype)
+
+    def estimate_memory(self, shape, dtype, meta):
+        params = meta["params"]
+        zyx = tuple(shape[-3:])
+        if params.deskew:
+            zyx = deskew_tform(zyx, params.dz, params.dx, params.deskew)[1]
+        if self.save_deskewed:
+            zyx = (2,) + zyx
+        outshape = tuple(shape[:-3]) + zyx
+        peak = _nbytes(shape, dtype) + _background_overhead(shape, dtype)
+        # one channel of float32 results from the GPU, all channels collected
+        # in float32, then cast to the output bit depth
+        peak += _nbytes(zyx, np.float32) + _nbytes(outshape, np.float32)
+        if self.dtype != np.float32:
+            peak += _nbytes(outshape, self.dtype)
+        return peak, outshape, self.output_dtype(dtype)
 
     @classmethod
     def from_llsdir(cls, llsdir, **kwargs):
@@ -545,7 +672,165 @@ class CUDADeconProcessor(ImgProcessor):
         return cls(**kwargs)
 
 
-class DeskewProcessor(ImgProcessor):
+def deskew_tform(shape, dz, dx, angle, width=0, shift=0):
+    """index matrix and output shape of deskewGPU for a volume of shape `shape`
+
+    Returns:
+        tuple: (4x4 matrix mapping (z, y, x, 1) output indices to input
+            indices, output shape)
+    """
+    nz, ny, nx = shape
+    f = np.cos(angle * np.pi / 180) * dz / dx
+    if width == 0:
+        width = int(nx + np.floor(nz * abs(f)))
+    M = np.eye(4)
+    M[2, 0] = -f
+    M[2, 3] = shift - width / 2 + f * nz / 2 + nx / 2
+    return M, (nz, ny, width)
+
+
+def rotate_y_tform(shape, angle=32.5, xzRatio=0.4253, reverse=False):
+    """index matrix and output shape of rotateGPU for a volume of shape `shape`
+
+    Returns:
+        tuple: (4x4 matrix mapping (z, y, x, 1) output indices to input
+            indices, output shape)
+    """
+    nz, ny, nx = shape
+    theta = angle * np.pi / 180
+    theta = theta if not reverse else -theta
+    T1 = np.eye(4)
+    T1[:3, 3] = (nx / 2, ny / 2, nz / 2)
+    S = np.diag((1, 1, xzRatio, 1))
+    R = np.eye(4)
+    R[0, [0, 2]] = np.cos(theta), -np.sin(theta)
+    R[2, [0, 2]] = np.sin(theta), np.cos(theta)
+    T2 = np.eye(4)
+    T2[:3, 3] = (-nx / 2, -ny / 2, -nz / 2)
+    # rotateGPU matrices are xyz, swap to zyx
+    P = np.eye(4)[[2, 1, 0, 3]]
+    return P @ T1 @ S @ R @ T2 @ P, tuple(shape)
+
+
+class _GeometricProcessor(ImgProcessor):
+    """ Base class for ImgProcessors that only resample the data with an affine
+    mapping of voxel indices.
+
+    Subclasses implement index_tform().  Consecutive geometric processors can
+    then be replaced by a single _FusedGeometryProcessor, which interpolates
+    each volume once instead of once per step.
+    """
+
+    @abstractmethod
+    def index_tform(self, shape, meta, c=0):
+        """ return (matrix, output_shape) for channel `c` of a volume of `shape`
+
+        matrix is the 4x4 matrix mapping zero-based (z, y, x, 1) output
+        indices to input indices (see fiducialreg.imwarp.intrinsic_tform).
+        """
+        pass
+
+    def warp_plan(self, shape, meta, c=0):
+        """ WarpPlan for channel `c`, cached per shape and channel """
+        plans = self.__dict__.setdefault("_plans", {})
+        key = (tuple(shape), c)
+        if key not in plans:
+            M, outshape = self.index_tform(tuple(shape), meta, c)
+            plans[key] = WarpPlan.from_matrix(M, shape, outshape)
+        return plans[key]
+
+    def resample(self, data, meta):
+        """ resample all channels of data on the CPU
+
+        The output has the dtype of the input, like the GPU processors.
+        Integer data is interpolated in float32 one channel at a time and
+        rounded.
+        """
+        nc = len(meta["c"])
+        channels = data if nc > 1 else [data]
+        out = buf = None
+        for c, channel in enumerate(channels):
+            plan = self.warp_plan(channel.shape, meta, c)
+            if out is None:
+                shape = (nc,) + plan.output_shape if nc > 1 else plan.output_shape
+                out = np.empty(shape, dtype=data.dtype)
+            dest = out[c] if nc > 1 else out
+            if data.dtype == np.float32:
+                plan(channel, out=dest)
+            else:
+                if buf is None:
+                    buf = np.empty(plan.output_shape, dtype=np.float32)
+                plan(channel, out=buf)
+                dest[...] = np.rint(buf, out=buf)
+        return out
+
+    def process(self, data, meta):
+        return self.resample(data, meta), meta
+
+    def estimate_memory(self, shape, dtype, meta):
+        outshape = tuple(shape[:-3]) + self.index_tform(tuple(shape[-3:]), meta)[1]
+        peak = _nbytes(shape, dtype) + _nbytes(outshape, dtype)
+        if dtype != np.float32:
+            # one channel is interpolated in float32 at a time
+            peak += _nbytes(outshape[-3:], np.float32)
+        return peak, outshape, np.dtype(dtype)
+
+
+class _FusedGeometryProcessor(_GeometricProcessor):
+    """ Several geometric processors applied with a single interpolation
+
+    The index matrices of all steps are multiplied into one, so every volume is
+    resampled exactly once, without intermediate volumes.  Compared to running
+    the steps one after another this is faster, and sharper, since the
+    interpolation blur does not accumulate.  Resampling is done on the CPU and
+    keeps the dtype of the input.
+    """
+
+    verbose_name = "Fused Geometric Transforms"
+    processing_verb = "Transforming"
+
+    def __init__(self, steps):
+        super(_FusedGeometryProcessor, self).__init__()
+        if not all(isinstance(s, _GeometricProcessor) for s in steps):
+            raise self.ImgProcessorError("Can only fuse geometric processors")
+        self.steps = list(steps)
+
+    def index_tform(self, shape, meta, c=0):
+        M = np.eye(4)
+        for step in self.steps:
+            m, shape = step.index_tform(shape, meta, c)
+            M = M @ m
+        return M, shape
+
+    def setup_t(self, data, meta):
+        for step in self.steps:
+            step.setup_t(data, meta)
+
+    def teardown_t(self, data, meta):
+        for step in self.steps:
+            step.teardown_t(data, meta)
+
+    @classmethod
+    def fuse(cls, imps):
+        """ return list of imps with runs of 2 or more consecutive
+        geometric processors replaced by a _FusedGeometryProcessor """
+        fused = []
+        run = []
+        for imp in list(imps) + [None]:
+            if isinstance(imp, _GeometricProcessor):
+                run.append(imp)
+                continue
+            if len(run) > 1:
+                fused.append(cls(run))
+            else:
+                fused.extend(run)
+            run = []
+            if imp is not None:
+                fused.append(imp)
+        return fused
+
+
+class DeskewProcessor(_GeometricProcessor):
     """ Deskewing only, no deconvolution """
 
     verbose_name = "Deskew Only"
@@ -556,6 +841,12 @@ class DeskewProcessor(ImgProcessor):
         self.width = width
         self.shift = shift
 
+    def index_tform(self, shape, meta, c=0):
+        params = meta["params"]
+        return deskew_tform(
+            shape, params.dz, params.dx, params.deskew, self.width, self.shift
+        )
+
     @for_channel(False)
     def process(self, data, meta):
         dtype = data.dtype
@@ -570,28 +861,64 @@ class DeskewProcessor(ImgProcessor):
         return _data.astype(dtype), meta
 
 
-class AffineProcessor(ImgProcessor):
+class AffineProcessor(_GeometricProcessor):
     """ Perform Affine Transformation, e.g. for channel registration """
 
-    def __init__(self, reg_file=""):
+    verbose_name = "Channel Registration"
+    processing_verb = "Registering"
+
+    def __init__(self, reg_file="", ref_wave=None, mode="2step"):
+        super(AffineProcessor, self).__init__()
         if not os.path.isfile(reg_file):
             raise self.ImgProcessorError("reg_file cannot be blank")
+        try:
+            self.regfile = RegFile(reg_file)
+        except Exception as e:
+            raise self.ImgProcessorError("Error loading reg_file: {}".format(e))
+        self.ref_wave = ref_wave
+        self.mode = mode
+
+    def index_tform(self, shape, meta, c=0):
+        wave = meta["w"][c]
+        # without a reference wavelength, register to the first channel
+        ref_wave = meta["w"][0] if self.ref_wave is None else self.ref_wave
+        if str(wave) == str(ref_wave):
+            return np.eye(4), tuple(shape)
+        try:
+            tform = self.regfile.get_tform(wave, ref_wave, self.mode)
+        except RegistrationError as e:
+            raise self.ImgProcessorError(str(e))
+        params = meta["params"]
+        R = imref3d(shape, params.dx, params.dx, params.dzFinal)
+        return intrinsic_tform(tform, R, R), tuple(shape)
 
-    def process(self, data, meta):
-        return data, meta
+    @classmethod
+    def from_llsdir(cls, llsdir, **kwargs):
+        # fix the reference to the first channel of the dataset, so that it
+        # does not change when channels are processed separately
+        if kwargs.get("ref_wave") is None and any(llsdir.params.wavelengths):
+            kwargs["ref_wave"] = llsdir.params.wavelengths[0]
+        return cls(**kwargs)
 
 
 class RotateYProcessor(AffineProcessor):
     """ Subclass of affine processor, for simplified rotation of the image in Y """
 
     verbose_name = "Rotate to Coverslip"
+    processing_verb = "Rotating"
 
-    def __init__(self, angle):
-        pass
+    def __init__(self, angle=32.5, xzRatio=0.4253, reverse=False):
+        _GeometricProcessor.__init__(self)
+        self.angle = angle
+        self.xzRatio = xzRatio
+        self.reverse = reverse
+
+    def index_tform(self, shape, meta, c=0):
+        return rotate_y_tform(shape, self.angle, self.xzRatio, self.reverse)
 
     @for_channel(False)
     def process(self, data, meta):
-        d = rotateGPU(data, angle=32.5, xzRatio=0.4253, reverse=False)
+        d = rotateGPU(data, self.angle, self.xzRatio, self.reverse)
         return d, meta
 
     @classmethod
@@ -647,3 +974,38 @@ class RotateYProcessor(AffineProcessor):
 #         if file is None or file is '':
 #             return
 #     self.RegProcessPathLineEdit.setText(file)
+
+
+if __name__ == "__main__":
+    # compare fused vs. sequential resampling on the CPU:
+    # python -m mosaicpy.imgprocessors.imgprocessors
+    import time
+    from mosaicpy.llsdir import LLSParams
+
+    shape = (100, 256, 256)
+    zz, yy, xx = np.indices(shape, dtype=np.float32)
+    data = 100 + 50 * np.sin(zz / 3) * np.cos(yy / 4) + 30 * np.sin(xx / 5)
+    meta = {"c": [0], "w": [488], "params": LLSParams(dz=0.3, dx=0.1, angle=31.5)}
+    steps = [DeskewProcessor(), RotateYProcessor(angle=31.5)]
+    fused = _FusedGeometryProcessor(steps)
+    # compile the numba kernels before timing
+    _FusedGeometryProcessor(steps).resample(data[:8, :16, :16], meta)
+
+    t0 = time.time()
+    sequential = data
+    for step in steps:
+        sequential = step.resample(sequential, meta)
+    t1 = time.time()
+    once = fused.resample(data, meta)
+    t2 = time.time()
+    print("sequential: {:.3f} s, fused: {:.3f} s".format(t1 - t0, t2 - t1))
+
+    M, outshape = fused.index_tform(shape, meta)
+    src = np.tensordot(M[:3, :3], np.indices(outshape), 1) + M[:3, 3:, None, None]
+    inside = np.all([(s > 2) & (s < n - 3) for s, n in zip(src, shape)], 0)
+    inside &= sequential > 0
+    z, y, x = src
+    truth = 100 + 50 * np.sin(z / 3) * np.cos(y / 4) + 30 * np.sin(x / 5)
+    for name, result in (("sequential", sequential), ("fused", once)):
+        err = np.abs(result - truth)[inside]
+        print("{} error: mean {:.3f}, max {:.3f}".format(name, err.mean(), err.max()))
@@ -1,11 +1,14 @@
+import itertools
+import json
 import logging
 import numpy as np
 from datetime import datetime
 from pprint import pformat
 from collections import MutableMapping
 from tifffolder import TiffFolder
+from tifffolder.axesarray import AxesArray
 from .settingstxt import parse_settings
-from .util import mode1
+from .util import mode1, imread
 
 try:
     from pathlib import Path
@@ -110,8 +113,25 @@ class LLSParams(MutableMapping):
         return pformat(self._store)
 
 
+def _as_index(selection):
+    """ a slice for evenly spaced, increasing selections, so that indexing
+    returns a view instead of a copy """
+    selection = list(selection)
+    step = selection[1] - selection[0] if len(selection) > 1 else 1
+    if step > 0 and all(b - a == step for a, b in zip(selection, selection[1:])):
+        return slice(selection[0], selection[-1] + 1, step)
+    return selection
+
+
 class LLSFolder(TiffFolder):
-    """ Example class for handling lattice light sheet data """
+    """ Example class for handling lattice light sheet data
+
+    Raw LLS files are uncompressed 3D stacks, so by default asarray()
+    memory-maps them (see `mmap`) rather than reading every file in full.
+    """
+
+    # memory-map uncompressed stacks in asarray()
+    mmap = True
 
     patterns = [
         ("rel_t", "_{d7}msec"),
@@ -146,6 +166,47 @@ class LLSFolder(TiffFolder):
                 except Exception:
                     self.timeinfo = {}
 
+    def asarray(self, maxworkers=None, mmap=None, **kwargs):
+        """Read TIFF data as numpy array (see TiffFolder.asarray)
+
+        Args:
+            mmap (bool): memory-map the files copy-on-write (see util.imread),
+                instead of reading them.  A single stack is returned as a
+                view of the file, so that only the planes, rows and columns
+                used later are ever read from disk, and writing to it does
+                not change the file.  Several stacks are copied into one
+                array of their own dtype.  Defaults to self.mmap
+            **kwargs: axis selections, as in TiffFolder.asarray
+        """
+        mmap = self.mmap if mmap is None else mmap
+        if not (mmap and self._tiff3d and self._symmetrical):
+            return super(LLSFolder, self).asarray(maxworkers, **kwargs)
+
+        selections = self._get_axes_selections(**kwargs)
+        file_selections = [list(selections[ax]) for ax in self._file_array_axes]
+        stack_shape = tuple(self._shapedict[ax] for ax in "zyx")
+        stacks = []
+        for idx in itertools.product(*file_selections):
+            stack = imread(str(self._file_array[idx]), mmap=True)
+            if stack.shape != stack_shape:
+                # e.g. transposed XY, let TiffFolder sort it out
+                return super(LLSFolder, self).asarray(maxworkers, **kwargs)
+            for dim, ax in enumerate("zyx"):
+                if ax in selections:
+                    index = (slice(None),) * dim + (_as_index(selections[ax]),)
+                    stack = stack[index]
+            stacks.append(stack)
+
+        if len(stacks) == 1:
+            data = stacks[0]
+        else:
+            shape = tuple(len(s) for s in file_selections) + stacks[0].shape
+            data = np.empty(shape, dtype=stacks[0].dtype)
+            for n, stack in enumerate(stacks):
+                data.reshape((-1,) + stack.shape)[n] = stack
+        axes = "".join(ax for ax, sel in selections.items() if len(sel) > 1)
+        return AxesArray(np.squeeze(data), axes=axes)
+
     @property
     def coreparams(self):
         _D = {
@@ -192,3 +253,126 @@ class LLSdir(DataDir):
     def age(self):
         """Returns the age of the dataset in age"""
         return (datetime.now() - self.date).days
+
+
+class RegDir(LLSdir):
+    """LLSdir of fiducial beads (e.g. tetraspeck) imaged in every channel.
+
+    Beads are detected in the first timepoint of each channel with a
+    :class:`fiducialreg.fiducialreg.CloudSet`.  With cache_dir, detected clouds
+    are cached on disk (see FiducialCloud.from_cache), so that generating
+    registration files for other references or modes does not detect the
+    beads again.  Extra keyword arguments are passed to CloudSet.
+    """
+
+    def __init__(self, path, threshold=None, mincount=None, cache_dir=None, **kwargs):
+        super(RegDir, self).__init__(path)
+        kwargs.update(threshold=threshold, mincount=mincount, cache_dir=cache_dir)
+        self.cloud_kwargs = kwargs
+        self._cloudset = None
+
+    @property
+    def isValid(self):
+        """whether there are at least two channels to register"""
+        return self.params.nc > 1
+
+    @property
+    def waves(self):
+        return list(self.params.wavelengths)
+
+    def cloudset(self):
+        """Return the CloudSet of all channels, detecting beads on first call."""
+        if self._cloudset is None:
+            from fiducialreg.fiducialreg import CloudSet
+
+            if self.params.samplescan:
+                raise ValueError(
+                    "Registration folders must be acquired without sample scanning"
+                )
+            files = [
+                self.data.select_filenames(t=0, c=c)[0] for c in range(self.params.nc)
+            ]
+            self._cloudset = CloudSet(
+                files,
+                labels=self.waves,
+                dx=self.params.dx,
+                dz=self.params.dz,
+                **self.cloud_kwargs
+            )
+        return self._cloudset
+
+    def write_reg_file(self, outdir, refs=None, **kwargs):
+        """Write all registration transforms to a .reg file in outdir.
+
+        Args:
+            outdir (str): destination directory
+            refs (list): reference wavelengths, by default all channels
+            **kwargs: passed to CloudSet.get_all_tforms (e.g. modes, robust)
+
+        Returns:
+            tuple: (path of the file, its JSON content)
+        """
+        refs = self.waves if refs is None else list(refs)
+        tforms = self.cloudset().get_all_tforms(refs=refs, **kwargs)
+        for tform in tforms:
+            tform["tform"] = np.asarray(tform["tform"]).tolist()
+        outdict = {
+            "path": str(self.path),
+            "dx": self.params.dx,
+            "dz": self.params.dz,
+            "date": self.params.date.strftime("%Y/%m/%d-%H:%M"),
+            "tforms": tforms,
+        }
+        outstring = json.dumps(outdict, indent=2)
+        outfile = Path(outdir) / "{}_refs{}.reg".format(
+            self.path.name, "-".join(str(r) for r in refs)
+        )
+        with open(str(outfile), "w") as f:
+            f.write(outstring)
+        return str(outfile), outstring
+
+
+if __name__ == "__main__":
+    # compare memory-mapped and regular reads of an LLS folder:
+    # python -m mosaicpy.llsdir [folder]
+    # without a folder, a synthetic dataset is written to a temporary directory
+    # on the local disk.  Page-cache effects dominate on a second run, so drop
+    # the caches (or use a fresh folder) for cold numbers.
+    import sys
+    import tempfile
+    import time
+    import tifffile
+
+    if len(sys.argv) > 1:
+        folder = sys.argv[1]
+    else:
+        folder = tempfile.mkdtemp()
+        stack = np.random.RandomState(0).randint(90, 2000, (100, 512, 512))
+        for t in range(4):
+            for c, w in enumerate((488, 560)):
+                name = "cell_ch{}_stack{:04d}_{}nm_{:07d}msec_{:010d}msecAbs.tif"
+                tifffile.imwrite(
+                    "{}/{}".format(folder, name.format(c, t, w, t, t)),
+                    stack.astype(np.uint16),
+                )
+    data = LLSFolder(folder)
+
+    def timeit(label, func):
+        times = []
+        for t in range(data._shapedict["t"]):
+            t0 = time.time()
+            func(t)
+            times.append(time.time() - t0)
+        print("{:<36} {:.4f} s".format(label, np.median(times)))
+
+    for mmap in (False, True):
+        name = "mmap" if mmap else "read"
+        timeit(name + ", full timepoint", lambda t: data.asarray(t=t, mmap=mmap))
+        timeit(
+            name + ", full timepoint, summed",
+            lambda t: data.asarray(t=t, mmap=mmap).sum(),
+        )
+        timeit(
+            name + ", 5 planes of channel 0, summed",
+            lambda t: data.asarray(t=t, c=0, mmap=mmap)[40:45].sum(),
+        )
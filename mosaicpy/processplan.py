@@ -1,5 +1,11 @@
+import logging
+import numpy as np
 from mosaicpy.imgprocessors import ImgProcessor, ImgWriter
+from mosaicpy.imgprocessors.imgprocessors import _FusedGeometryProcessor
 from mosaicpy.llsdir import LLSdir
+from mosaicpy.util import available_memory, format_size
+
+logger = logging.getLogger(__name__)
 
 
 class ProcessPlan(object):
@@ -18,9 +24,25 @@ class ProcessPlan(object):
             4. (bool, optional) - Whether the ImgProcessor is collapsed in the GUI
         t_range (list): a list of timepoints to process.  Defaults to all timepoints
         c_range (list): a list of channels to process.  Defaults to all channels
+        fuse_geometry (bool): replace consecutive geometric processors (deskew,
+            affine, rotation) with a single _FusedGeometryProcessor, so that each
+            volume is only interpolated once.  Defaults to False
+        memory_budget (int): maximum memory (bytes) that processing a single
+            timepoint should use.  If the estimated peak exceeds it, plan()
+            warns, and channels are processed one at a time when possible.
+            Defaults to the physical memory available when the plan is
+            created.  Set to 0 to disable.
     """
 
-    def __init__(self, llsdir, imps=[], t_range=None, c_range=None):
+    def __init__(
+        self,
+        llsdir,
+        imps=[],
+        t_range=None,
+        c_range=None,
+        fuse_geometry=False,
+        memory_budget=None,
+    ):
         if not isinstance(llsdir, LLSdir):
             raise ValueError("First argument to ProcessPlan must be an LLSdir")
         assert isinstance(imps, (list, tuple)), (
@@ -35,6 +57,11 @@ class ProcessPlan(object):
         self.imp_classes = imps
         self.t_range = t_range or list(range(llsdir.params.nt))
         self.c_range = c_range or list(range(llsdir.params.nc))
+        self.fuse_geometry = fuse_geometry
+        if memory_budget is None:
+            memory_budget = available_memory()
+        self.memory_budget = memory_budget or 0
+        self.split_channels = False
         self.aborted = False
         self.meta = None
 
@@ -46,7 +73,7 @@ class ProcessPlan(object):
         # sanity checkes go here...
         warnings = []
         writers = [
-            issubclass(imp, ImgWriter) for imp, p, act, _ in self.imp_classes if act
+            issubclass(imp, ImgWriter) for imp, p, act, *_ in self.imp_classes if act
         ]
         if not any(writers):
             warnings.append("No Image writer/output detected.")
@@ -56,27 +83,114 @@ class ProcessPlan(object):
             idx_of_last_writer = False
         if idx_of_last_writer:
             warnings.append("You have image processors after the last Writer")
+        warnings.extend(self.memory_warnings())
 
         if warnings:
             raise self.PlanWarning("\n".join(warnings))
 
+    def memory_warnings(self):
+        """Return a list of warnings if the plan does not fit the memory budget."""
+        if not (self.ready and self.memory_budget):
+            return []
+        peak = self.peak_memory()
+        if peak <= self.memory_budget:
+            return []
+        if self.split_channels:
+            channel_peak = max(self.peak_memory([c]) for c in self.c_range)
+            if channel_peak <= self.memory_budget:
+                return []
+            msg = (
+                "Processing channels one at a time needs about {} per timepoint, "
+                "the budget is {}.".format(
+                    format_size(channel_peak), format_size(self.memory_budget)
+                )
+            )
+        else:
+            msg = "Processing needs about {} per timepoint, the budget is {}.".format(
+                format_size(peak), format_size(self.memory_budget)
+            )
+        msg += " Processing may run out of memory."
+        return [msg]
+
+    def estimate_memory(self, c_range=None):
+        """Estimate the peak memory used by each imp for one timepoint.
+
+        Args:
+            c_range (list): channels processed together.  Defaults to self.c_range
+
+        Returns:
+            list: peak bytes for each imp in self.imps, including the raw
+                timepoint that is held for the duration of the chain
+        """
+        c_range = self.c_range if c_range is None else list(c_range)
+        params = self.llsdir.params
+        shape = (params.nz, params.ny, params.nx)
+        if len(c_range) > 1:
+            shape = (len(c_range),) + shape
+        dtype = np.dtype(getattr(self.llsdir.data, "dtype", np.uint16))
+        raw = int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+        meta = dict(
+            self.meta or {},
+            c=c_range,
+            nc=len(c_range),
+            w=[params.wavelengths[i] for i in c_range],
+            params=params,
+        )
+        peaks = []
+        for n, imp in enumerate(self.imps):
+            held = raw if n else 0
+            cast = imp.input_dtype(dtype)
+            if cast != dtype:
+                # the uncast input is held while the imp runs
+                held += int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+                dtype = cast
+            try:
+                peak, shape, dtype = imp.estimate_memory(shape, dtype, meta)
+            except Exception as e:
+                logger.debug("memory estimate failed for {}: {}".format(imp, e))
+                peak, shape, dtype = ImgProcessor.estimate_memory(
+                    imp, shape, dtype, meta
+                )
+            peaks.append(peak + held)
+        return peaks
+
+    def dtypes(self):
+        """Return the (input, output) dtype of each imp in the plan.
+
+        Each imp casts its input to the narrowest dtype it accepts (see
+        ImgProcessor.input_dtype), so that data stays uint16 or float32 where
+        possible.
+        """
+        dtype = np.dtype(getattr(self.llsdir.data, "dtype", np.uint16))
+        chain = []
+        for imp in self.imps:
+            dtype = imp.input_dtype(dtype)
+            chain.append((dtype, imp.output_dtype(dtype)))
+            dtype = chain[-1][1]
+        return chain
+
+    def peak_memory(self, c_range=None):
+        """Estimated peak memory (bytes) of processing one timepoint."""
+        return max(self.estimate_memory(c_range), default=0)
+
     def plan(self, skip_warnings=False):
         """This actually instantiates the ImgProcessors (but does not run them).
 
-        Unless explicitly skipped, it runs check_sanity() to look for potential
-        problems in the plan.  Then in instantiates all active image processors,
-        by calling the ImgProcessor.from_llsdir() class method.
-
-        It also creates the self.meta object that will be passed through the processing
-        chain.
+        It instantiates all active image processors, by calling the
+        ImgProcessor.from_llsdir() class method, and creates the self.meta object
+        that will be passed through the processing chain.  If the plan exceeds
+        the memory budget, channels are processed separately where possible.
+        Unless explicitly skipped, it then runs check_sanity() to look for
+        potential problems in the plan.  The imps are kept when check_sanity()
+        fails, so that a following plan(skip_warnings=True) does not
+        instantiate them again.
 
         Raises:
             self.PlanWarning: if check_sanity() fails
             self.PlanError: if ImgProcessor instantiation fails
         """
-        if not skip_warnings:
-            self.check_sanity()
-
+        if skip_warnings and self.ready:
+            return
         errors = []
         self.imps = []  # will hold instantiated imps
         for imp_tup in self.imp_classes:
@@ -102,6 +216,8 @@ class ProcessPlan(object):
                 )
                 + "\n\n".join(errors)
             )
+        if self.fuse_geometry:
+            self.imps = _FusedGeometryProcessor.fuse(self.imps)
         self.meta = {
             "c": self.c_range,
             "nc": len(self.c_range),
@@ -112,6 +228,20 @@ class ProcessPlan(object):
             "axes": None,
         }
 
+        self.split_channels = bool(
+            self.memory_budget
+            and len(self.c_range) > 1
+            and all(imp.channel_independent for imp in self.imps)
+            and self.peak_memory() > self.memory_budget
+        )
+        if self.split_channels:
+            logger.info(
+                "Plan for {} exceeds the memory budget, processing channels "
+                "one at a time".format(self.llsdir.path.name)
+            )
+        if not skip_warnings:
+            self.check_sanity()
+
     def setup_t(self, data):
         """Called before all ImgProcs, at every timepoint."""
         for n, imp in enumerate(self.imps):
@@ -133,17 +263,44 @@ class ProcessPlan(object):
         for t in self.t_range:
             if self.aborted:
                 break
-            data = self.llsdir.data.asarray(t=t, c=self.c_range)
-            self.meta["t"] = t
-            self.meta["axes"] = data.axes
-            self.setup_t(data)
-            try:
-                yield self._execute_t(data)
-            finally:
-                self.teardown_t(data)
-
-    def _execute_t(self, data):
-        return self._iterimps(data)
+            yield self._execute_t(t)
+
+    def _execute_t(self, t):
+        self.meta["t"] = t
+        if self.split_channels:
+            return self._execute_channels(t)
+        return self._execute_block(t, self.c_range)
+
+    def _execute_block(self, t, c_range):
+        # the raw data is only referenced here, so that it is released before
+        # the next timepoint is read
+        data = self.llsdir.data.asarray(t=t, c=c_range)
+        self.meta["axes"] = data.axes
+        self.setup_t(data)
+        try:
+            return self._iterimps(data)
+        finally:
+            self.teardown_t(data)
+
+    def _execute_channels(self, t):
+        """process the channels of timepoint t one at a time"""
+        meta = self.meta
+        results = []
+        try:
+            for i, c in enumerate(self.c_range):
+                self.meta = dict(meta, c=[c], nc=1, w=[meta["w"][i]])
+                result = self._execute_block(t, [c])
+                results.append(result[0] if result else None)
+                if self.aborted:
+                    break
+        finally:
+            chan_meta, self.meta = self.meta, meta
+            for key, value in chan_meta.items():
+                self.meta.setdefault(key, value)
+            self.meta["has_background"] = chan_meta["has_background"]
+        if any(r is None for r in results) or len(results) < len(self.c_range):
+            return None
+        return np.stack(results), self.meta
 
     def _iterimps(self, data):
         for n, imp in enumerate(self.imps):
@@ -194,4 +351,6 @@ class PreviewPlan(ProcessPlan):
 
     def check_sanity(self):
         # overwriting parent method that looks for writers
-        pass
+        warnings = self.memory_warnings()
+        if warnings:
+            raise self.PlanWarning("\n".join(warnings))
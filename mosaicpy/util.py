@@ -75,9 +75,37 @@ def find_filepattern(path, filepattern="*.tar*"):
     return None
 
 
-def imread(*args, **kwargs):
+def get_cache_dir(*subdirs):
+    """Return (and create if necessary) a per-user cache directory.
+
+    The location may be overridden with the MOSAICPY_CACHE_DIR environment
+    variable.  Optional ``subdirs`` are joined onto the cache directory.
+    """
+    base = os.environ.get("MOSAICPY_CACHE_DIR")
+    if not base:
+        from appdirs import user_cache_dir
+
+        base = user_cache_dir("MOSAICpy")
+    path = os.path.join(base, *subdirs)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def imread(*args, mmap=False, **kwargs):
+    """Read a TIFF file with tifffile.imread.
+
+    With mmap=True, uncompressed contiguous files are memory-mapped
+    copy-on-write instead of read: pages are only loaded from disk when they
+    are accessed, and writing to the array never changes the file.  Files
+    that cannot be mapped are read normally.
+    """
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
+        if mmap:
+            try:
+                return tifffile.memmap(*args, mode="c", **kwargs)
+            except ValueError:
+                pass
         return tifffile.imread(*args, **kwargs)
 
 
@@ -126,6 +154,28 @@ def format_size(size):
         size /= 1024.0
 
 
+def available_memory():
+    """Return the physical memory currently available in bytes, or None."""
+    try:
+        import psutil
+
+        return psutil.virtual_memory().available
+    except ImportError:
+        pass
+    # SC_AVPHYS_PAGES is only MemFree, which excludes reclaimable page cache
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
 def is_exe(fpath):
     return os.path.isfile(fpath) and os.access(fpath, os.X_OK)
 
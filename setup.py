@@ -97,6 +97,7 @@ setup(
         'spimagine',
         'gputools',
         'raven',
+        'appdirs',
     ],
     entry_points={
             'console_scripts': [
@@ -0,0 +1,259 @@
+import numpy as np
+import pytest
+from mosaicpy import camcalib
+
+
+def _synthetic_series(shape=(200, 6, 7), seed=0):
+    rs = np.random.RandomState(seed)
+    nobs, ny, nx = shape
+    a = rs.uniform(20, 400, (ny, nx))
+    b = rs.uniform(0.0005, 0.008, (ny, nx))
+    x = rs.uniform(0, 3000, shape)
+    y = a * (1 - np.exp(-b * x)) + rs.normal(0, 5, shape)
+    return x, y
+
+
+def test_parallel_fit_matches_per_pixel_fit():
+    x, y = _synthetic_series()
+    progress = []
+    result = camcalib.parallel_fit(x, y, callback=progress.append, blocksize=10)
+    assert result.shape == (2,) + x.shape[1:]
+    assert sum(progress) == x.shape[1] * x.shape[2]
+    for i in range(x.shape[1]):
+        for j in range(x.shape[2]):
+            expected = camcalib.fitstickypixel(x[:, i, j], y[:, i, j], i, j)[0]
+            np.testing.assert_allclose(result[:, i, j], expected, rtol=1e-4)
+
+
+def test_fit_block_respects_bounds():
+    x, y = _synthetic_series((50, 1, 4))
+    y = y[:, 0] * 10  # plateau far above the upper bound of a
+    result = camcalib.fit_block(x[:, 0], y)
+    (amin, bmin), (amax, bmax) = camcalib.BOUNDS
+    assert np.all((result[0] >= amin) & (result[0] <= amax))
+    assert np.all((result[1] >= bmin) & (result[1] <= bmax))
+
+
+def test_process_dark_images_matches_full_stack(tmp_path):
+    import threading
+    import tifffile
+
+    rs = np.random.RandomState(0)
+    stacks = [rs.poisson(100, (n, 9, 11)).astype(np.uint16) for n in (5, 3, 7, 4)]
+    for i, stack in enumerate(stacks):
+        tifffile.imwrite(
+            str(tmp_path / "dark_{:02d}.tif".format(i)), stack, photometric="minisblack"
+        )
+    full = np.concatenate(stacks)
+
+    for workers in (1, 3):
+        progress = []
+        darkavg, darkstd = camcalib.process_dark_images(
+            str(tmp_path), callback=progress.append, workers=workers
+        )
+        assert sum(progress) == len(stacks)
+        np.testing.assert_allclose(darkavg, full.mean(0), rtol=1e-12)
+        np.testing.assert_allclose(darkstd, full.std(0), rtol=1e-10)
+
+    # cancelling stops reading files
+    cancel = threading.Event()
+    progress = []
+
+    def callback(n):
+        progress.append(n)
+        cancel.set()  # as if abort was pressed while reading the first file
+
+    out = camcalib.process_dark_images(str(tmp_path), callback, cancel=cancel)
+    assert out == (None, None)
+    assert sum(progress) == 1
+
+
+def test_iter_bright_tiles(tmp_path):
+    import tifffile
+
+    rs = np.random.RandomState(0)
+    darkavg = rs.uniform(90, 110, (10, 12))
+    ch0, ch1 = [], []
+    for i in range(3):
+        for c, lst in ((0, ch0), (1, ch1)):
+            path = str(tmp_path / "cal_ch{}_stack{:04d}.tif".format(c, i))
+            # exercise both the memmap and the page-by-page code paths
+            compression = "zlib" if i == 1 else None
+            data = rs.poisson(200, (4, 10, 12)).astype(np.uint16)
+            tifffile.imwrite(
+                path, data, compression=compression, photometric="minisblack"
+            )
+            lst.append(path)
+    assert camcalib.get_channel_list(str(tmp_path)) == (ch0, ch1)
+
+    pre, post = camcalib.combine_stacks(ch0, ch1, darkavg)
+    assert pre.dtype == np.float32 and pre.shape == (12, 10, 12)
+    expected = np.concatenate([tifffile.imread(f) for f in ch0]) - darkavg
+    np.testing.assert_allclose(pre, expected, rtol=1e-6)
+
+    tiles = list(camcalib.iter_bright_tiles(ch0, ch1, darkavg, tile_rows=3))
+    assert len(tiles) == 4
+    np.testing.assert_array_equal(np.concatenate([t[1] for t in tiles], 1), pre)
+    np.testing.assert_array_equal(np.concatenate([t[2] for t in tiles], 1), post)
+
+
+def _bright_folder(path):
+    import tifffile
+
+    rs = np.random.RandomState(0)
+    for i in range(4):
+        for c in (0, 1):
+            fname = str(path / "cal_ch{}_stack{:04d}.tif".format(c, i))
+            data = rs.poisson(100 + 300 * i, (5, 8, 6)).astype(np.uint16)
+            tifffile.imwrite(fname, data, photometric="minisblack")
+    return np.full((8, 6), 100.0), np.ones((8, 6))
+
+
+def test_process_bright_images_resumes(tmp_path, monkeypatch):
+    darkavg, darkstd = _bright_folder(tmp_path)
+
+    expected = camcalib.process_bright_images(
+        str(tmp_path), darkavg, darkstd, save=False, tile_rows=3
+    )[1]
+    assert not (tmp_path / "camcalib_checkpoint").exists()
+
+    # interrupt the calibration after the first tile
+    real_fit = camcalib.parallel_fit
+    calls = []
+
+    def failing_fit(*args, **kwargs):
+        if calls:
+            raise KeyboardInterrupt
+        calls.append(1)
+        return real_fit(*args, **kwargs)
+
+    monkeypatch.setattr(camcalib, "parallel_fit", failing_fit)
+    with pytest.raises(KeyboardInterrupt):
+        camcalib.process_bright_images(
+            str(tmp_path), darkavg, darkstd, save=False, tile_rows=3
+        )
+    assert len(list((tmp_path / "camcalib_checkpoint").glob("tile_*.npy"))) == 1
+
+    # resume: only the remaining two tiles are fit
+    fitted = []
+
+    def counting_fit(pre, post, callback=None):
+        fitted.append(pre.shape[1])
+        return real_fit(pre, post, callback)
+
+    monkeypatch.setattr(camcalib, "parallel_fit", counting_fit)
+    progress = []
+    result = camcalib.process_bright_images(
+        str(tmp_path), darkavg, darkstd, progress.append, save=False, tile_rows=3
+    )[1]
+    assert fitted == [3, 2]
+    assert sum(progress) == 8 * 6
+    np.testing.assert_array_equal(result, expected)
+
+
+def test_process_bright_images_cancel(tmp_path, monkeypatch):
+    import threading
+
+    darkavg, darkstd = _bright_folder(tmp_path)
+    cancel = threading.Event()
+    real_fit = camcalib.parallel_fit
+
+    def cancelling_fit(*args, **kwargs):
+        cancel.set()  # as if abort was pressed during the first tile
+        return real_fit(*args, **kwargs)
+
+    monkeypatch.setattr(camcalib, "parallel_fit", cancelling_fit)
+    out = camcalib.process_bright_images(
+        str(tmp_path), darkavg, darkstd, tile_rows=3, cancel=cancel
+    )
+    assert out == (None, None)
+    assert not list(tmp_path.glob("FlashParam*.tif"))
+    # the finished tile is kept so that the next run resumes
+    assert len(list((tmp_path / "camcalib_checkpoint").glob("tile_*.npy"))) == 1
+
+
+def test_throttled_callback():
+    received = []
+    throttled = camcalib.ThrottledCallback(received.append, interval=60)
+    for _ in range(1000):
+        throttled(5)
+    throttled.flush()
+    assert sum(received) == 5000
+    assert len(received) <= 2
+
+
+def test_calibrate_roi_matches_cropped_full_chip(tmp_path):
+    import tifffile
+    from mosaicpy.camera import CameraParameters, roi_slices
+
+    fullroi, roi = [1, 1, 8, 6], [3, 2, 6, 6]
+    rs = np.random.RandomState(0)
+    for i in range(3):
+        data = rs.poisson(100, (5, 8, 6)).astype(np.uint16)
+        tifffile.imwrite(
+            str(tmp_path / "dark_{:02d}.tif".format(i)), data, photometric="minisblack"
+        )
+    for i in range(4):
+        for c in (0, 1):
+            path = str(tmp_path / "cal_ch{}_stack{:04d}.tif".format(c, i))
+            data = rs.poisson(100 + 300 * i, (5, 8, 6)).astype(np.uint16)
+            tifffile.imwrite(path, data, photometric="minisblack")
+
+    assert roi_slices(fullroi, fullroi, (8, 6)) == (slice(0, 8), slice(0, 6))
+    darkavg, darkstd = camcalib.process_dark_images(str(tmp_path))
+    full = camcalib.process_bright_images(str(tmp_path), darkavg, darkstd, save=False)
+    expected = CameraParameters(data=np.squeeze(full[1]), roi=fullroi).get_subroi(roi)
+
+    (_, result), = camcalib.process_rois(
+        str(tmp_path), [roi], save=False, fullroi=fullroi
+    )
+    result = np.squeeze(result)
+    assert result.shape == (4, 4, 5)
+    np.testing.assert_allclose(result, expected.data, rtol=1e-4)
+
+    with pytest.raises(ValueError):
+        camcalib.process_dark_images(str(tmp_path), roi=[0, 0, 4, 4], fullroi=fullroi)
+
+
+def test_process_rois_resumes(tmp_path, monkeypatch):
+    import threading
+    import tifffile
+
+    fullroi, rois = [1, 1, 8, 6], [[1, 1, 4, 6], [5, 1, 8, 6]]
+    rs = np.random.RandomState(0)
+    for i in range(3):
+        data = rs.poisson(100, (5, 8, 6)).astype(np.uint16)
+        tifffile.imwrite(
+            str(tmp_path / "dark_{:02d}.tif".format(i)), data, photometric="minisblack"
+        )
+    _bright_folder(tmp_path)
+    (_, expected), = camcalib.process_rois(
+        str(tmp_path), rois[1:], save=False, fullroi=fullroi, tile_rows=2
+    )
+
+    # cancel after the first tile of the second ROI
+    cancel = threading.Event()
+    real_fit = camcalib.parallel_fit
+    fitted = []
+
+    def counting_fit(*args, **kwargs):
+        fitted.append(1)
+        if len(fitted) == 3:
+            cancel.set()
+        return real_fit(*args, **kwargs)
+
+    monkeypatch.setattr(camcalib, "parallel_fit", counting_fit)
+    kwargs = dict(fullroi=fullroi, tile_rows=2)
+    output = camcalib.process_rois(str(tmp_path), rois, cancel=cancel, **kwargs)
+    assert output[0][0] == camcalib.find_calibration(str(tmp_path), rois[0])
+    assert output[1] == (None, None)
+    assert not camcalib.find_calibration(str(tmp_path), rois[1])
+
+    # resume: the first ROI is done, only one tile of the second is left
+    fitted.clear()
+    output = camcalib.process_rois(str(tmp_path), rois, **kwargs)
+    assert len(fitted) == 1
+    assert output[0][1] is None
+    np.testing.assert_allclose(output[1][1], expected, rtol=1e-6)
+    assert camcalib.find_calibration(str(tmp_path), rois[1]) == output[1][0]
+    assert not (tmp_path / "camcalib_checkpoint").exists()
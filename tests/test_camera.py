@@ -0,0 +1,98 @@
+import numpy as np
+import pytest
+from mosaicpy.camera import calc_correction, _calc_correction_serial
+
+
+@pytest.fixture
+def flash_data():
+    rs = np.random.RandomState(0)
+    shape = (12, 32, 48)
+    stack = rs.poisson(200, size=shape).astype(np.uint16)
+    a = rs.uniform(0, 200, size=shape[1:]).astype(np.float32)
+    b = rs.uniform(0, 0.005, size=shape[1:]).astype(np.float32)
+    offset = rs.uniform(90, 110, size=shape[1:]).astype(np.float32)
+    return stack, a, b, offset
+
+
+def test_calc_correction_matches_serial(flash_data):
+    ref = _calc_correction_serial(*flash_data)
+    res = calc_correction(*flash_data)
+    assert res.dtype == ref.dtype
+    assert np.abs(res.astype(int) - ref.astype(int)).max() <= 1
+
+
+def test_calc_correction_inplace(flash_data):
+    stack, a, b, offset = flash_data
+    expected = calc_correction(stack, a, b, offset)
+    buf = stack.copy()
+    res = calc_correction(buf, a, b, offset, out=buf)
+    assert res is buf
+    np.testing.assert_array_equal(res, expected)
+
+
+def test_calc_correction_float_out(flash_data):
+    stack = flash_data[0]
+    out = np.empty(stack.shape, np.float32)
+    res = calc_correction(*flash_data, out=out)
+    assert res is out
+    assert res.min() >= 0
+
+
+def test_median_filter_cpu():
+    from scipy.ndimage import median_filter
+    from mosaicpy.camera import median_filter_cpu
+
+    im = np.random.RandomState(0).poisson(100, (4, 30, 40)).astype(np.float32)
+    expected = median_filter(im, size=(1, 3, 3))
+    result = median_filter_cpu(im, 3)
+    np.testing.assert_array_equal(result[:, 1:-1, 1:-1], expected[:, 1:-1, 1:-1])
+    # edges are left untouched
+    np.testing.assert_array_equal(result[:, 0], im[:, 0])
+    np.testing.assert_array_equal(median_filter_cpu(im[0], 3), result[0])
+
+
+def test_determine_threshold_matches_sorted_knee():
+    from mosaicpy.camera import determineThreshold
+
+    x = np.random.RandomState(0).exponential(3, 100000)
+    srt = np.sort(x)
+    line = np.linspace(srt[0], srt[-1], len(srt))
+    expected = srt[np.argmax(np.abs(srt - line))]
+    bin_width = (x.max() - x.min()) / 50000
+    assert abs(determineThreshold(x) - expected) <= bin_width
+
+
+def test_selective_median_cpu_corrects_hot_pixel():
+    from mosaicpy.camera import selectiveMedianFilter
+
+    stack = np.random.RandomState(0).poisson(100, (20, 64, 64)).astype(np.uint16)
+    stack[:, 10, 10] = 5000
+    out, _ = selectiveMedianFilter(stack, 0, with_mean=True, target="cpu")
+    assert out.dtype == stack.dtype
+    assert out[:, 10, 10].max() < 1000
+
+
+def test_camera_parameters_from_cache(tmp_path, monkeypatch):
+    import tifffile
+    from mosaicpy.camera import CameraParameters
+
+    monkeypatch.setenv("MOSAICPY_CACHE_DIR", str(tmp_path / "cache"))
+    rs = np.random.RandomState(0)
+    data = rs.uniform(0, 1, (3, 64, 48)).astype(np.float32)
+    data[2] += 100
+    path = str(tmp_path / "FlashParam_roi1-1-64-48.tif")
+    tifffile.imwrite(path, data)
+
+    subroi = (11, 5, 50, 30)
+    full = CameraParameters(path)
+    expected = full.get_subroi(subroi)
+    assert expected.data.flags.c_contiguous
+    assert not np.shares_memory(expected.data, full.data)
+    first = CameraParameters.from_cache(path, subroi)
+    second = CameraParameters.from_cache(path, subroi)
+    np.testing.assert_array_equal(first.data, expected.data)
+    np.testing.assert_array_equal(second.data, expected.data)
+    assert len(list((tmp_path / "cache" / "camparams").iterdir())) == 1
+    # cached parameters are a read-only memory map
+    assert not second.data.flags.writeable
+    assert second.data.flags.c_contiguous
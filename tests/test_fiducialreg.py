@@ -0,0 +1,330 @@
+import numpy as np
+import pytest
+from fiducialreg import fiducialreg as fr
+
+
+def _clouds(n=300, seed=0):
+    rs = np.random.RandomState(seed)
+    pc1 = rs.uniform(0, 1, (3, n)) * np.array([[200], [200], [40]])
+    pc2 = pc1 + rs.normal(0.5, 0.1, pc1.shape)
+    # unmatched beads in each channel
+    pc1 = np.hstack((pc1, rs.uniform(0, 200, (3, 20))))
+    pc2 = np.hstack((pc2, rs.uniform(0, 200, (3, 15))))
+    return pc1, pc2[:, rs.permutation(pc2.shape[1])]
+
+
+def test_closest_points_match_brute_force():
+    pc1, pc2 = _clouds()
+    expected = fr._get_closest_points_brute(pc1, pc2)
+    result = fr.get_closest_points(pc1, pc2)
+    assert [i for _, i in result] == [i for _, i in expected]
+    np.testing.assert_array_equal([d for d, _ in result], [d for d, _ in expected])
+
+
+def test_get_matching_points_rejects_unpaired():
+    pc1, pc2 = _clouds()
+    good1, good2 = fr.get_matching_points(pc1, pc2)
+    assert good1.shape == good2.shape
+    assert 280 <= good1.shape[1] <= 320
+    assert np.all(np.abs(good2 - good1 - 0.5).max(0) < 1)
+
+
+def test_fit_batch_matches_single_fits():
+    im, centers = fr._synthetic_beads(30, shape=(30, 96, 96))
+    cloud = fr.FiducialCloud(im, dx=0.1, dz=0.3, filtertype="log", threshold=5)
+    assert len(cloud.fits) >= cloud.count >= 25
+    fitter = fr.GaussFitter3D(im, dx=0.1, dz=0.3)
+    for batch in cloud.fits:
+        if not batch.resultCode:
+            continue  # too small to fit
+        single = fitter[batch.slicekey]
+        if single.success and batch.success and single.A() > 0:
+            np.testing.assert_allclose(
+                batch.fitResults[1:4], single.fitResults[1:4], atol=1e-3
+            )
+            assert np.isclose(batch.residual, single.residual, rtol=1e-3)
+    # every true bead is localized to within a fraction of a pixel
+    found = cloud.coords[::-1].T
+    dist = np.sqrt(((centers[:, None] - found[None]) ** 2).sum(-1)).min(1)
+    assert np.median(dist) < 0.2
+
+
+def test_fit_batch_isolates_bad_rois(monkeypatch):
+    im, _ = fr._synthetic_beads(10, shape=(20, 64, 64), seed=2)
+    cloud = fr.FiducialCloud(im, dx=0.1, dz=0.3, filtertype="log", threshold=5)
+    keys = [F.slicekey for F in cloud.fits if F.success]
+    # an empty roi cannot even be prepared
+    empty = (slice(0, 0), slice(0, 5), slice(0, 5))
+    fitter = fr.GaussFitter3D(im, dx=0.1, dz=0.3)
+    expected = fitter.fit_batch(keys)
+
+    real_fit = fr.fit_gauss3d_batch
+
+    def fragile_fit(rois, *args, **kwargs):
+        # as if one roi in every batch breaks the vectorized solver
+        if len(rois) > 1:
+            raise FloatingPointError
+        return real_fit(rois, *args, **kwargs)
+
+    monkeypatch.setattr(fr, "fit_gauss3d_batch", fragile_fit)
+    results = fitter.fit_batch([empty] + keys)
+    assert len(results) == len(keys) + 1
+    assert not results[0].success and results[0].slicekey == empty
+    for F, E in zip(results[1:], expected):
+        assert F.success
+        np.testing.assert_allclose(F.fitResults, E.fitResults, rtol=1e-6)
+
+    # fits that hit maxiter are not used as bead coordinates
+    monkeypatch.setattr(fr, "fit_gauss3d_batch", real_fit)
+    fit_batch = fr.GaussFitter3D.fit_batch
+    monkeypatch.setattr(
+        fr.GaussFitter3D, "fit_batch", lambda self, k: fit_batch(self, k, maxiter=1)
+    )
+    cloud.update_coords()
+    assert 5 in {F.resultCode for F in cloud.fits}
+    assert cloud.count == 0
+
+
+def test_object_counts_match_label():
+    from scipy import ndimage
+
+    rs = np.random.RandomState(0)
+    for _ in range(10):
+        im = ndimage.gaussian_filter(rs.rand(*rs.randint(1, 50, 2)), rs.uniform(0, 3))
+        thresholds = rs.permutation(np.linspace(im.min(), im.max(), 30))
+        expected = [ndimage.label(im > t)[1] for t in thresholds]
+        np.testing.assert_array_equal(fr.object_counts(im, thresholds), expected)
+
+
+def test_get_thresh_unchanged():
+    from scipy import ndimage
+
+    im, _ = fr._synthetic_beads(60, shape=(20, 128, 128))
+    filtered = fr.log_filter(im)
+    # threshold chosen by the original implementation
+    mip = filtered.max(0)
+    threshrange = np.linspace(mip.min(), mip.max(), 100)
+    object_count = np.array([ndimage.label(mip > t)[1] for t in threshrange])
+    values, freq = np.unique(object_count[object_count >= 20], return_counts=True)
+    modecount = values[np.argmax(freq)]
+    expected = threshrange[np.argmax(object_count == modecount)]
+
+    assert fr.get_thresh(filtered, 20) == (expected, modecount)
+    cloud = fr.FiducialCloud(filtertype="log")
+    cloud.filtered = filtered
+    assert cloud.autothresh(20) == expected
+
+    # the cached object counts follow a new filtered volume
+    cloud.filtered = filtered[:, :64]
+    assert cloud.autothresh(20) == fr.get_thresh(filtered[:, :64], 20)[0]
+    counts = cloud.threshold_counts
+    assert cloud.threshold_counts is counts
+    cloud.filtered = filtered
+    assert cloud.autothresh(20) == expected
+
+
+def test_blocked_cpd_estep_matches_dense():
+    rs = np.random.RandomState(0)
+    X = rs.uniform(0, 50, (40, 3))
+    Y = X[:35] + rs.normal(0, 0.5, (35, 3))
+    reg = fr.CPDaffine(X, Y, blocksize=6)
+    reg.initialize()
+    diff = Y[:, None] - X[None]
+    assert np.isclose(reg.sigma2, (diff ** 2).sum() / (3 * 35 * 40))
+    reg.EStep()
+    P = np.exp(-(diff ** 2).sum(-1) / (2 * reg.sigma2))
+    P /= P.sum(0)
+    np.testing.assert_allclose(reg.P1, P.sum(1))
+    np.testing.assert_allclose(reg.Pt1, P.sum(0))
+    np.testing.assert_allclose(reg.PX, P @ X)
+
+
+def test_cpd_recovers_transform():
+    rs = np.random.RandomState(1)
+    X = rs.uniform(0, 50, (150, 3))
+    th = 0.05
+    R = np.array([[np.cos(th), -np.sin(th), 0], [np.sin(th), np.cos(th), 0], [0, 0, 1]])
+    idx = rs.permutation(len(X))[:130]
+    Y = (X[idx] - 1.5) @ R.T * 1.02
+    for cls in (fr.CPDrigid, fr.CPDsimilarity, fr.CPDaffine):
+        matrix = cls(X, Y).register(None)[-1]
+        blocked = cls(X, Y, blocksize=7).register(None)[-1]
+        np.testing.assert_allclose(blocked, matrix, atol=1e-10)
+        if cls is not fr.CPDrigid:
+            # the registered Y lands on the corresponding points of X
+            TY = Y @ matrix[:3, :3].T + matrix[:3, 3]
+            assert np.abs(TY - X[idx]).max() < 1
+
+
+def test_block_filters_match_scipy():
+    from scipy import ndimage
+
+    im = np.random.RandomState(3).rand(30, 90, 70) * 1000
+    expected = -ndimage.gaussian_laplace(im.astype("f"), (2.5, 1, 1))
+    expected *= expected > 0
+    for workers in (1, 4):
+        result = fr.log_filter(im, 1, 2.5, workers=workers)
+        assert result.dtype == np.float32
+        np.testing.assert_allclose(result, expected, rtol=1e-5, atol=1e-3)
+
+    expected = ndimage.gaussian_filter(im.astype("f"), (5, 2, 2), mode="constant")
+    result = fr.blur_filter(im, 2, 5, workers=4)
+    np.testing.assert_allclose(result, expected, rtol=1e-5, atol=1e-3)
+
+
+def test_coarse_to_fine_detection():
+    from scipy.spatial import cKDTree
+
+    im, centers = fr._synthetic_beads(80, shape=(32, 256, 256), seed=4)
+    # a bright clump of beads that should not be fit
+    clump = np.array([16, 128, 128])
+    grid = np.indices(im.shape)
+    r2 = sum((g - c) ** 2 / s ** 2 for g, c, s in zip(grid, clump, (3, 5, 5)))
+    im += 5000 * np.exp(-r2 / 2)
+    truth = centers[np.abs(centers - clump).max(1) > 15][:, ::-1]
+
+    full = fr.FiducialCloud(im, dx=0.1, dz=0.3, filtertype="log")
+    coarse = fr.FiducialCloud(im, dx=0.1, dz=0.3, filtertype="log", binning=2)
+    assert coarse.filtered.shape == (32, 128, 128)
+    assert coarse.count >= 0.9 * len(truth)
+    dist, _ = cKDTree(truth).query(coarse.coords.T)
+    assert np.mean(dist < 1) > 0.95
+    assert np.sqrt(np.mean(dist[dist < 1] ** 2)) < 0.2
+    # the clump is detected at full resolution, but rejected when coarse
+    near = np.abs(full.coords.T[:, ::-1] - clump).max(1) < 5
+    assert near.any()
+    assert not (np.abs(coarse.coords.T[:, ::-1] - clump).max(1) < 5).any()
+
+
+def _affine_pairs(n=2000, noutliers=300, seed=5):
+    rs = np.random.RandomState(seed)
+    T = np.eye(4)
+    T[:3, :3] += rs.normal(0, 0.01, (3, 3))
+    T[:3, 3] = [0.4, -0.3, 0.2]
+    X = rs.uniform(0, 1, (3, n)) * np.array([[100], [100], [20]])
+    Y = fr.affineXF(X, T) + rs.normal(0, 0.01, X.shape)
+    # mismatched pairs
+    Y[:, :noutliers] += rs.uniform(-3, 3, (3, noutliers))
+    return X, Y, T
+
+
+def test_infer_robust_ignores_mismatches():
+    X, Y, T = _affine_pairs()
+    for mode in ("affine", "2step", "translation"):
+        tform, inliers = fr.infer_robust(X, Y, mode)
+        assert 1600 < inliers.sum() <= 1720
+        assert inliers[300:].mean() > 0.99
+    tform, inliers = fr.infer_robust(X, Y, "affine")
+    np.testing.assert_allclose(tform, T, atol=2e-3)
+    assert np.abs(fr.infer_affine(X, Y) - T).max() > 2e-3
+
+    # sampling is bounded, even if no good hypothesis exists
+    rs = np.random.RandomState(0)
+    Y = rs.permutation(Y.T).T
+    tform, inliers = fr.infer_robust(X, Y, thresh=0.1, maxiter=50)
+    assert inliers.sum() < 100
+
+
+def test_cloudset_tform_reports_inliers():
+    X, Y, T = _affine_pairs(500, 50)
+    cs = fr.CloudSet()
+    cs.clouds = [fr.FiducialCloud(), fr.FiducialCloud()]
+    cs.clouds[0].coords, cs.clouds[1].coords = Y, X
+    cs.labels, cs.N = ["488", "560"], 2
+    # robust estimation is opt-in
+    tforms = cs.get_all_tforms(inworld=False, modes=("affine",))
+    assert not any("inliers" in t for t in tforms)
+    tforms = cs.get_all_tforms(
+        inworld=False, modes=("affine", "cpd_2step"), robust=True
+    )
+    affine = [t for t in tforms if t["mode"] == "affine" and t["moving"] == "560"]
+    assert affine[0]["inliers"] <= affine[0]["matched"]
+    assert affine[0]["inliers"] > 400
+    np.testing.assert_allclose(affine[0]["tform"], T, atol=5e-3)
+
+
+def test_fiducial_cloud_cache(tmp_path, monkeypatch):
+    import os
+    import tifffile
+
+    im, _ = fr._synthetic_beads(30, shape=(24, 96, 96), seed=6)
+    path = str(tmp_path / "beads.tif")
+    tifffile.imwrite(path, im)
+    cache = str(tmp_path / "cache")
+    params = dict(dx=0.1, dz=0.3, filtertype="log", threshold=5)
+
+    calls = []
+    update_coords = fr.FiducialCloud.update_coords
+    monkeypatch.setattr(
+        fr.FiducialCloud,
+        "update_coords",
+        lambda self, *a: calls.append(1) or update_coords(self, *a),
+    )
+    for data in (path, im):
+        first = fr.FiducialCloud.from_cache(data, cache, **params)
+        second = fr.FiducialCloud.from_cache(data, cache, **params)
+        np.testing.assert_array_equal(first.coords, second.coords)
+        assert first.count > 20
+    assert len(calls) == 2
+    # cached arrays keep their data, cached files are not read
+    assert second.data is im
+    assert not fr.FiducialCloud.from_cache(path, cache, **params).has_data()
+
+    # different detection parameters are detected again
+    fr.FiducialCloud.from_cache(path, cache, **dict(params, threshold=6))
+    assert len(calls) == 3
+
+    cs = fr.CloudSet(
+        [path, path], dx=0.1, dz=0.3, threshold=5, filtertype="log", cache_dir=cache
+    )
+    assert len(calls) == 3
+    np.testing.assert_array_equal(cs.clouds[1].coords, first.coords)
+
+    # files are keyed on their size and modification time
+    os.utime(path, ns=(0, 0))
+    fr.FiducialCloud.from_cache(path, cache, **params)
+    assert len(calls) == 4
+
+    # the default cache location is the mosaicpy cache dir
+    monkeypatch.setenv("MOSAICPY_CACHE_DIR", str(tmp_path / "default"))
+    fr.FiducialCloud.from_cache(path, **params)
+    assert len(list((tmp_path / "default" / "beads").glob("beads_*.json"))) == 1
+
+
+def test_localization_tiers():
+    from scipy.spatial import cKDTree
+
+    im, centers = fr._synthetic_beads(60, shape=(32, 192, 192), seed=7)
+    tree = cKDTree(centers[:, ::-1])
+    for localization in ("centroid", "gauss1d", "gauss3d"):
+        cloud = fr.FiducialCloud(
+            im, dx=0.1, dz=0.3, filtertype="log", localization=localization
+        )
+        dist = tree.query(cloud.coords.T)[0]
+        assert np.sum(dist < 1) >= 45
+        assert np.sqrt(np.mean(dist[dist < 1] ** 2)) < 0.15
+    with pytest.raises(ValueError):
+        fr.FiducialCloud(localization="fast")
+
+
+def test_regfile_preview(tmp_path):
+    import json
+
+    T = np.eye(4)
+    T[:3, 3] = [0.4, -0.4, 0]
+    path = str(tmp_path / "reg.json")
+    tforms = [{"reference": 488, "moving": 560, "mode": "2step", "tform": T.tolist()}]
+    with open(path, "w") as f:
+        json.dump({"tforms": tforms, "dx": 0.1, "dz": 0.3}, f)
+    regfile = fr.RegFile(path)
+
+    im, _ = fr._synthetic_beads(20, shape=(16, 64, 80), seed=8)
+    mips = regfile.preview([im, im], [488, 560], 488, "2step")
+    assert mips.shape == (2, 1, 64, 80)
+    np.testing.assert_array_equal(mips[0, 0], im.max(0))
+    # 560 is shifted by +4 px in x and -4 px in y
+    np.testing.assert_allclose(mips[1, 0, 10:50, 10:70], im.max(0)[14:54, 6:66])
+
+    binned = regfile.preview([im, im], [488, 560], 488, "2step", method="binned")
+    assert binned.shape == (2, 16, 16, 20)
+    np.testing.assert_allclose(binned[1, :, 5:12, 5:15], binned[0, :, 6:13, 4:14])
@@ -0,0 +1,208 @@
+import numpy as np
+from mosaicpy.llsdir import LLSParams
+from mosaicpy.imgprocessors.imgprocessors import (
+    DeskewProcessor,
+    RotateYProcessor,
+    _FusedGeometryProcessor,
+    TrimProcessor,
+    BleachCorrectionProcessor,
+    SelectiveMedianProcessor,
+    deskew_tform,
+    rotate_y_tform,
+    narrowest_dtype,
+)
+
+
+def _field(z, y, x):
+    return 100 + 50 * np.sin(z / 3.0) * np.cos(y / 4.0) + 30 * np.sin(x / 5.0)
+
+
+def _meta(nc=1):
+    return {
+        "c": list(range(nc)),
+        "w": [488, 560][:nc],
+        "params": LLSParams(dz=0.3, dx=0.1, angle=31.5),
+    }
+
+
+def test_deskew_tform_shape():
+    M, shape = deskew_tform((10, 20, 30), 0.3, 0.1, 31.5)
+    nx = 30 + int(np.floor(10 * 0.3 * np.cos(31.5 * np.pi / 180) / 0.1))
+    assert shape == (10, 20, nx)
+    # the central z plane is shifted to the center of the output
+    zyx = M @ [5, 0, shape[2] / 2, 1]
+    np.testing.assert_allclose(zyx[:3], [5, 0, 15])
+
+
+def test_fused_geometry_single_interpolation():
+    shape = (24, 32, 40)
+    data = _field(*np.indices(shape, dtype=float)).astype(np.float32)
+    meta = _meta()
+    steps = [DeskewProcessor(), RotateYProcessor(angle=10, xzRatio=1)]
+
+    sequential = data
+    for step in steps:
+        sequential = step.resample(sequential, meta)
+    fused_imp = _FusedGeometryProcessor(steps)
+    fused, meta = fused_imp.process(data, meta)
+    assert fused.shape == sequential.shape
+    assert fused.dtype == np.float32
+
+    # exact values, where the source lies well inside the input volume
+    M, outshape = fused_imp.index_tform(shape, meta)
+    idx = np.indices(outshape, dtype=float).reshape(3, -1)
+    src = M[:3, :3] @ idx + M[:3, 3:]
+    inside = np.all((src > 2) & (src < np.array(shape)[:, None] - 3), axis=0)
+    inside = inside.reshape(outshape)
+    inside &= sequential > 0
+    truth = _field(*src).reshape(outshape)
+    err_fused = np.abs(fused - truth)[inside]
+    err_seq = np.abs(sequential - truth)[inside]
+    assert inside.sum() > 1000
+    assert err_fused.mean() < err_seq.mean()
+    assert err_fused.max() < 2
+
+
+def test_fused_geometry_multichannel():
+    shape = (8, 12, 16)
+    data = np.random.RandomState(0).rand(2, *shape).astype(np.float32)
+    meta = _meta(nc=2)
+    fused = _FusedGeometryProcessor([DeskewProcessor(), RotateYProcessor(angle=5)])
+    out, _ = fused.process(data, meta)
+    for c in range(2):
+        single, _ = fused.process(data[c], _meta())
+        np.testing.assert_array_equal(out[c], single)
+
+
+def test_fuse_consecutive_geometric_imps():
+    d, r, t = DeskewProcessor(), RotateYProcessor(), TrimProcessor()
+    imps = _FusedGeometryProcessor.fuse([t, d, r, t, d])
+    assert [type(i) for i in imps] == [
+        TrimProcessor,
+        _FusedGeometryProcessor,
+        TrimProcessor,
+        DeskewProcessor,
+    ]
+    assert imps[1].steps == [d, r]
+
+
+def test_selective_median_rounds_up_even_sizes():
+    # the GUI spin box allows every size in valid_range
+    lo, hi = SelectiveMedianProcessor.valid_range["median_range"]
+    for size in range(lo, hi + 1):
+        imp = SelectiveMedianProcessor(median_range=size)
+        assert imp.median_range % 2 == 1
+        assert size <= imp.median_range <= size + 1
+
+
+def test_narrowest_dtype():
+    accepted = (np.uint8, np.uint16, np.float32)
+    assert narrowest_dtype(np.uint16, accepted) == np.uint16
+    assert narrowest_dtype(bool, accepted) == np.uint8
+    assert narrowest_dtype(np.int16, accepted) == np.float32
+    assert narrowest_dtype(np.float64, accepted) == np.float32
+    assert narrowest_dtype(np.float64, (np.uint16,)) == np.uint16
+
+
+def test_dtypes_are_kept():
+    shape = (8, 12, 16)
+    data = _field(*np.indices(shape, dtype=float))
+    meta = _meta()
+    bleach = BleachCorrectionProcessor(data[:2])
+    # float64 input is processed as float32
+    out, _ = bleach(data, meta)
+    assert out.dtype == np.float32
+    np.testing.assert_allclose(out, data * data[:2].mean() / data.mean(), rtol=1e-6)
+
+    # integer data is resampled in float32, rounded back to the input dtype
+    fused = _FusedGeometryProcessor([DeskewProcessor(), RotateYProcessor(angle=5)])
+    out16, _ = fused(data.astype(np.uint16), meta)
+    out32, _ = fused(data.astype(np.uint16).astype(np.float32), meta)
+    assert out16.dtype == np.uint16
+    np.testing.assert_array_equal(out16, np.rint(out32))
+
+
+def _fake_deskew_interface(im, nx, ny, nz, dz, dr, angle, result, nxout, shift):
+    # the cudaDeconv deskew kernel: linear interpolation along x at
+    # xin = (xout - nxOut / 2 + shift) - deskewFactor * (z - nz / 2) + nx / 2
+    f = np.cos(angle * np.pi / 180) * dz / dr
+    xout = np.arange(nxout)
+    result[:] = 0
+    for z in range(nz):
+        xin = (xout - nxout / 2.0 + shift) - f * (z - nz / 2.0) + nx / 2.0
+        valid = (xin >= 0) & (xin < nx - 1)
+        base = np.floor(xin[valid]).astype(int)
+        frac = (xin[valid] - base).astype(np.float32)
+        plane = im[z]
+        result[z][:, valid] = plane[:, base] * (1 - frac) + plane[:, base + 1] * frac
+    return 0
+
+
+def test_deskew_tform_matches_gpu_geometry(monkeypatch):
+    from mosaicpy import libcudawrapper
+
+    monkeypatch.setattr(libcudawrapper, "requireCUDAlib", lambda: None)
+    monkeypatch.setattr(libcudawrapper, "cuda_reset", lambda: None)
+    monkeypatch.setattr(libcudawrapper, "Deskew_interface", _fake_deskew_interface)
+
+    shape = (12, 10, 30)
+    data = _field(*np.indices(shape, dtype=float)).astype(np.float32)
+    meta = _meta()
+    for shift in (0, 3):
+        gpu = libcudawrapper.deskewGPU(data, 0.3, 0.1, 31.5, shift=shift)
+        cpu = DeskewProcessor(shift=shift).resample(data, meta)
+        assert cpu.shape == gpu.shape
+        inside = (gpu > 0) & (cpu > 0)
+        assert inside.sum() > 0.3 * gpu.size
+        np.testing.assert_allclose(cpu[inside], gpu[inside], rtol=1e-4)
+
+
+def test_rotate_y_tform_matches_gpu_geometry(monkeypatch):
+    from mosaicpy import libcudawrapper
+
+    captured = {}
+
+    def fake_affine(im, tmat, dzyx=None):
+        captured["shape"], captured["tmat"] = im.shape, tmat
+        return np.zeros(im.shape, np.float32)
+
+    monkeypatch.setattr(libcudawrapper, "requireCUDAlib", lambda: None)
+    monkeypatch.setattr(libcudawrapper, "affineGPU", fake_affine)
+    shape = (12, 10, 30)
+    P = np.eye(4)[[2, 1, 0, 3]]
+    for reverse in (False, True):
+        libcudawrapper.rotateGPU(np.zeros(shape), 20, 0.5, reverse)
+        M, outshape = rotate_y_tform(shape, 20, 0.5, reverse)
+        assert outshape == captured["shape"]
+        # rotateGPU hands an xyz matrix to the affine kernel
+        np.testing.assert_allclose(M, P @ captured["tmat"] @ P)
+
+
+def test_regfile_preview_deskews_skewed_input(tmp_path):
+    import json
+    from fiducialreg import fiducialreg as fr
+    from fiducialreg.imwarp import WarpPlan
+
+    T = np.eye(4)
+    T[:3, 3] = [0.4, -0.4, 0]
+    path = str(tmp_path / "reg.json")
+    tforms = [{"reference": 488, "moving": 560, "mode": "2step", "tform": T.tolist()}]
+    with open(path, "w") as f:
+        json.dump({"tforms": tforms, "dx": 0.1, "dz": 0.3}, f)
+    regfile = fr.RegFile(path)
+
+    # beads in deskewed space, and the raw sample-scan stack they came from
+    rawshape = (16, 64, 96)
+    M, shape = deskew_tform(rawshape, 0.3, 0.1, 31.5)
+    im, _ = fr._synthetic_beads(40, shape=shape, seed=9)
+    im *= WarpPlan.from_matrix(M, rawshape, shape)(np.ones(rawshape)) > 0.999
+    skewed = WarpPlan.from_matrix(np.linalg.inv(M), shape, rawshape)(im)
+
+    dz = 0.3 * np.sin(31.5 * np.pi / 180)
+    expected = regfile.preview([im, im], [488, 560], 488, "2step", dz=dz)
+    result = regfile.preview(
+        [skewed, skewed], [488, 560], 488, "2step", dz=dz, prewarp=(M, shape)
+    )
+    assert result.shape == expected.shape == (2, 1) + shape[1:]
+    for res, exp in zip(result, expected):
+        assert np.corrcoef(res.ravel(), exp.ravel())[0, 1] > 0.98
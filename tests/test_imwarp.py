@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+from fiducialreg import imwarp
+from fiducialreg.imref import imref3d
+
+
+def _tform(seed=0):
+    rs = np.random.RandomState(seed)
+    T = np.eye(4)
+    T[:3, :3] += rs.normal(0, 0.02, (3, 3))
+    T[:3, 3] = [1.3, -2.2, 0.7]
+    return T
+
+
+@pytest.mark.parametrize("dtype", [np.uint16, np.float32, np.float64])
+def test_imwarp_matches_map_coordinates(dtype):
+    im = (np.random.RandomState(1).rand(20, 40, 50) * 1000).astype(dtype)
+    T = _tform()
+    result = imwarp.imwarp(im, T)
+    assert result.dtype == np.float32
+    expected = imwarp.imwarp_map_coordinates(im, T)
+    np.testing.assert_allclose(result, expected, rtol=1e-5, atol=1e-3)
+
+    # anisotropic voxels and an output reference that contains the whole input
+    R_A = imref3d(im.shape, 0.1, 0.1, 0.3)
+    outputRef = imwarp.calculateOutputSpatialReferencing(R_A, T)
+    out = np.zeros(outputRef.ImageSize, np.float32)
+    result = imwarp.imwarp(im, T, R_A, outputRef, out=out)
+    assert result is out
+    expected = imwarp.imwarp_map_coordinates(im, T, R_A, outputRef)
+    np.testing.assert_allclose(result, expected, rtol=1e-5, atol=1e-3)
+
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.uint16, np.int32, np.float64])
+def test_imwarp_returns_float32(dtype):
+    # unlike imwarp_map_coordinates, which returns float64 for integer input
+    im = (np.random.RandomState(3).rand(6, 8, 9) * 200).astype(dtype)
+    assert imwarp.imwarp_map_coordinates(im, _tform()).dtype == np.float64
+    assert imwarp.imwarp(im, _tform()).dtype == np.float32
+    np.testing.assert_array_equal(imwarp.imwarp(im, np.eye(4)), im.astype("f4"))
+
+
+def test_imwarp_identity():
+    im = np.random.RandomState(2).rand(5, 6, 7).astype(np.float32)
+    np.testing.assert_array_equal(imwarp.imwarp(im, np.eye(4)), im)
+
+
+def test_warp_plan_reuse():
+    rs = np.random.RandomState(3)
+    T = _tform(1)
+    R_A = imref3d((12, 30, 40), 0.1, 0.1, 0.3)
+    outputRef = imwarp.calculateOutputSpatialReferencing(R_A, T)
+    plan = imwarp.WarpPlan(T, (12, 30, 40), R_A, outputRef)
+    out = np.empty(plan.output_shape, np.float32)
+    for _ in range(3):
+        im = rs.rand(12, 30, 40).astype(np.float32)
+        expected = imwarp.imwarp_map_coordinates(im, T, R_A, outputRef)
+        np.testing.assert_allclose(plan(im, out=out), expected, rtol=1e-5, atol=1e-6)
+    with pytest.raises(ValueError):
+        plan(np.zeros((12, 30, 41), np.float32))
+
+    x, y, z = rs.rand(3, 5, 6)
+    for a, b in zip(
+        plan.inverse_points(x, y, z), imwarp.transformPackedPointsInverse(T, x, y, z)
+    ):
+        np.testing.assert_allclose(a, b)
+
+
+def test_projection_plan_matches_projected_warp():
+    # sparse beads, as in registration calibration data
+    rs = np.random.RandomState(4)
+    zz, yy, xx = np.indices((12, 60, 70))
+    im = np.zeros(zz.shape, np.float32)
+    for z, y, x in rs.uniform((2, 5, 5), (10, 55, 65), (20, 3)):
+        im += np.exp(-((zz - z) ** 2 / 4 + (yy - y) ** 2 / 2 + (xx - x) ** 2 / 2))
+    R_A = imref3d(im.shape, 0.1, 0.1, 0.3)
+    # in-plane affine, as in the first step of '2step' tforms
+    T = np.eye(4)
+    T[:2, :2] += [[0.02, -0.01], [0.015, -0.02]]
+    T[:2, 3] = [0.13, -0.22]
+    expected = imwarp.imwarp(im, T, R_A).max(0)
+    plan = imwarp.projection_plan(T, im.shape, R_A)
+    result = plan(im.max(0)[np.newaxis])
+    assert result.shape == (1, 60, 70)
+    assert np.corrcoef(result[0].ravel(), expected.ravel())[0, 1] > 0.99
+    unregistered = np.corrcoef(im.max(0).ravel(), expected.ravel())[0, 1]
+    assert unregistered < 0.9
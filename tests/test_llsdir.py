@@ -1,5 +1,8 @@
 import os
 import hashlib
+import numpy as np
+import tifffile
+from mosaicpy.llsdir import LLSFolder
 
 def sha1OfFile(filepath):
     sha = hashlib.sha1()
@@ -18,4 +21,76 @@ def hash_dir(dir_path):
         for dir in sorted(dirs): # we sort to guarantee that dirs will always go in the same order
             hashes.append(hash_dir(os.path.join(path, dir)))
         break # we only need one iteration - to get files and dirs in current directory
-    return str(hash(''.join(hashes)))
\ No newline at end of file
+    return str(hash(''.join(hashes)))
+
+
+def _lls_folder(path, nt=2, waves=(488, 560), shape=(6, 16, 20)):
+    rs = np.random.RandomState(0)
+    name = "cell_ch{}_stack{:04d}_{}nm_{:07d}msec_{:010d}msecAbs.tif"
+    for t in range(nt):
+        for c, w in enumerate(waves):
+            stack = rs.randint(0, 5000, shape).astype(np.uint16)
+            tifffile.imwrite(str(path / name.format(c, t, w, t, t)), stack)
+    return path
+
+
+def test_llsfolder_mmap(tmp_path):
+    data = LLSFolder(str(_lls_folder(tmp_path)))
+    for sel in ({}, {"t": 1}, {"t": 1, "c": [0]}, {"t": [0, 1], "c": 1, "z": [1, 2]}):
+        mapped = data.asarray(mmap=True, **sel)
+        read = data.asarray(mmap=False, **sel)
+        assert mapped.axes == read.axes
+        assert mapped.dtype == read.dtype
+        np.testing.assert_array_equal(mapped, read)
+
+    # a single stack is a copy-on-write view of the file
+    stack = data.asarray(t=1, c=0, z=range(2, 5))
+    chain = [stack]
+    while getattr(chain[-1], "base", None) is not None:
+        chain.append(chain[-1].base)
+    assert any(isinstance(b, np.memmap) for b in chain)
+    expected = data.asarray(t=1, c=0, mmap=False)[2:5]
+    stack[:] = 0
+    np.testing.assert_array_equal(data.asarray(t=1, c=0)[2:5], expected)
+
+
+def test_regdir_write_reg_file(tmp_path, monkeypatch):
+    import json
+    from scipy import ndimage
+    from fiducialreg import fiducialreg as fr
+    from mosaicpy.llsdir import RegDir
+
+    folder = tmp_path / "beads"
+    folder.mkdir()
+    im, _ = fr._synthetic_beads(30, shape=(16, 96, 96), seed=3)
+    name = "beads_ch{}_stack0000_{}nm_0000000msec_0000000000msecAbs.tif"
+    # the 560 channel is shifted by one pixel in x
+    for c, (w, shift) in enumerate(((488, 0), (560, 1))):
+        data = ndimage.shift(im, (0, 0, shift), order=0)
+        tifffile.imwrite(str(folder / name.format(c, w)), data.astype(np.uint16))
+
+    detections = []
+    update_coords = fr.FiducialCloud.update_coords
+    monkeypatch.setattr(
+        fr.FiducialCloud,
+        "update_coords",
+        lambda self, *a: detections.append(1) or update_coords(self, *a),
+    )
+    cache = str(tmp_path / "cache")
+    for refs in ([488], [560]):
+        rd = RegDir(str(folder), filtertype="log", cache_dir=cache)
+        rd.params.update(dx=0.1, dz=0.3)
+        assert rd.isValid and rd.waves == [488, 560]
+        outfile, outstring = rd.write_reg_file(
+            str(tmp_path), refs=refs, modes=["translation"], robust=True
+        )
+        assert outfile == str(tmp_path / "beads_refs{}.reg".format(refs[0]))
+        regfile = fr.RegFile(outfile)
+        assert regfile.refwaves == [str(refs[0])]
+        assert json.loads(outstring)["dx"] == 0.1
+        (tform,) = regfile.tforms
+        assert "inliers" in tform
+        sign = 1 if refs == [488] else -1
+        np.testing.assert_allclose(tform["tform"][0][3], -0.1 * sign, atol=0.02)
+    # beads are only detected once per channel
+    assert len(detections) == 2
@@ -0,0 +1,141 @@
+import numpy as np
+import pytest
+from pathlib import Path
+from mosaicpy.llsdir import LLSdir, LLSParams
+from mosaicpy.processplan import ProcessPlan
+from mosaicpy.imgprocessors import (
+    ImgProcessor,
+    BleachCorrectionProcessor,
+    DeskewProcessor,
+    TrimProcessor,
+)
+
+
+class _AxesArray(np.ndarray):
+    pass
+
+
+class _Data:
+    def __init__(self, arr):
+        self.arr = arr
+        self.dtype = arr.dtype
+        self.reads = []
+
+    def asarray(self, t, c=None):
+        c = list(range(self.arr.shape[1])) if c is None else list(c)
+        self.reads.append(c)
+        out = np.squeeze(self.arr[t][c]).view(_AxesArray)
+        out.axes = "czyx"[-out.ndim :]
+        return out
+
+
+class _Scale(ImgProcessor):
+    def __init__(self, factor=2):
+        self.factor = factor
+
+    def process(self, data, meta):
+        return (data * self.factor).astype(np.float32), meta
+
+    def estimate_memory(self, shape, dtype, meta):
+        n = int(np.prod(shape))
+        return n * (np.dtype(dtype).itemsize + 4), tuple(shape), np.dtype("f4")
+
+
+def _llsdir(nt=2, nc=3, shape=(4, 8, 10)):
+    llsdir = LLSdir.__new__(LLSdir)
+    llsdir.path = Path("/tmp/fake_llsdir")
+    arr = np.random.RandomState(0).randint(0, 1000, (nt, nc) + shape)
+    llsdir.data = _Data(arr.astype(np.uint16))
+    llsdir.params = LLSParams(
+        nt=nt,
+        nc=nc,
+        nz=shape[0],
+        ny=shape[1],
+        nx=shape[2],
+        wavelengths=[488, 560, 642][:nc],
+        dz=0.3,
+        dx=0.1,
+        angle=31.5,
+    )
+    return llsdir
+
+
+def test_estimate_memory():
+    llsdir = _llsdir()
+    plan = ProcessPlan(
+        llsdir,
+        [(TrimProcessor, {"trim_x": (1, 1)}, True), (DeskewProcessor, {}, True)],
+        memory_budget=0,
+    )
+    plan.plan(skip_warnings=True)
+    raw = 3 * 4 * 8 * 10 * 2
+    trim, deskew = plan.estimate_memory()
+    assert trim == raw  # a view
+    # raw + trimmed input + uint16 output + one float32 channel
+    nx = DeskewProcessor().index_tform((4, 8, 8), plan.meta)[1][2]
+    assert deskew == raw + 3 * 4 * 8 * 8 * 2 + 3 * 4 * 8 * nx * 2 + 4 * 8 * nx * 4
+    assert plan.peak_memory() == deskew
+    assert plan.peak_memory([0]) < 0.6 * deskew
+    assert plan.dtypes() == [(np.uint16, np.uint16)] * 2
+
+
+def test_memory_budget_splits_channels():
+    llsdir = _llsdir()
+    imps = [(_Scale, {"factor": 3}, True)]
+
+    plan = ProcessPlan(llsdir, imps, memory_budget=0)
+    plan.plan(skip_warnings=True)
+    assert not plan.split_channels
+    expected = [d for d, _ in plan.execute()]
+
+    plan = ProcessPlan(llsdir, imps, memory_budget=1000)
+    with pytest.raises(plan.PlanWarning, match="one at a time"):
+        plan.plan()
+    plan.plan(skip_warnings=True)
+    assert plan.split_channels
+    llsdir.data.reads.clear()
+    results = list(plan.execute())
+    assert llsdir.data.reads == [[0], [1], [2]] * 2
+    for (data, meta), exp in zip(results, expected):
+        np.testing.assert_array_equal(data, exp)
+        assert meta["c"] == [0, 1, 2]
+
+
+def test_memory_budget_no_warning_when_split_fits():
+    llsdir = _llsdir()
+    imps = [(_Scale, {"factor": 3}, True)]
+    plan = ProcessPlan(llsdir, imps, memory_budget=0)
+    plan.plan(skip_warnings=True)
+    budget = plan.peak_memory([0])
+    assert budget < plan.peak_memory()
+
+    plan = ProcessPlan(llsdir, imps, memory_budget=budget)
+    plan.plan(skip_warnings=True)
+    assert plan.split_channels
+    assert plan.memory_warnings() == []
+
+
+def test_memory_budget_respects_channel_dependence():
+    llsdir = _llsdir()
+    imps = [(BleachCorrectionProcessor, {}, True)]
+    plan = ProcessPlan(llsdir, imps, memory_budget=1000)
+    with pytest.raises(plan.PlanWarning, match="run out of memory"):
+        plan.plan()
+    plan.plan(skip_warnings=True)
+    assert not plan.split_channels
+
+
+def test_warned_plan_is_not_instantiated_twice():
+    created = []
+
+    class _Counted(_Scale):
+        def __init__(self, factor=2):
+            created.append(self)
+            super().__init__(factor)
+
+    plan = ProcessPlan(_llsdir(), [(_Counted, {}, True)], memory_budget=1000)
+    with pytest.raises(plan.PlanWarning):
+        plan.plan()
+    plan.plan(skip_warnings=True)
+    assert len(created) == 1
+    assert plan.imps == created